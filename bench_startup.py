@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""
+Startup benchmark: runs the gateway with --startup-benchmark several times in fresh
+interpreters and reports the time spent in each startup phase.
+
+usage: bench_startup.py [--runs 5] [--timeout 60] [-- extra gateway arguments, e.g. --ini ./bacnet.ini]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_once(extra_args, timeout):
+    """Start the gateway once and return (wall seconds, phase timings)."""
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(
+            [sys.executable, os.path.join(HERE, "pi_serverv2.py"), "--startup-benchmark"] + extra_args,
+            cwd=HERE, capture_output=True, text=True, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired as e:
+        # a thread left running after main() returns keeps the process alive
+        raise RuntimeError(f"gateway did not exit within {timeout}s:\n{e.stdout}\n{e.stderr}")
+    wall = time.perf_counter() - started
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith("{"):
+            return wall, json.loads(line)
+    raise RuntimeError(f"gateway did not report its startup phases:\n{result.stdout}\n{result.stderr}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure gateway startup by phase")
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts to measure")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds a start may take before it counts as hung")
+    parser.add_argument("gateway_args", nargs=argparse.REMAINDER, help="arguments passed on to the gateway after --")
+    args = parser.parse_args()
+    extra_args = [arg for arg in args.gateway_args if arg != "--"]
+
+    walls, phases = [], {}
+    for _ in range(args.runs):
+        wall, timings = run_once(extra_args, args.timeout)
+        walls.append(wall)
+        for phase, seconds in timings.items():
+            phases.setdefault(phase, []).append(seconds)
+
+    print(f"{'phase':<10} {'median':>9} {'min':>9} {'max':>9}")
+    for phase, samples in list(phases.items()) + [("process", walls)]:
+        print(f"{phase:<10} {statistics.median(samples):>8.3f}s {min(samples):>8.3f}s {max(samples):>8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
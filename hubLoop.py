@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import os
 import queue
 import struct
 import sys
 import threading
+import time
+from collections import deque, namedtuple
 from datetime import datetime, timezone
 from time import sleep
 from helper import *
@@ -12,15 +15,59 @@ import serial
 
 from lib import packet_codes
 from lib.central_control_types import CommandCode, EventCode
+from lib.central_control_types import OUTCOME_OK, OUTCOME_TIMEOUT, OUTCOME_RETRY_MAX, OUTCOME_REJECTED, OUTCOME_UNVALIDATED, SUCCESSFUL_OUTCOMES
+from lib.central_control_types import OUTCOME_UNAVAILABLE, OUTCOME_DROPPED, OUTCOME_INTERRUPTED
+from lib.event_codecs import EVENT_CODECS, ChannelEvent, VersionsEvent, VitalsEvent
+from lib import device_snapshot
+from lib.device_snapshot import DeviceSnapshot
 from lib.position_codes import PositionCode
 from lib.utils import HEX
+from lib.logs import LazyHex, configureLogging, getLogger
+from lib import capture
+from lib.metrics import REGISTRY
+from lib.event_bus import EventBus
+from lib.hub_health import CircuitBreaker
+from lib import hub_link
+from lib.hub_link import HubLink
+from lib.tracing import STAGE_QUEUE, Trace
 from lib.twigIDs import TwigID
 
-from typing import Dict, Callable
+from typing import Deque, Dict, Callable, Iterable, List, Optional, Sequence
+
+wireLog = getLogger("wire")
+eventsLog = getLogger("events")
+commandsLog = getLogger("commands")
+
+FRAMES_DECODED = REGISTRY.counter("twig_frames_decoded_total", "Event frames that passed the checksum and were dispatched")
+REJECTED_HELP = "Event frames dropped by dispatch, by reason"
+CHECKSUM_FAILURES = REGISTRY.counter("twig_frames_rejected_total", REJECTED_HELP, {"reason": "checksum"})
+SHORT_EVENTS = REGISTRY.counter("twig_frames_rejected_total", REJECTED_HELP, {"reason": "short"})
+UNKNOWN_EVENTS = REGISTRY.counter("twig_frames_rejected_total", REJECTED_HELP, {"reason": "unknown"})
+SIZE_MISMATCHES = REGISTRY.counter("twig_frames_rejected_total", REJECTED_HELP, {"reason": "size"})
+COMMANDS_SENT = REGISTRY.counter("twig_commands_sent_total", "Commands taken off the queue and put on the wire")
+COMMAND_RETRIES = REGISTRY.counter("twig_command_retries_total", "Commands resent after a transmission error")
+COMMAND_RETRY_MAX = REGISTRY.counter("twig_command_retry_max_total", "Commands abandoned after the maximum number of retries")
+COMMAND_TIMEOUTS = REGISTRY.counter("twig_command_timeouts_total", "Commands that got no response in time")
+COMMAND_QUEUE_DEPTH = REGISTRY.gauge("twig_command_queue_depth", "Commands waiting to be sent to the hub")
+COMMAND_QUEUE_WAIT = REGISTRY.histogram("twig_command_queue_wait_seconds", "Time commands spend queued before going on the wire")
+COMMAND_ROUND_TRIP = REGISTRY.histogram("twig_command_round_trip_seconds", "Time from a command going on the wire to its response, retries included")
+COMMANDS_REFUSED = REGISTRY.counter("twig_commands_refused_total", "Commands refused because the command queue was full")
+COMMANDS_COALESCED = REGISTRY.counter("twig_commands_coalesced_total", "Telemetry commands not queued because an identical one was already waiting")
+COMMANDS_EVICTED = REGISTRY.counter("twig_commands_evicted_total", "Queued telemetry commands dropped to make room for other commands")
+COMMANDS_FAILED_FAST = REGISTRY.counter("twig_commands_failed_fast_total", "Commands failed without being sent while the hub was unresponsive")
+EVENTS_DROPPED = REGISTRY.counter("twig_command_events_dropped_total", "Solicited events dropped because the command loop was not reading them")
+
+COMMAND_QUEUE_SIZE = 256  # commands, a full valve transaction of 16 puts is 18
+EVENT_QUEUE_SIZE = 16  # solicited events waiting for the command loop, only the latest few can answer the active command
+SWEEP_TIMEOUT = 30.0  # seconds a VitalsGet 0 sweep may run before what it buffered is ingested without AllVitalsReported
+SWEEP_MAX_RTUS = 1024  # vitals a sweep may buffer before they are ingested without AllVitalsReported
 
 eventLoop = None
 
 commandLoop = None
+
+hubThreads: List[threading.Thread] = []  # started by the last setup()
+
 # Every command has a 16 bit fletcher appended. The seeding with 0x600D is important
 def fletcher16(bits):
 	sum2 = 0x60
@@ -33,17 +80,147 @@ def fletcher16(bits):
 	return bytes((sum1, sum2))
 
 
+# published on the "command" topic once a command's response has been handled
+CommandOutcome = namedtuple("CommandOutcome", "command raw outcome retries")
+
+
+# commands that only read, see QueuedCommand.isTelemetry
+TELEMETRY_COMMANDS = frozenset((CommandCode.VersionsGet, CommandCode.NetIDGet, CommandCode.PairingPatternGet, CommandCode.VitalsGet))
+
+
+class QueuedCommand(object):
+	# a command waiting in HubCommandLoop.commands, raw already has the fletcher appended
+	# onWire is called on the command thread just before the command is first sent,
+	# onDone with the command's outcome once its response has been handled; both must be quick
+	# traces are the BACnet writes it carries (lib/tracing.py), marked as it goes on the wire and charged its retries
+	# transaction holds every command of the valve transaction it belongs to, see CommandQueue.putMany
+	__slots__ = ("raw", "queuedAt", "onWire", "onDone", "traces", "transaction")
+
+	def __init__(self, raw: bytes, onWire: Optional[Callable[[], None]] = None, onDone: Optional[Callable[[str], None]] = None,
+			traces: Sequence[Trace] = ()):
+		self.raw = raw
+		self.queuedAt = time.perf_counter()
+		self.onWire = onWire
+		self.onDone = onDone
+		self.traces = traces
+		self.transaction: Optional[Sequence[QueuedCommand]] = None
+
+	@property
+	def isTelemetry(self) -> bool:
+		# reads the hub answers from its own state: harmless to merge with an identical one or to drop under load
+		code = self.raw[0]
+		if code == CommandCode.Channel:
+			return self.raw[1] == 0  # channel 0 reads the settings, any other sets them
+		return code in TELEMETRY_COMMANDS
+
+
+class CommandQueueFull(Exception):
+	pass
+
+
+class CommandQueue(object):
+	# Bounded FIFO between everything that queues commands and the command thread
+	# When it is full, queued telemetry is evicted (oldest first) to make room, anything else is refused with
+	# CommandQueueFull rather than left to wait behind hundreds of commands. A telemetry command without an onDone
+	# is not queued at all while an identical one is waiting, so repeated polls collapse into one.
+	def __init__(self, maxsize=COMMAND_QUEUE_SIZE):
+		self.maxsize = maxsize
+		self.items: Deque[QueuedCommand] = deque()
+		self.condition = threading.Condition()
+		self.interrupted = False
+
+	def qsize(self) -> int:
+		return len(self.items)
+
+	def room(self) -> int:
+		return self.maxsize - len(self.items)
+
+	def put(self, command: QueuedCommand):
+		self.putMany((command,))
+
+	def putMany(self, commands: Iterable[QueuedCommand], transaction=False):
+		# all or nothing, so a valve transaction is never queued without its commit
+		# with transaction the commands are one valve transaction, sent in full or failed in full (see discard)
+		evicted: List[QueuedCommand] = []
+		with self.condition:
+			fresh = []
+			for command in commands:
+				if command.isTelemetry and command.onDone is None and any(queued.raw == command.raw for queued in self.items):
+					COMMANDS_COALESCED.inc()
+					continue
+				fresh.append(command)
+			excess = len(self.items) + len(fresh) - self.maxsize
+			if excess > 0:
+				telemetry = [queued for queued in self.items if queued.isTelemetry]
+				if len(telemetry) < excess:
+					COMMANDS_REFUSED.inc(len(fresh))
+					raise CommandQueueFull(f"{len(self.items)} commands queued, no room for {len(fresh)} more")
+				for queued in telemetry[:excess]:
+					self.items.remove(queued)
+				evicted = telemetry[:excess]
+			if transaction:
+				members = tuple(fresh)
+				for command in fresh:
+					command.transaction = members
+			self.items.extend(fresh)
+			self.condition.notify()
+		for queued in evicted:
+			COMMANDS_EVICTED.inc()
+			if queued.onDone is not None:
+				queued.onDone(OUTCOME_DROPPED)  # on the queuing thread, it never reaches the command thread
+
+	def requeue(self, command: QueuedCommand):
+		# put a command that could not be sent back at the front, room or not, it was already accepted once
+		with self.condition:
+			self.items.appendleft(command)
+			self.condition.notify()
+
+	def discard(self, transaction: Sequence[QueuedCommand]) -> List[QueuedCommand]:
+		# take the commands of a transaction that are still queued out of the queue, for the caller to fail
+		with self.condition:
+			discarded = [queued for queued in self.items if queued.transaction is transaction]
+			for queued in discarded:
+				self.items.remove(queued)
+		return discarded
+
+	def interrupt(self):
+		# the next (or current) get returns None straight away
+		with self.condition:
+			self.interrupted = True
+			self.condition.notify_all()
+
+	def get(self, timeout: Optional[float] = None) -> Optional[QueuedCommand]:
+		# None if nothing was queued within timeout, or when interrupted
+		with self.condition:
+			self.condition.wait_for(lambda: self.items or self.interrupted, timeout)
+			if self.interrupted:
+				self.interrupted = False
+				return None
+			return self.items.popleft() if self.items else None
+
+
 class HubCommandLoop(object):
 	# Responsible for queing and dispatching commands to the hub
 	# The hub has no buffering ability, so it is important that commands
 	# are buffered here in the "commands" variable and reeled out only after events related to tehir send
 	# In initial set of 5 commands are issued at startup to harvest information from the hub
+	# Both queues are bounded (see CommandQueue); while the hub is not answering, health fails commands fast and the
+	# loop probes the hub instead of spending a response timeout on every queued command
+	# With a link (see lib/hub_link.py) a serial error puts the command back and waits for the port to be reopened;
+	# every new port gets resetCommandStream and the startup commands before the queued commands are replayed
 	def __init__(self, port: serial.Serial):
 		self.port = port
+		self.link: Optional[HubLink] = None
+		self.linkGeneration = 0  # of the port the command stream was last reset on
+		self.capture: Optional[capture.CaptureWriter] = None
 		self.activeCommand = None
+		self.openTransaction: Optional[Sequence[QueuedCommand]] = None  # sent from, its last command not handled yet
 		self.retryCount = 0
-		self.commands = queue.SimpleQueue()
-		self.events = queue.SimpleQueue()
+		self.commands = CommandQueue()
+		self.events = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+		self.health = CircuitBreaker()
+		self.stopped = False  # set by stop(), cleared by setup() before the loop is started again
+		COMMAND_QUEUE_DEPTH.function = self.commands.qsize
 		self.validators: Dict[CommandCode, Callable[[bytes], bool]] = {
 			# assume VitalsGet a 0x000 all vitals variant
 			CommandCode.VitalsGet: lambda bits: self.validateEventCode(bits, EventCode.CommandSuccess),
@@ -60,113 +237,309 @@ class HubCommandLoop(object):
 
 	def noteEvent(self, bits):
 		if EventCode(bits[0]).isSolicited:
-			self.events.put(bits)
+			self.putEvent(bits)
 
-	def queueNamedCommand(self, commandCode, body=None):
+	def putEvent(self, bits: Optional[bytes]):
+		# None wakes waitForResponse without an answer, see stop()
+		try:
+			self.events.put_nowait(bits)
+		except queue.Full:
+			# nothing is reading them, keep the newest since only a recent event can answer the active command
+			EVENTS_DROPPED.inc()
+			try:
+				self.events.get_nowait()
+			except queue.Empty:
+				pass
+			self.events.put_nowait(bits)
+
+	def isAcceptingWrites(self, room=1) -> bool:
+		# False while the hub is not answering or the command queue could not take room more commands
+		return not self.health.isOpen and self.commands.room() >= room
+
+	@staticmethod
+	def namedCommand(commandCode, body=None, onWire=None, onDone=None, traces=()) -> QueuedCommand:
 		bits = bytes([commandCode])
 		if body:
 			bits += body
-		self.queueCommandBits(bits)
+		return QueuedCommand(bits + fletcher16(bits), onWire, onDone, traces)
+
+	def queueCommands(self, commands: Iterable[QueuedCommand], transaction=False):
+		# queued together or not at all, raises CommandQueueFull; see CommandQueue.putMany for transaction
+		self.commands.putMany(commands, transaction)
 
-	def queueCommandBits(self, bits):
+	def queueNamedCommand(self, commandCode, body=None, onWire=None, onDone=None):
+		self.commands.put(self.namedCommand(commandCode, body, onWire, onDone))
+
+	def queueCommandBits(self, bits, onWire=None, onDone=None):
 		raw = bits + fletcher16(bits)
-		self.commands.put(raw)
+		self.commands.put(QueuedCommand(raw, onWire, onDone))
 
 	def putCommandOnWire(self):
 		global eventLoop
 		packet = packet_codes.escapePacketCodes(self.activeCommand)
 		toSend = bytes(packet).join(packet_codes.PacketCode.byteEnds())
 		self.port.write(toSend)
-		print(f'send[{HEX(toSend)}]')
-		eventLoop.append_to_list(f'send[{HEX(toSend)}]')
+		if self.capture is not None:
+			self.capture.write(capture.DIRECTION_TX, toSend)
+		wireLog.debug("send[%s]", LazyHex(toSend))
+		eventLoop.append_to_list("send[%s]", LazyHex(toSend))
 
 
 	def validateValvesSet(self, eventBits) -> bool:
 		if eventBits[0] != EventCode.Valves:
 			return False
-		active_oid, _ = struct.unpack_from("<IB", self.activeCommand, 1)
-		event_oid, _ = struct.unpack_from("<IB", eventBits, 1)
+		valvesStruct = EVENT_CODECS[EventCode.Valves].struct  # ValvesPut shares the Valves event layout
+		active_oid, _ = valvesStruct.unpack_from(self.activeCommand, 1)
+		event_oid, _ = valvesStruct.unpack_from(eventBits, 1)
 		return active_oid == event_oid
 
 	def validateEventCode(self, eventBits, desiredCode):
 		return eventBits[0] == desiredCode
 
-	def validateResponse(self, eventBits):
+	def validateResponse(self, eventBits) -> str:
 		validator = self.validators.get(self.activeCommand[0], None)
 		if validator:
 			if not validator(eventBits):
-				print(f"UNEXPECTED {HEX(self.activeCommand)} {HEX(eventBits)}")
-				self.waitForResponse()
-		else:
-			print(f"NO VALIDATOR {HEX(self.activeCommand)}")
-
-	def waitForResponse(self):
+				commandsLog.warning("UNEXPECTED %s %s", LazyHex(self.activeCommand), LazyHex(eventBits))
+				if eventBits[0] == EventCode.CommandErrorIllegal and eventBits[1:2] == self.activeCommand[:1]:
+					return OUTCOME_REJECTED
+				return self.waitForResponse()
+			return OUTCOME_OK
+		commandsLog.debug("NO VALIDATOR %s", LazyHex(self.activeCommand))
+		return OUTCOME_UNVALIDATED
+
+	def waitForResponse(self) -> str:
 		global eventLoop
 		try:
 			responseBits = self.events.get(timeout=0.6)
 		except queue.Empty:
-			print(f"ERROR no response for {HEX(self.activeCommand)}")
-			eventLoop.append_to_list(f"ERROR no response for {HEX(self.activeCommand)}")
-
-			return
+			COMMAND_TIMEOUTS.inc()
+			commandsLog.warning("no response for %s", LazyHex(self.activeCommand))
+			eventLoop.append_to_list("ERROR no response for %s", LazyHex(self.activeCommand))
+			return OUTCOME_TIMEOUT
+		if responseBits is None:
+			return OUTCOME_INTERRUPTED
 		if EventCode(responseBits[0]).isTransmissionError:
 			if self.retryCount < 3:
 				self.retryCount += 1
-				print(f"RETRY {self.retryCount} {HEX(self.activeCommand)}")
+				COMMAND_RETRIES.inc()
+				commandsLog.info("RETRY %d %s", self.retryCount, LazyHex(self.activeCommand))
 				sleep(0.01)
 				self.drainEvents()
 				self.putCommandOnWire()
-				self.waitForResponse()
-				return
+				return self.waitForResponse()
 			else:
-				print(f"RETRY MAX {HEX(self.activeCommand)}")
-				return
-		self.validateResponse(responseBits)
+				COMMAND_RETRY_MAX.inc()
+				commandsLog.warning("RETRY MAX %s", LazyHex(self.activeCommand))
+				return OUTCOME_RETRY_MAX
+		return self.validateResponse(responseBits)
 
 	def drainEvents(self):
-		while self.events.qsize():
-			self.events.get_nowait()
+		try:
+			while True:
+				self.events.get_nowait()
+		except queue.Empty:
+			pass
 
 	def step(self):
-		self.activeCommand = self.commands.get()
+		global eventLoop
+		if not self.awaitLink():
+			return
+		if self.health.probeDue():
+			try:
+				self.probe()
+			except (serial.SerialException, OSError) as e:
+				self.linkFailed(e)
+			return
+		command = self.commands.get(self.health.timeUntilProbe())
+		if command is None:
+			return
+		if self.health.isOpen:
+			self.failFast(command)
+			return
+		self.activeCommand = command.raw
+		self.drainEvents()
+		if self.activeCommand[:5] == VITALS_SWEEP_COMMAND:
+			eventLoop.beginVitalsSweep()
+		sentAt = time.perf_counter()
+		COMMAND_QUEUE_WAIT.observe(sentAt - command.queuedAt)
+		if command.onWire is not None:
+			command.onWire()
+			command.onWire = None  # not again if it has to be replayed
+		for trace in command.traces:
+			trace.mark(STAGE_QUEUE)
+		self.openTransaction = command.transaction
+		try:
+			self.putCommandOnWire()
+			COMMANDS_SENT.inc()
+			self.retryCount = 0
+			outcome = self.waitForResponse()
+		except (serial.SerialException, OSError) as e:
+			self.commands.requeue(command)
+			if self.activeCommand[:5] == VITALS_SWEEP_COMMAND:
+				eventLoop.requestSweepEnd("cut short by a write error")
+			self.linkFailed(e)
+			return
+		COMMAND_ROUND_TRIP.observe(time.perf_counter() - sentAt)
+		if self.activeCommand[:5] == VITALS_SWEEP_COMMAND and outcome not in SUCCESSFUL_OUTCOMES:
+			eventLoop.requestSweepEnd(f"failed ({outcome})")  # no AllVitalsReported is coming
+		for trace in command.traces:
+			trace.retries += self.retryCount
+		if outcome != OUTCOME_INTERRUPTED and self.health.record(outcome not in (OUTCOME_TIMEOUT, OUTCOME_RETRY_MAX)) and self.link is not None:
+			self.link.fail(hub_link.TIMEOUT_STREAK, self.linkGeneration)
+		if command.onDone is not None:
+			command.onDone(outcome)
+		eventLoop.bus.publish("command", CommandOutcome(self.activeCommand[0], self.activeCommand, outcome, self.retryCount))
+		if outcome == OUTCOME_INTERRUPTED:
+			self.abandonTransaction()
+		elif command.transaction is not None and command is command.transaction[-1]:
+			self.openTransaction = None
+
+	def awaitLink(self):
+		# wait out a reconnect, then resync the new port before anything else goes out on it
+		# False if there is no port to use, the link was stopped
+		if self.link is None:
+			return True
+		generation = self.link.waitForPort()
+		if generation is None:
+			return False
+		if generation != self.linkGeneration:
+			self.linkGeneration = generation
+			commandsLog.info("resetting the command stream on port generation %d", generation)
+			try:
+				self.resetCommandStream()
+			except (serial.SerialException, OSError) as e:
+				self.linkFailed(e)
+				return False
+			self.abandonTransaction()  # the new port's hub never saw its begin
+			self.drainEvents()
+			self.queueStartupCommands()
+			eventLoop.bus.publish("recovered")
+		return True
+
+	def linkFailed(self, error: Exception):
+		if self.link is None:
+			raise error
+		commandsLog.error("cannot write to the hub: %s", error)
+		self.link.fail(hub_link.WRITE_ERROR, self.linkGeneration)
+
+	def failFast(self, command: QueuedCommand):
+		# the rest of its transaction goes with it, the hub could recover before its commit and take that half on its own
+		global eventLoop
+		failed = [command] + (self.commands.discard(command.transaction) if command.transaction is not None else [])
+		for queued in failed:
+			COMMANDS_FAILED_FAST.inc()
+			commandsLog.debug("hub unresponsive, not sending %s", LazyHex(queued.raw))
+			for trace in queued.traces:
+				trace.mark(STAGE_QUEUE)  # out of the queue, if not on the wire
+			if queued.onDone is not None:
+				queued.onDone(OUTCOME_UNAVAILABLE)
+			eventLoop.bus.publish("command", CommandOutcome(queued.raw[0], queued.raw, OUTCOME_UNAVAILABLE, 0))
+
+	def abandonTransaction(self):
+		# the transaction being sent was cut short by a stop or a new port: its remaining commands can't go out without
+		# the begin that went before them, so they are failed as interrupted and their owner queues the whole of it again
+		global eventLoop
+		transaction, self.openTransaction = self.openTransaction, None
+		if transaction is None:
+			return
+		for queued in self.commands.discard(transaction):
+			if queued.onDone is not None:
+				queued.onDone(OUTCOME_INTERRUPTED)
+			eventLoop.bus.publish("command", CommandOutcome(queued.raw[0], queued.raw, OUTCOME_INTERRUPTED, 0))
+
+	def probe(self):
+		# the hub stopped answering: flush its command stream and see whether it answers a NetIDGet
+		# once it does, the startup commands are queued again in case the hub restarted in the meantime
+		self.resetCommandStream()
+		self.activeCommand = self.namedCommand(CommandCode.NetIDGet).raw
 		self.drainEvents()
 		self.putCommandOnWire()
 		self.retryCount = 0
-		self.waitForResponse()
+		outcome = self.waitForResponse()
+		if outcome == OUTCOME_INTERRUPTED:
+			return
+		answered = outcome not in (OUTCOME_TIMEOUT, OUTCOME_RETRY_MAX)
+		self.health.recordProbe(answered)
+		if answered:
+			self.queueStartupCommands()
+			eventLoop.bus.publish("recovered")
 
 	def resetCommandStream(self):
 		# emit a stream of time spaced empty packets to flush/reset the command stream
 		# this may cause some debug wth output on the hub
 		for _ in range(3):
 			self.port.write(packet_codes.packetize(b""))
+			if self.capture is not None:
+				self.capture.write(capture.DIRECTION_TX, packet_codes.packetize(b""))
 			sleep(0.05)
 
 	def queueStartupCommands(self):
-		self.queueNamedCommand(CommandCode.NetIDGet)
-		self.queueNamedCommand(CommandCode.Channel, bytes([0]))
-		self.queueNamedCommand(CommandCode.VersionsGet)
-		self.queueNamedCommand(CommandCode.PairingPatternGet)
-		self.queueNamedCommand(CommandCode.VitalsGet, struct.pack("<I", 0))
+		try:
+			self.queueCommands((
+				self.namedCommand(CommandCode.NetIDGet),
+				self.namedCommand(CommandCode.Channel, bytes([0])),
+				self.namedCommand(CommandCode.VersionsGet),
+				self.namedCommand(CommandCode.PairingPatternGet),
+				self.namedCommand(CommandCode.VitalsGet, struct.pack("<I", 0)),
+			))
+		except CommandQueueFull as e:
+			commandsLog.warning("startup commands not queued: %s", e)
 
 	def loop(self):
-		self.resetCommandStream()
-		self.queueStartupCommands()
-		while True:
-			self.step()
+		if self.link is None:
+			self.resetCommandStream()
+			self.queueStartupCommands()
+		while not self.stopped:
+			self.step()  # with a link, the first step resets the command stream once the port is open
+		self.abandonTransaction()
+
+	def stop(self):
+		# returns at once; a command waiting for its response ends as interrupted and so does the rest of its valve
+		# transaction, other queued commands are kept for the next loop()
+		self.stopped = True
+		self.commands.interrupt()
+		self.putEvent(None)
 
 
 
 class HubEventLoop(object):
 	# The event loop handles the reading of the serial port and decoding of events
-	# The eventXXX methods can be used as templates for callbacks to ingest network related information into the host system
+	# The eventXXX methods keep the device state and publish what they decode on self.bus; consumers subscribe there
+	# (see lib/event_bus.py) rather than patching the handlers, and can never hold up this thread
 	# It also relays events to the CommandLoop, so that the commandLoop can validate the reception of its commands and queue any retries accordingly
 	def __init__(self, port, commandLoop: HubCommandLoop):
 		super().__init__()
 		self.port = port
+		self.link: Optional[HubLink] = None
+		self.linkGeneration = 0
+		self.stopped = False
+		self.capture: Optional[capture.CaptureWriter] = None
 		self.commandLoop = commandLoop
+		self.isEscaped = False
+		self.packet = bytearray()
 		self.unique_ids = set()
-		self.communication_log=[]
+		self.devices: Dict[int, VitalsEvent] = {}  # last vitals per oid, replaced wholesale at the end of each sweep
+		self.sweepBuffer: Optional[bytearray] = None  # raw Vitals bodies while a VitalsGet 0 sweep is in progress
+		self.sweepDeadline = 0.0  # perf_counter by which the sweep's AllVitalsReported is due
+		self.sweepEndReason: Optional[str] = None  # set when another thread asks for the sweep to be ended
+		self.sweepTimer: Optional[threading.Timer] = None  # wakes the reader at the deadline
+		self.sweepLock = threading.Lock()  # the command thread begins sweeps and asks for their end, this one fills and ends them
+		self.positions: Dict[int, int] = {}  # last reported packed valve positions per oid
+		self.lastSeen: Dict[int, float] = {}  # time of the last live vitals per oid
+		self.staleIDs = set()  # oids restored from the snapshot that have not reported since boot
+		# decoded events for any consumer; topics: "vitals", "sweep", "valves", "netid", "versions", "channel", "subnet",
+		# "pairing", "command_error" (records from lib.event_codecs), "command" (CommandOutcome), "log" and "recovered"
+		# (no payload, the command loop resynced a reopened port or the hub answers its probe again)
+		self.bus = EventBus()
+		self.communication_log = deque(maxlen=20)  # (time, message, args), formatted only when read by getCommunicationLog
 		self.isLoRa = False
+		self.netID: Optional[int] = None
+		self.channel: Optional[ChannelEvent] = None
+		self.versions: Optional[VersionsEvent] = None
+		self.stateVersion = 0  # bumped on every change to the device state, lets readers cache what they derive from it
+		self.snapshotPath: Optional[str] = None
+		self.checkpointTimer: Optional[threading.Timer] = None
 		self.dispatchTable = {
 			EventCode.CycleStartImminent: self.eventCycleStartImminent,
 			EventCode.CommandErrorNotFound: self.eventCommandErrorNotFound,
@@ -186,106 +559,332 @@ class HubEventLoop(object):
 
 	def dispatch(self, packet):
 		if len(packet) < 3:
-			print("!short_event", HEX(packet))
+			SHORT_EVENTS.inc()
+			eventsLog.warning("!short_event %s", LazyHex(bytes(packet)))
+			return
+		# work on views of the packet so neither the body nor the checksum is copied; they are released however dispatch
+		# ends, feed appends to the same bytearray and could not resize it while a view of it is alive
+		with memoryview(packet) as view, view[:-2] as event, view[-2:] as preChecksum:
+			postChecksum = fletcher16(event)
+			if postChecksum != preChecksum:
+				CHECKSUM_FAILURES.inc()
+				if self.link is not None:
+					self.link.noteChecksumFailure(self.linkGeneration)
+				eventsLog.warning("!checksum_pre %s != post %s %s", LazyHex(bytes(preChecksum)), LazyHex(postChecksum), LazyHex(bytes(packet)))
+				return
+			if self.sweepBuffer is not None and self.bufferSweepVitals(event):
+				FRAMES_DECODED.inc()
+				return
+			codec = EVENT_CODECS.get(event[0], None)
+			method = self.dispatchTable.get(event[0], None)
+			if codec is None or method is None:
+				UNKNOWN_EVENTS.inc()
+				eventsLog.warning("!unknown_event %s", LazyHex(bytes(event)))
+				return
+			record = codec.decode(view)
+			if record is None:
+				SIZE_MISMATCHES.inc()
+				eventsLog.warning("!size_event expected %d byte body %s", codec.size, LazyHex(bytes(event)))
+				return
+			solicited = bytes(event) if codec.isSolicited else None
+		FRAMES_DECODED.inc()
+		try:
+			method(record)
+		except Exception as e:
+			eventsLog.exception("handling %s failed: %s", type(record).__name__, e)  # the reader carries on with the next event
+		if solicited is not None:
+			self.commandLoop.noteEvent(solicited)
+
+	# Sweeps are begun by the command thread, but only this thread fills and ends them, so vitals are only ever ingested
+	# here. Other threads ask for the end with requestSweepEnd and wake the reader; so does a timer at the deadline.
+
+	def beginVitalsSweep(self):
+		# every RTU is about to report back to back, buffer them until AllVitalsReported rather than ingesting one at a time
+		# an unfinished sweep is carried on by the new one
+		with self.sweepLock:
+			if self.sweepBuffer is None:
+				self.sweepBuffer = bytearray()
+			self.sweepDeadline = time.perf_counter() + SWEEP_TIMEOUT
+			self.sweepEndReason = None
+			if self.sweepTimer is not None:
+				self.sweepTimer.cancel()
+			self.sweepTimer = threading.Timer(SWEEP_TIMEOUT, self.wakeReader)
+			self.sweepTimer.daemon = True
+			self.sweepTimer.start()
+
+	def requestSweepEnd(self, reason: str):
+		# from any thread: the sweep will not see its AllVitalsReported, the reader ends it as soon as it wakes
+		with self.sweepLock:
+			if self.sweepBuffer is None:
+				return
+			self.sweepEndReason = reason
+		self.wakeReader()
+
+	def wakeReader(self):
+		if hasattr(self.port, "cancel_read"):
+			self.port.cancel_read()
+
+	def sweepOverdue(self) -> Optional[str]:
+		# called with the sweep lock held, why the sweep has to end now if it does
+		if self.sweepEndReason is not None:
+			return self.sweepEndReason
+		if time.perf_counter() >= self.sweepDeadline:
+			return "timed out"
+		if len(self.sweepBuffer) >= SWEEP_MAX_RTUS * VITALS_CODEC.size:
+			return "full"
+		return None
+
+	def expireVitalsSweep(self):
+		# on this thread, after every read: end a sweep that is overdue
+		with self.sweepLock:
+			reason = self.sweepOverdue() if self.sweepBuffer is not None else None
+		if reason is not None:
+			self.endVitalsSweep(reason)
+
+	def bufferSweepVitals(self, event) -> bool:
+		# True if event was a Vitals taken into the sweep; an overdue sweep is ended here instead
+		with self.sweepLock:
+			if self.sweepBuffer is None:
+				return False
+			reason = self.sweepOverdue()
+			if reason is None:
+				if event[0] != EventCode.Vitals or len(event) != VITALS_CODEC.size + 1:
+					return False
+				self.sweepBuffer += event[1:]
+				return True
+		self.endVitalsSweep(reason)
+		return False
+
+	def takeSweep(self) -> Optional[bytearray]:
+		# what the sweep buffered, None without one; the sweep is over
+		with self.sweepLock:
+			buffer, self.sweepBuffer = self.sweepBuffer, None
+			self.sweepEndReason = None
+			if self.sweepTimer is not None:
+				self.sweepTimer.cancel()
+				self.sweepTimer = None
+		return buffer
+
+	def endVitalsSweep(self, reason: str):
+		# on this thread only: ingest what the sweep buffered one rtu at a time, as if unswept
+		buffer = self.takeSweep()
+		if not buffer:
 			return
-		event, preChecksum = packet[:-2], packet[-2:]
-		postChecksum = fletcher16(event)
-		if postChecksum != preChecksum:
-			print("!checksum_pre", HEX(preChecksum), "!= post", HEX(postChecksum), HEX(packet))
+		eventsLog.warning("vitals sweep %s, ingesting the %d rtus it buffered", reason, len(buffer) // VITALS_CODEC.size)
+		for vitals in map(VitalsEvent._make, VITALS_CODEC.struct.iter_unpack(buffer)):
+			self.eventVitals(vitals)
+
+	def restoreSnapshot(self, snapshot: DeviceSnapshot):
+		# start from the last checkpoint so BACnet writes work before the hub has answered anything
+		# every restored rtu stays stale until it reports live vitals
+		self.devices = dict(snapshot.devices)
+		self.positions = dict(snapshot.positions)
+		self.lastSeen = dict(snapshot.lastSeen)
+		self.staleIDs = set(snapshot.devices)
+		self.unique_ids = set(snapshot.devices)
+		if snapshot.netID is not None:
+			self.netID = snapshot.netID
+			self.isLoRa = TwigID.int(snapshot.netID).isLoRa
+		self.channel = snapshot.channel
+		self.versions = snapshot.versions
+		self.stateVersion += 1
+
+	def takeSnapshot(self) -> DeviceSnapshot:
+		return DeviceSnapshot(time.time(), self.netID, self.channel, self.versions, dict(self.devices), dict(self.positions), dict(self.lastSeen))
+
+	def changed(self):
+		self.stateVersion += 1
+		self.checkpoint()
+
+	def checkpoint(self, delay=2.0):
+		# write the registry behind, so a burst of changes costs one write and the serial thread never touches the disk
+		if self.snapshotPath is None or self.checkpointTimer is not None:
 			return
-		eventCode = event[0]
-		method = self.dispatchTable.get(eventCode, None)
-		if method is not None:
-			method(event[1:])
-		else:
-			print("!unknown_event", HEX(event))
-		self.commandLoop.noteEvent(event)
-
-	def eventVitals(self, eventBody): 
-		oid, _pow, rssi, valves, extra = struct.unpack("<IHBHH", eventBody)
-		print(f'<< rtu oid={oid}, rssi={rssi}, valves={valves:04X}, extra={extra:04X}')
-		self.unique_ids.add(oid)
-
-	def eventSubnet(self, eventBody):
-		oid, subnet = struct.unpack("<II", eventBody)
-		print(f'<< subnet oid={oid}, subnet={subnet}')
-		self.append_to_list(f'<< subnet oid={oid}, subnet={subnet}')
+		self.checkpointTimer = threading.Timer(delay, self.writeCheckpoint)
+		self.checkpointTimer.daemon = True
+		self.checkpointTimer.start()
+
+	def writeCheckpoint(self):
+		self.checkpointTimer = None
+		if self.snapshotPath is None:
+			return
+		try:
+			device_snapshot.saveSnapshot(self.snapshotPath, self.takeSnapshot())
+		except OSError as e:
+			eventsLog.warning("cannot write device snapshot %s: %s", self.snapshotPath, e)
+
+	def eventVitals(self, vitals):
+		eventsLog.debug("<< rtu oid=%d, rssi=%d, valves=%04X, extra=%04X", vitals.oid, vitals.rssi, vitals.valves, vitals.extra)
+		self.devices[vitals.oid] = vitals
+		self.positions[vitals.oid] = vitals.valves
+		self.lastSeen[vitals.oid] = time.time()
+		self.unique_ids.add(vitals.oid)
+		self.staleIDs.discard(vitals.oid)
+		self.changed()
+		self.bus.publish("vitals", vitals)
+
+	def eventSubnet(self, subnetInfo):
+		eventsLog.info("<< subnet oid=%d, subnet=%d", subnetInfo.oid, subnetInfo.subnet)
+		self.bus.publish("subnet", subnetInfo)
+		self.append_to_list("<< subnet oid=%d, subnet=%d", subnetInfo.oid, subnetInfo.subnet)
 
 	def eventCycleStartImminent(self, _):  # this should only ever happen on a 174 network
-		print(f'<< cycleStart')
+		eventsLog.debug("<< cycleStart")
 
-	def eventNetID(self, eventBody):
-		(netID,) = struct.unpack("<I", eventBody)
-		twigID: TwigID = TwigID.int(netID)
+	def eventNetID(self, netID):
+		twigID: TwigID = TwigID.int(netID.netID)
 		self.isLoRa = twigID.isLoRa
-		print(f'<< netid={netID}')
-
-	def eventVersions(self, eventBody):
-		protocol, network, git = struct.unpack("<BB8s", eventBody)
-		git = git.strip(b"\x00").decode("ascii")
-		print(f'<< versions git={git}, protocol={protocol}, network={network}')
-		self.append_to_list(f'<< versions git={git}, protocol={protocol}, network={network}')
-
-	def eventChannel(self, eventBody):
-		channel, low, high = struct.unpack("<BBB", eventBody)
-		print(f'<< channel={channel}, min={low}, max={high}')
-		self.append_to_list(f'<< channel={channel}, min={low}, max={high}')
-
-	def eventPairingPattern(self, eventBody):
-		(pattern,) = struct.unpack("<H", eventBody)
-		print(f'<< pairingPattern={pattern:09b}')
+		self.netID = netID.netID
+		self.changed()
+		self.bus.publish("netid", netID)
+		eventsLog.info("<< netid=%d", netID.netID)
+
+	def eventVersions(self, versions):
+		git = versions.git.strip(b"\x00").decode("ascii")
+		self.versions = versions
+		self.changed()
+		self.bus.publish("versions", versions)
+		eventsLog.info("<< versions git=%s, protocol=%d, network=%d", git, versions.protocol, versions.network)
+		self.append_to_list("<< versions git=%s, protocol=%d, network=%d", git, versions.protocol, versions.network)
+
+	def eventChannel(self, channel):
+		self.channel = channel
+		self.changed()
+		self.bus.publish("channel", channel)
+		eventsLog.info("<< channel=%d, min=%d, max=%d", channel.channel, channel.low, channel.high)
+		self.append_to_list("<< channel=%d, min=%d, max=%d", channel.channel, channel.low, channel.high)
+
+	def eventPairingPattern(self, pairingPattern):
+		eventsLog.info("<< pairingPattern=%s", format(pairingPattern.pattern, "09b"))
+		self.bus.publish("pairing", pairingPattern)
 
 	def eventAllVitalsReported(self, _):
-		print(f'<< allVitalsReported')
+		buffer = self.takeSweep()
+		if buffer is None:
+			eventsLog.info("<< allVitalsReported")
+			return
+		sweep = tuple(map(VitalsEvent._make, VITALS_CODEC.struct.iter_unpack(buffer)))
+		now = time.time()
+		devices = dict(self.devices)
+		devices.update((vitals.oid, vitals) for vitals in sweep)
+		positions = dict(self.positions)
+		positions.update((vitals.oid, vitals.valves) for vitals in sweep)
+		lastSeen = dict(self.lastSeen)
+		lastSeen.update((vitals.oid, now) for vitals in sweep)
+		# swap in the new state in one assignment each, readers on other threads see either the old or the new table
+		self.devices = devices
+		self.positions = positions
+		self.lastSeen = lastSeen
+		self.unique_ids = set(devices)
+		self.staleIDs = self.staleIDs - {vitals.oid for vitals in sweep}
+		eventsLog.info("<< allVitalsReported rtus=%d", len(sweep))
+		self.bus.publish("sweep", sweep)
+		self.changed()
 
 	def eventCommandSuccess(self, _):
 		pass
 
-	def eventValves(self, _):
-		pass
+	def eventValves(self, valves):
+		self.positions[valves.oid] = valves.positions
+		self.changed()
+		self.bus.publish("valves", valves)
+
+	def eventCommandErrorChecksum(self, error):
+		eventsLog.warning("ERROR checksum command=%02X pre=%s post=%s", error.command, LazyHex(error.pre), LazyHex(error.post))
+		self.bus.publish("command_error", error)
 
-	def eventCommandErrorChecksum(self, eventBody):
-		print(f"ERROR checksum {HEX(eventBody)}")
+	def eventCommandErrorIllegal(self, error):
+		eventsLog.warning("ERROR illegal command=%02X", error.command)
+		self.bus.publish("command_error", error)
 
-	def eventCommandErrorIllegal(self, eventBody):
-		print(f"ERROR illegal {HEX(eventBody)}")
+	def eventCommandErrorSize(self, error):
+		eventsLog.warning("ERROR size command=%02X passed=%d", error.command, error.passed)
+		self.bus.publish("command_error", error)
 
-	def eventCommandErrorSize(self, eventBody):
-		print(f"ERROR size {HEX(eventBody)}")
+	def eventCommandErrorNotFound(self, error):
+		eventsLog.warning("ERROR not found command=%02X", error.command)
+		self.bus.publish("command_error", error)
 
-	def eventCommandErrorNotFound(self, eventBody):
-		print(f"ERROR not found {HEX(eventBody)}")
+	def awaitLink(self):
+		# block until the link has a port, dropping any partial frame read from the previous one
+		# False if there is no port to use, the link was stopped
+		generation = self.link.waitForPort()
+		if generation is None:
+			return False
+		if generation != self.linkGeneration:
+			self.linkGeneration = generation
+			self.isEscaped = False
+			self.packet = bytearray()
+			self.endVitalsSweep("cut short by a reconnect")
+		return True
 
 	def loop(self):
-		global eventLoop
-		isEscaped = False
-		packet = bytearray()
-		while True:
-			bits = self.port.read(1) # this will block
-			bits += self.port.read(self.port.in_waiting) # this will not, but will grab any other buffered bytes
-			print(f'received[{HEX(bits)}]')
-			self.append_to_list(f'received[{HEX(bits)}]')
-
-			# simple loop for unescaping the byte stream and deframing the packets
-			for byte in bits:
-				if byte == packet_codes.PacketCode.Start:
-					packet = bytearray()
-				elif byte == packet_codes.PacketCode.Stop:
-					self.dispatch(packet)
-				elif byte == packet_codes.PacketCode.Escape:
-					isEscaped = True
-				else:
-					packet.append(byte ^ 0xFF if isEscaped else byte)
-					isEscaped = False
-			if isEscaped == True:
-				print(f'escaped[{HEX(bits)}]')
-	def append_to_list(self,item):
-		# Add the item with a timestamp
-		self.communication_log.append({"timestamp": datetime.now().isoformat(), "value": item})
-		# Keep the list size to a maximum of 10
-		print(self.communication_log)
-		if len(self.communication_log) > 20:
-			self.communication_log.pop(0)  # Remove the oldest item
+		while not self.stopped:
+			if self.link is not None and not self.awaitLink():
+				continue
+			try:
+				bits = self.port.read(1) # this will block
+				if bits:
+					bits += self.port.read(self.port.in_waiting) # this will not, but will grab any other buffered bytes
+			except (serial.SerialException, OSError) as e:
+				if self.link is None:
+					raise
+				eventsLog.error("cannot read from the hub: %s", e)
+				self.link.fail(hub_link.READ_ERROR, self.linkGeneration)
+				continue
+			if self.sweepBuffer is not None:
+				self.expireVitalsSweep()
+			if not bits:
+				continue  # the read was cancelled, the link is reopening the port or the loop is stopping
+			if self.capture is not None:
+				self.capture.write(capture.DIRECTION_RX, bits)
+			wireLog.debug("received[%s]", LazyHex(bits))
+			self.append_to_list("received[%s]", LazyHex(bits))
+			self.feed(bits)
+
+	def feed(self, bits):
+		# simple loop for unescaping the byte stream and deframing the packets
+		# the deframing state is kept between calls, since a packet may be split across reads
+		isEscaped = self.isEscaped
+		packet = self.packet
+		for byte in bits:
+			if byte == packet_codes.PacketCode.Start:
+				packet = bytearray()
+			elif byte == packet_codes.PacketCode.Stop:
+				self.dispatch(packet)
+			elif byte == packet_codes.PacketCode.Escape:
+				isEscaped = True
+			else:
+				packet.append(byte ^ 0xFF if isEscaped else byte)
+				isEscaped = False
+		self.isEscaped = isEscaped
+		self.packet = packet
+		if isEscaped == True:
+			wireLog.debug("escaped[%s]", LazyHex(bytes(bits)))
+
+	def stop(self):
+		# wakes the loop out of its blocking read, the port is left open
+		self.stopped = True
+		if hasattr(self.port, "cancel_read"):
+			self.port.cancel_read()
+
+	def append_to_list(self, message, *args):
+		# Keep the raw arguments with a timestamp, the deque drops the oldest beyond 20
+		# formatting is left to getCommunicationLog so packets nobody looks at cost nothing
+		self.communication_log.append((time.time(), message, args))
+		self.bus.publish("log")
+
+	def getCommunicationLog(self):
+		return [
+			{"timestamp": datetime.fromtimestamp(timestamp).isoformat(), "value": message % args}
+			for timestamp, message, args in list(self.communication_log)
+		]
+
+VITALS_CODEC = EVENT_CODECS[EventCode.Vitals]
+VITALS_SWEEP_COMMAND = bytes([CommandCode.VitalsGet]) + struct.pack("<I", 0)
+
+DEFAULT_PORT_PATH = '/dev/ttyUSB0'
+PORT_ENVIRONMENT_KEY = "TWIG_PORT"  # another serial port, e.g. the terminal of hub_emulator.py
 
 def get_event_loop():
     global eventLoop
@@ -298,27 +897,71 @@ def get_command_loop():
         raise RuntimeError("commandLoop is not initialized. Did you call setup()?")  
     return commandLoop
 
+def get_hub_threads() -> List[threading.Thread]:
+	return list(hubThreads)
+
 def setup():
+	# opens the port and creates the loops the first time, later calls (after teardown) reuse them
+	# and only start new threads; queued commands survive and the command stream is reset before they are sent
 	global eventLoop
 	global commandLoop
-	#portPath = sys.argv[1] # should be something like "/dev/ttyS1"
-	portPath = '/dev/ttyUSB0'
-	try:
-		port = serial.Serial(portPath, stopbits=serial.STOPBITS_ONE, baudrate=115200, timeout=None)
-	except Exception as e:
-		print(e)
-		return CONNECTION_ERROR
-
-	# create a loop object to handle each side of serial communcations (command for sending, event for consuming responses and other async data)
-	commandLoop = HubCommandLoop(port)
-	eventLoop = HubEventLoop(port, commandLoop)
+	global hubThreads
+	if commandLoop is None:
+		status = create_hub()
+	else:
+		status = OK if commandLoop.link.isUp else CONNECTION_ERROR
+	link = commandLoop.link
+	link.stopped = commandLoop.stopped = eventLoop.stopped = False
+	commandLoop.linkGeneration = eventLoop.linkGeneration = 0  # resync on whatever port the link has
 
 	# launch threads to run each loop
-	eventThread = threading.Thread(target=eventLoop.loop)
+	linkThread = threading.Thread(target=link.loop, name="hub-link", daemon=True)
+	linkThread.start()
+	eventThread = threading.Thread(target=eventLoop.loop, name="hub-events", daemon=True)
 	eventThread.start()
-	commandThread = threading.Thread(target=commandLoop.loop)
+	commandThread = threading.Thread(target=commandLoop.loop, name="hub-commands", daemon=True)
 	commandThread.start()
-	return OK
+	hubThreads = [linkThread, eventThread, commandThread]
+	return status
+
+def teardown():
+	# asks the hub threads to finish and returns at once, join get_hub_threads() to wait for them
+	# the port, the loops and the commands still queued are kept for the next setup()
+	if commandLoop is None:
+		return
+	commandLoop.link.stop()
+	commandLoop.stop()
+	eventLoop.stop()
+
+def create_hub():
+	global eventLoop
+	global commandLoop
+	#portPath = sys.argv[1] # should be something like "/dev/ttyS1"
+	portPath = os.environ.get(PORT_ENVIRONMENT_KEY, DEFAULT_PORT_PATH)
+	configureLogging()
+
+	# create a loop object to handle each side of serial communcations (command for sending, event for consuming responses and other async data)
+	commandLoop = HubCommandLoop(None)
+	eventLoop = HubEventLoop(None, commandLoop)
+
+	# the link owns the port: it is reopened after any failure, including not being there at startup
+	def usePort(port):
+		commandLoop.port = eventLoop.port = port
+	link = HubLink(lambda: serial.Serial(portPath, stopbits=serial.STOPBITS_ONE, baudrate=115200, timeout=None), usePort)
+	commandLoop.link = eventLoop.link = link
+	status = OK if link.connect() else CONNECTION_ERROR
+
+	# warm start from the last registry checkpoint, live vitals reconcile it as they arrive
+	eventLoop.snapshotPath = os.environ.get(device_snapshot.ENVIRONMENT_KEY, device_snapshot.DEFAULT_PATH)
+	snapshot = device_snapshot.loadSnapshot(eventLoop.snapshotPath)
+	if snapshot is not None:
+		eventLoop.restoreSnapshot(snapshot)
+		eventsLog.info("restored %d rtus from %s saved %s", len(snapshot.devices), eventLoop.snapshotPath, datetime.fromtimestamp(snapshot.savedAt).isoformat())
+
+	capturePath = os.environ.get(capture.ENVIRONMENT_KEY)
+	if capturePath:
+		commandLoop.capture = eventLoop.capture = capture.CaptureWriter(capturePath)
+	return status
 	# # now wait for user input to send to the hub
 	# while True:
 	# 	commandText = input('Command (hex):')
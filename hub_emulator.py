@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Emulates a TWIG hub on a pseudo terminal, so the gateway can run (and be load tested) without a hub attached
+# usage: hub_emulator.py [--rtus 8] [--delay 0.005] [--vitals 30]
+# prints the terminal's path on the first line, start the gateway with TWIG_PORT=<path>
+
+import argparse
+import os
+import pty
+import signal
+import struct
+import sys
+import threading
+import time
+import tty
+from collections import Counter
+
+from hubLoop import fletcher16
+from lib import packet_codes, valve_positions
+from lib.central_control_types import CommandCode, EventCode
+from lib.event_codecs import EVENT_CODECS
+
+FIRST_RTU = 0x1B00_0001  # SiFlex type B, 2 valves each
+
+
+class HubEmulator(object):
+	# Answers commands the way the hub does, one at a time, each after delay seconds
+	# A VitalsGet sweep is answered with CommandSuccess, a Vitals event per RTU and AllVitalsReported; a ValvesPut with
+	# the RTU's new positions in a Valves event. With vitalsInterval the RTUs also report their vitals on their own.
+	def __init__(self, rtus, netID=1, delay=0.005, vitalsInterval=None):
+		self.positions = {oid: 0 for oid in rtus}
+		self.netID = netID
+		self.channel = (1, 1, 20)  # channel, low, high
+		self.delay = delay
+		self.vitalsInterval = vitalsInterval
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)  # the slave is kept open, the master reads EIO while no end is open
+		self.path = os.ttyname(self.slave)
+		self.writeLock = threading.Lock()
+		self.counts = Counter()  # commands received by code
+		self.stopped = False
+
+	def send(self, code: EventCode, *fields):
+		event = bytes([code]) + EVENT_CODECS[code].struct.pack(*fields)
+		with self.writeLock:
+			os.write(self.master, packet_codes.packetize(event + fletcher16(event)))
+
+	def sendVitals(self, oid: int):
+		self.send(EventCode.Vitals, oid, 3300, 200, self.positions[oid], 0)
+
+	def handle(self, packet: bytes):
+		if len(packet) < 3:
+			return  # the empty packets the gateway resets the command stream with
+		command, checksum = packet[:-2], packet[-2:]
+		if fletcher16(command) != checksum:
+			self.send(EventCode.CommandErrorChecksum, command[0], checksum, fletcher16(command))
+			return
+		code, body = command[0], command[1:]
+		self.counts[code] += 1
+		if self.delay:
+			time.sleep(self.delay)
+		if code == CommandCode.NetIDGet:
+			self.send(EventCode.NetID, self.netID)
+		elif code == CommandCode.Channel:
+			if body[0]:
+				self.channel = (body[0],) + self.channel[1:]
+			self.send(EventCode.Channel, *self.channel)
+		elif code == CommandCode.VersionsGet:
+			self.send(EventCode.Versions, 1, 1, b"emulator")
+		elif code in (CommandCode.PairingPatternGet, CommandCode.PairingPatternGenerate):
+			self.send(EventCode.PairingPattern, 0x5A)
+		elif code in (CommandCode.ValvesBegin, CommandCode.ValvesCommit, CommandCode.Forget):
+			self.send(EventCode.CommandSuccess, code)
+		elif code == CommandCode.Test:
+			self.send(EventCode.Test, bytes(byte ^ 0xFF for byte in body))
+		elif code == CommandCode.VitalsGet:
+			oid, = struct.unpack("<I", body)
+			self.send(EventCode.CommandSuccess, code)
+			for rtu in (self.positions if oid == 0 else [oid] if oid in self.positions else []):
+				self.sendVitals(rtu)
+			if oid == 0:
+				self.send(EventCode.AllVitalsReported)
+		elif code == CommandCode.ValvesPut:
+			oid, bits = struct.unpack("<IB", body)
+			if oid not in self.positions:
+				self.send(EventCode.CommandErrorIllegal, code)
+				return
+			self.positions[oid] = valve_positions.applyPut(oid, self.positions[oid], bits)
+			self.send(EventCode.Valves, oid, self.positions[oid])
+		else:
+			self.send(EventCode.CommandErrorNotFound, code)
+
+	def loop(self):
+		# the same deframing as HubEventLoop.feed
+		packet = bytearray()
+		isEscaped = False
+		while not self.stopped:
+			try:
+				bits = os.read(self.master, 4096)
+			except OSError:
+				return
+			for byte in bits:
+				if byte == packet_codes.PacketCode.Start:
+					packet = bytearray()
+				elif byte == packet_codes.PacketCode.Stop:
+					self.handle(bytes(packet))
+				elif byte == packet_codes.PacketCode.Escape:
+					isEscaped = True
+				else:
+					packet.append(byte ^ 0xFF if isEscaped else byte)
+					isEscaped = False
+
+	def reportVitals(self):
+		while not self.stopped:
+			time.sleep(self.vitalsInterval)
+			for oid in list(self.positions):
+				self.sendVitals(oid)
+
+	def start(self):
+		threads = [threading.Thread(target=self.loop, name="hub-emulator", daemon=True)]
+		if self.vitalsInterval:
+			threads.append(threading.Thread(target=self.reportVitals, name="hub-emulator-vitals", daemon=True))
+		for thread in threads:
+			thread.start()
+		return threads
+
+	def close(self):
+		self.stopped = True
+		os.close(self.slave)
+		os.close(self.master)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="emulate a TWIG hub on a pseudo terminal")
+	parser.add_argument("--rtus", type=int, default=8, help="number of 2 valve RTUs behind the hub")
+	parser.add_argument("--delay", type=float, default=0.005, help="seconds the hub takes to answer a command")
+	parser.add_argument("--vitals", type=float, default=None, help="seconds between unsolicited vitals reports")
+	args = parser.parse_args()
+	emulator = HubEmulator(range(FIRST_RTU, FIRST_RTU + args.rtus), delay=args.delay, vitalsInterval=args.vitals)
+	print(emulator.path, flush=True)
+	stopped = threading.Event()
+	signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+	emulator.start()
+	try:
+		stopped.wait()
+	except KeyboardInterrupt:
+		pass
+	emulator.close()
+	names = {code.value: code.name for code in CommandCode}
+	print(", ".join(f"{names.get(code, hex(code))} {count}" for code, count in sorted(emulator.counts.items())), file=sys.stderr)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,87 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Iterator, Tuple
+
+# A capture file is a sequence of records: header (timestamp, direction, length) followed by the raw bytes
+# Files are preallocated and memory mapped, so the unused tail is zero and a zeroed header marks the end
+RECORD_HEADER = struct.Struct("<dBH")
+DIRECTION_RX = 1  # hub -> gateway
+DIRECTION_TX = 2  # gateway -> hub
+MAX_CHUNK = 0xFFFF
+MIN_FILE_SIZE = 64 * 1024
+ENVIRONMENT_KEY = "TWIG_CAPTURE"
+
+
+class CaptureWriter(object):
+	# Appends timestamped serial chunks to path, rotating it to path.1 ... path.<keep - 1> when full
+	# Safe to share between the event and command threads
+	def __init__(self, path, fileSize=4 * 1024 * 1024, keep=4):
+		self.path = path
+		self.fileSize = max(fileSize, MIN_FILE_SIZE)
+		self.keep = keep
+		self.lock = threading.Lock()
+		self.file = None
+		self.map = None
+		self.offset = 0
+		self.open()
+
+	def open(self):
+		if os.path.exists(self.path):
+			self.shift()  # never overwrite an earlier capture
+		self.file = open(self.path, "w+b")
+		self.file.truncate(self.fileSize)
+		self.map = mmap.mmap(self.file.fileno(), self.fileSize)
+		self.offset = 0
+
+	def shift(self):
+		for index in range(self.keep - 1, 0, -1):
+			source = self.path if index == 1 else f"{self.path}.{index - 1}"
+			if os.path.exists(source):
+				os.replace(source, f"{self.path}.{index}")
+
+	def closeFile(self):
+		self.map.flush()
+		self.map.close()
+		self.file.truncate(self.offset)  # drop the zeroed tail so finished files are compact
+		self.file.close()
+		self.map = None
+		self.file = None
+
+	def write(self, direction, bits):
+		timestamp = time.time()
+		with self.lock:
+			if self.map is None:
+				return
+			for start in range(0, len(bits), MAX_CHUNK):
+				chunk = bits[start:start + MAX_CHUNK]
+				end = self.offset + RECORD_HEADER.size + len(chunk)
+				if end + RECORD_HEADER.size > self.fileSize:  # always leave room for the zeroed end marker
+					self.closeFile()
+					self.open()
+					end = RECORD_HEADER.size + len(chunk)
+				RECORD_HEADER.pack_into(self.map, self.offset, timestamp, direction, len(chunk))
+				self.map[self.offset + RECORD_HEADER.size:end] = chunk
+				self.offset = end
+
+	def close(self):
+		with self.lock:
+			if self.map is not None:
+				self.closeFile()
+
+
+def readCapture(path) -> Iterator[Tuple[float, int, bytes]]:
+	with open(path, "rb") as file:
+		if os.fstat(file.fileno()).st_size == 0:
+			return
+		with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+			offset = 0
+			while offset + RECORD_HEADER.size <= len(view):
+				timestamp, direction, length = RECORD_HEADER.unpack_from(view, offset)
+				if direction == 0:
+					return
+				offset += RECORD_HEADER.size
+				yield timestamp, direction, view[offset:offset + length]
+				offset += length
@@ -61,3 +61,18 @@ class EventCode(enum.IntEnum):
 	@property
 	def isSolicited(self):
 		return self not in (EventCode.CycleStartImminent, EventCode.AllVitalsReported, EventCode.Vitals, EventCode.SubnetInfo)
+
+
+# how a command ended, after its response (and any retries) has been handled by HubCommandLoop
+OUTCOME_OK = "ok"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_RETRY_MAX = "retry_max"
+OUTCOME_REJECTED = "rejected"  # the hub answered CommandErrorIllegal
+OUTCOME_UNVALIDATED = "unvalidated"  # no validator for this command code, assumed to have worked
+OUTCOME_UNAVAILABLE = "unavailable"  # never sent, the hub was not answering (see lib/hub_health.py)
+OUTCOME_DROPPED = "dropped"  # never sent, evicted from a full command queue
+OUTCOME_INTERRUPTED = "interrupted"  # sent, but the command loop was stopped before its response arrived
+OUTCOME_ERROR = "error"  # never sent, the transaction could not be queued (e.g. CommandQueueFull)
+OUTCOME_CANCELLED = "cancelled"  # never sent, its valve operation was cancelled (see lib/valve_scheduler.py)
+SUCCESSFUL_OUTCOMES = (OUTCOME_OK, OUTCOME_UNVALIDATED)
+UNSENT_OUTCOMES = (OUTCOME_UNAVAILABLE, OUTCOME_DROPPED, OUTCOME_INTERRUPTED, OUTCOME_ERROR)  # the transaction never ran on the hub
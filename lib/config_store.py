@@ -0,0 +1,109 @@
+import copy
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from lib.logs import getLogger
+from lib.utils import atomicWrite
+
+log = getLogger("config")
+
+SCHEMA_VERSION = 1
+DEFAULTS = {
+	"num_valves": 0,
+	"object_to_ids_mapping": {},
+	"valve_groups": {},  # group name -> [valve index, ...], each exposed as a BACnet binary value
+}
+
+
+def _migrateUnversioned(config: Dict) -> Dict:
+	# the original flat {"num_valves", "object_to_ids_mapping"} file, only needs stamping
+	return config
+
+
+# MIGRATIONS[n] upgrades a schema n document to schema n + 1
+MIGRATIONS: Dict[int, Callable[[Dict], Dict]] = {
+	0: _migrateUnversioned,
+}
+
+
+class ConfigStore(object):
+	# Keeps the configuration in memory and writes it behind
+	# Bursts of update() calls are coalesced: the file is written once, delay seconds after the last change,
+	# and never later than maxDelay seconds after the first unsaved one
+	def __init__(self, path, delay=0.5, maxDelay=5.0):
+		self.path = path
+		self.delay = delay
+		self.maxDelay = maxDelay
+		self.lock = threading.Lock()
+		self.writeLock = threading.Lock()  # serializes flushes without holding up update()
+		self.data: Dict = copy.deepcopy(DEFAULTS)
+		self.version = 0  # bumped on every change, cheap to compare for readers caching derived state
+		self.dirtySince: Optional[float] = None
+		self.timer: Optional[threading.Timer] = None
+
+	def load(self):
+		try:
+			with open(self.path, "r") as file:
+				stored = json.load(file)
+			if not isinstance(stored, dict):
+				raise ValueError("top level is not an object")
+		except FileNotFoundError:
+			stored = {}
+		except (OSError, ValueError) as e:
+			# keep the damaged file for inspection rather than silently overwriting it on the next flush
+			log.error("cannot read %s (%s), starting from defaults", self.path, e)
+			try:
+				os.replace(self.path, self.path + ".corrupt")
+			except OSError:
+				pass
+			stored = {}
+		schemaVersion = stored.pop("schema_version", 0)
+		while schemaVersion < SCHEMA_VERSION:
+			stored = MIGRATIONS[schemaVersion](stored)
+			schemaVersion += 1
+		if schemaVersion > SCHEMA_VERSION:
+			log.warning("%s has schema %d, newer than %d; unknown keys are kept as is", self.path, schemaVersion, SCHEMA_VERSION)
+		with self.lock:
+			self.data = copy.deepcopy(DEFAULTS)
+			self.data.update(stored)
+			self.version += 1
+
+	def get(self, key, default=None):
+		with self.lock:
+			return copy.deepcopy(self.data.get(key, default))
+
+	def update(self, **values):
+		with self.lock:
+			self.data.update(copy.deepcopy(values))
+			self.version += 1
+			now = time.monotonic()
+			if self.dirtySince is None:
+				self.dirtySince = now
+			wait = min(self.delay, self.dirtySince + self.maxDelay - now)
+			if self.timer is not None:
+				self.timer.cancel()
+			self.timer = threading.Timer(max(wait, 0), self.flush)
+			self.timer.daemon = True
+			self.timer.start()
+
+	def flush(self):
+		with self.writeLock:
+			with self.lock:
+				if self.dirtySince is None:
+					return
+				self.dirtySince = None
+				if self.timer is not None:
+					self.timer.cancel()
+					self.timer = None
+				document = dict(self.data, schema_version=SCHEMA_VERSION)
+				payload = json.dumps(document, indent=1, sort_keys=True).encode("utf-8")
+			try:
+				atomicWrite(self.path, payload)
+			except OSError as e:
+				log.error("cannot write %s: %s", self.path, e)
+				with self.lock:
+					if self.dirtySince is None:
+						self.dirtySince = time.monotonic()  # the next update will retry
@@ -0,0 +1,80 @@
+import asyncore
+import itertools
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from lib.logs import getLogger
+from lib.metrics import REGISTRY
+
+log = getLogger("bacnet")
+
+APPLIED = REGISTRY.counter("twig_bacnet_handoff_applied_total", "Updates handed to the BACnet core thread and applied there")
+COALESCED = REGISTRY.counter("twig_bacnet_handoff_coalesced_total", "Updates replaced by a newer one for the same key before the core thread applied them")
+DELAY = REGISTRY.histogram("twig_bacnet_handoff_delay_seconds", "Time from an update being handed over to the core thread applying it")
+
+
+class CoreHandoff(asyncore.dispatcher):
+	# Runs work from other threads on the bacpypes core thread, which owns the BACnet objects
+	# post() keeps the latest update per key (e.g. per object and property) until the core applies it, and writes a
+	# byte to a socket pair whose other end sits in the core's asyncore map: the core's select wakes at once instead of
+	# at the end of its spin, so a change and its COV notifications go out within milliseconds. Updates are applied in
+	# the order their keys were first posted. Posting before the core runs is fine, the byte waits in the socket.
+	def __init__(self, map=None):
+		self.waker, reader = socket.socketpair()
+		self.waker.setblocking(False)
+		reader.setblocking(False)
+		asyncore.dispatcher.__init__(self, reader, map)
+		self.lock = threading.Lock()
+		self.pending: "OrderedDict[Hashable, list]" = OrderedDict()  # key -> [fn, args, posted at]
+		self.woken = False  # a wake byte has been written and not read yet
+		self.ids = itertools.count()
+
+	def post(self, key: Hashable, fn: Callable, *args):
+		with self.lock:
+			entry = self.pending.get(key)
+			if entry is None:
+				self.pending[key] = [fn, args, time.perf_counter()]
+			else:
+				COALESCED.inc()
+				entry[0], entry[1] = fn, args
+			wake, self.woken = not self.woken, True
+		if wake:
+			try:
+				self.waker.send(b"\0")
+			except (BlockingIOError, OSError) as e:
+				log.debug("cannot wake the core: %s", e)  # full means a wake is pending, closed means shut down
+
+	def call(self, fn: Callable, *args):
+		# never coalesced
+		self.post(("call", next(self.ids)), fn, *args)
+
+	def readable(self) -> bool:
+		return True
+
+	def writable(self) -> bool:
+		return False
+
+	def handle_read(self):
+		try:
+			while self.recv(4096):
+				pass
+		except BlockingIOError:
+			pass
+		with self.lock:
+			pending, self.pending = self.pending, OrderedDict()
+			self.woken = False
+		now = time.perf_counter()
+		for fn, args, postedAt in pending.values():
+			DELAY.observe(now - postedAt)
+			try:
+				fn(*args)
+			except Exception as e:
+				log.exception("update on the BACnet core failed: %s", e)
+		APPLIED.inc(len(pending))
+
+	def close(self):
+		asyncore.dispatcher.close(self)
+		self.waker.close()
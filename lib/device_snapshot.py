@@ -0,0 +1,70 @@
+import struct
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+from lib.event_codecs import ChannelEvent, VersionsEvent, VitalsEvent
+from lib.logs import getLogger
+from lib.utils import atomicWrite
+
+log = getLogger("events")
+
+# A compact binary checkpoint of the device registry, so the gateway can serve and actuate right after boot
+# header, then one record per RTU; the vitals layout matches the Vitals event body
+MAGIC = b"TWRS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHdIBBBBBB8sI")  # magic, format, savedAt, netID, hasNetID, channel, low, high, protocol, network, git, count
+RECORD = struct.Struct("<IHBHHHd")  # oid, power, rssi, valves, extra, positions, lastSeen
+ENVIRONMENT_KEY = "TWIG_SNAPSHOT"
+DEFAULT_PATH = "registry.snapshot"
+
+DeviceSnapshot = namedtuple("DeviceSnapshot", "savedAt netID channel versions devices positions lastSeen")
+
+
+def saveSnapshot(path, snapshot: DeviceSnapshot):
+	channel = snapshot.channel or ChannelEvent(0, 0, 0)
+	versions = snapshot.versions or VersionsEvent(0, 0, b"")
+	chunks: List[bytes] = [HEADER.pack(
+		MAGIC, FORMAT_VERSION, snapshot.savedAt,
+		snapshot.netID or 0, snapshot.netID is not None,
+		channel.channel, channel.low, channel.high,
+		versions.protocol, versions.network, versions.git,
+		len(snapshot.devices),
+	)]
+	for oid, vitals in snapshot.devices.items():
+		chunks.append(RECORD.pack(
+			oid, vitals.power, vitals.rssi, vitals.valves, vitals.extra,
+			snapshot.positions.get(oid, vitals.valves) & 0xFFFF, snapshot.lastSeen.get(oid, snapshot.savedAt),
+		))
+	atomicWrite(path, b"".join(chunks))
+
+
+def loadSnapshot(path) -> Optional[DeviceSnapshot]:
+	try:
+		with open(path, "rb") as file:
+			data = file.read()
+	except FileNotFoundError:
+		return None
+	except OSError as e:
+		log.warning("cannot read device snapshot %s: %s", path, e)
+		return None
+	try:
+		magic, formatVersion, savedAt, netID, hasNetID, channel, low, high, protocol, network, git, count = HEADER.unpack_from(data)
+		if magic != MAGIC or formatVersion != FORMAT_VERSION or len(data) != HEADER.size + count * RECORD.size:
+			raise ValueError("not a device snapshot or an unsupported version")
+	except (struct.error, ValueError) as e:
+		log.warning("ignoring device snapshot %s: %s", path, e)
+		return None
+	devices: Dict[int, VitalsEvent] = {}
+	positions: Dict[int, int] = {}
+	lastSeen: Dict[int, float] = {}
+	for oid, power, rssi, valves, extra, position, seen in RECORD.iter_unpack(memoryview(data)[HEADER.size:]):
+		devices[oid] = VitalsEvent(oid, power, rssi, valves, extra)
+		positions[oid] = position
+		lastSeen[oid] = seen
+	return DeviceSnapshot(
+		savedAt,
+		netID if hasNetID else None,
+		ChannelEvent(channel, low, high) if channel or low or high else None,
+		VersionsEvent(protocol, network, git) if git.strip(b"\x00") else None,
+		devices, positions, lastSeen,
+	)
@@ -0,0 +1,127 @@
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Hashable, Iterable, Optional, Tuple
+
+from lib.logs import getLogger
+from lib.metrics import REGISTRY
+
+log = getLogger("events")
+
+# Publish/subscribe for decoded hub events
+# publish() never blocks on a subscriber: each subscriber has its own bounded queue drained by its own thread,
+# and when a queue is full its policy decides what is lost, so a slow consumer only ever delays itself
+DROP_NEWEST = "drop_newest"  # keep what is queued, lose the new event
+DROP_OLDEST = "drop_oldest"  # make room by losing the oldest queued event
+COALESCE = "coalesce"  # an event replaces the queued one with the same key (by default topic and oid), keeping its place
+
+POLICIES = (DROP_NEWEST, DROP_OLDEST, COALESCE)
+
+Callback = Callable[[str, object], None]
+KeyFunction = Callable[[str, object], Hashable]
+
+
+def topicAndOid(topic: str, payload) -> Hashable:
+	return topic, getattr(payload, "oid", None)
+
+
+class Subscription(object):
+	def __init__(self, name: str, callback: Callback, topics: Optional[Iterable[str]], maxsize: int, policy: str, key: KeyFunction):
+		if policy not in POLICIES:
+			raise ValueError(f"unknown policy {policy!r}, expected one of {', '.join(POLICIES)}")
+		self.name = name
+		self.callback = callback
+		self.topics = frozenset(topics) if topics is not None else None
+		self.maxsize = maxsize
+		self.policy = policy
+		self.key = key
+		self.condition = threading.Condition()
+		self.queue = OrderedDict() if policy == COALESCE else deque()
+		self.closed = False
+		labels = {"subscriber": name}
+		self.dropped = REGISTRY.counter("twig_bus_dropped_total", "Events lost because a subscriber queue was full", labels)
+		self.coalesced = REGISTRY.counter("twig_bus_coalesced_total", "Events that replaced a queued event with the same key", labels)
+		REGISTRY.gauge("twig_bus_queue_depth", "Events waiting for each subscriber", labels).function = lambda: len(self.queue)
+		self.thread = threading.Thread(target=self.run, name=f"bus-{name}", daemon=True)
+
+	def wants(self, topic: str) -> bool:
+		return self.topics is None or topic in self.topics
+
+	def offer(self, topic: str, payload):
+		with self.condition:
+			if self.closed:
+				return
+			if self.policy == COALESCE:
+				key = self.key(topic, payload)
+				if key in self.queue:
+					self.queue[key] = (topic, payload)
+					self.coalesced.inc()
+					return
+				if len(self.queue) >= self.maxsize:
+					self.dropped.inc()
+					return
+				self.queue[key] = (topic, payload)
+			else:
+				if len(self.queue) >= self.maxsize:
+					self.dropped.inc()
+					if self.policy == DROP_NEWEST:
+						return
+					self.queue.popleft()
+				self.queue.append((topic, payload))
+			self.condition.notify()
+
+	def take(self) -> Optional[Tuple[str, object]]:
+		with self.condition:
+			while not self.queue and not self.closed:
+				self.condition.wait()
+			if not self.queue:
+				return None
+			if self.policy == COALESCE:
+				return self.queue.popitem(last=False)[1]
+			return self.queue.popleft()
+
+	def run(self):
+		while True:
+			item = self.take()
+			if item is None:
+				return
+			try:
+				self.callback(*item)
+			except Exception:
+				log.exception("subscriber %s failed on %s", self.name, item[0])
+
+	def close(self):
+		# events already queued are still delivered
+		with self.condition:
+			self.closed = True
+			self.condition.notify()
+
+
+class EventBus(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.subscriptions: Tuple[Subscription, ...] = ()  # replaced, never mutated, so publish() can iterate without the lock
+
+	def subscribe(self, name: str, callback: Callback, topics: Optional[Iterable[str]] = None, maxsize=256,
+			policy=DROP_OLDEST, key: KeyFunction = topicAndOid) -> Subscription:
+		# callback(topic, payload) runs on the subscription's own thread
+		subscription = Subscription(name, callback, topics, maxsize, policy, key)
+		with self.lock:
+			self.subscriptions += (subscription,)
+		subscription.thread.start()
+		return subscription
+
+	def unsubscribe(self, subscription: Subscription):
+		with self.lock:
+			self.subscriptions = tuple(existing for existing in self.subscriptions if existing is not subscription)
+		subscription.close()
+
+	def publish(self, topic: str, payload=None):
+		for subscription in self.subscriptions:
+			if subscription.wants(topic):
+				subscription.offer(topic, payload)
+
+	def close(self):
+		with self.lock:
+			subscriptions, self.subscriptions = self.subscriptions, ()
+		for subscription in subscriptions:
+			subscription.close()
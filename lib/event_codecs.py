@@ -0,0 +1,62 @@
+import struct
+from collections import namedtuple
+from typing import Dict, Optional
+
+from lib.central_control_types import EventCode
+
+# lightweight typed records for decoded event bodies, one per EventCode
+CycleStartImminentEvent = namedtuple("CycleStartImminentEvent", "")
+AllVitalsReportedEvent = namedtuple("AllVitalsReportedEvent", "")
+CommandErrorNotFoundEvent = namedtuple("CommandErrorNotFoundEvent", "command")
+CommandErrorIllegalEvent = namedtuple("CommandErrorIllegalEvent", "command")
+CommandSuccessEvent = namedtuple("CommandSuccessEvent", "command")
+CommandErrorSizeEvent = namedtuple("CommandErrorSizeEvent", "command passed")
+PairingPatternEvent = namedtuple("PairingPatternEvent", "pattern")
+ChannelEvent = namedtuple("ChannelEvent", "channel low high")
+TestEvent = namedtuple("TestEvent", "inverted")
+NetIDEvent = namedtuple("NetIDEvent", "netID")
+CommandErrorChecksumEvent = namedtuple("CommandErrorChecksumEvent", "command pre post")
+ValvesEvent = namedtuple("ValvesEvent", "oid positions")
+SubnetInfoEvent = namedtuple("SubnetInfoEvent", "oid subnet")
+VersionsEvent = namedtuple("VersionsEvent", "protocol network git")
+VitalsEvent = namedtuple("VitalsEvent", "oid power rssi valves extra")
+
+
+class EventCodec(object):
+	# A precompiled decoder for one event code
+	# decode() takes the whole deframed packet (code + body + fletcher) so callers never have to slice it
+	__slots__ = ("code", "struct", "size", "record", "isSolicited")
+
+	def __init__(self, code: EventCode, fmt: str, record):
+		self.code = code
+		self.struct = struct.Struct(fmt)
+		self.size = self.struct.size  # expected body size in bytes
+		self.record = record
+		self.isSolicited = code.isSolicited
+
+	def decode(self, packet) -> Optional[tuple]:
+		# returns None rather than raising when the body is not the expected size
+		if len(packet) != self.size + 3:
+			return None
+		return self.record._make(self.struct.unpack_from(packet, 1))
+
+
+_EVENT_FORMATS = {
+	EventCode.CycleStartImminent: ("<", CycleStartImminentEvent),
+	EventCode.AllVitalsReported: ("<", AllVitalsReportedEvent),
+	EventCode.CommandErrorNotFound: ("<B", CommandErrorNotFoundEvent),
+	EventCode.CommandErrorIllegal: ("<B", CommandErrorIllegalEvent),
+	EventCode.CommandSuccess: ("<B", CommandSuccessEvent),
+	EventCode.CommandErrorSize: ("<BB", CommandErrorSizeEvent),
+	EventCode.PairingPattern: ("<H", PairingPatternEvent),
+	EventCode.Channel: ("<BBB", ChannelEvent),
+	EventCode.Test: ("<4s", TestEvent),
+	EventCode.NetID: ("<I", NetIDEvent),
+	EventCode.CommandErrorChecksum: ("<B2s2s", CommandErrorChecksumEvent),
+	EventCode.Valves: ("<IB", ValvesEvent),
+	EventCode.SubnetInfo: ("<II", SubnetInfoEvent),
+	EventCode.Versions: ("<BB8s", VersionsEvent),
+	EventCode.Vitals: ("<IHBHH", VitalsEvent),
+}
+
+EVENT_CODECS: Dict[int, EventCodec] = {code: EventCodec(code, fmt, record) for code, (fmt, record) in _EVENT_FORMATS.items()}
@@ -0,0 +1,77 @@
+import threading
+import time
+from typing import Optional
+
+from lib.logs import getLogger
+from lib.metrics import REGISTRY
+
+log = getLogger("commands")
+
+CIRCUIT_OPEN = REGISTRY.gauge("twig_hub_circuit_open", "1 while the hub is considered unresponsive and commands fail fast")
+CIRCUIT_OPENED = REGISTRY.counter("twig_hub_circuit_opened_total", "Times the hub was declared unresponsive")
+CIRCUIT_PROBES = REGISTRY.counter("twig_hub_circuit_probes_total", "Recovery probes sent to an unresponsive hub")
+
+CLOSED = "closed"  # the hub answers, commands flow
+OPEN = "open"  # the hub stopped answering, commands fail fast until a probe gets an answer
+
+
+class CircuitBreaker(object):
+	# Tracks whether the hub answers commands
+	# failureThreshold consecutive commands without an answer open the circuit; while open the command loop fails queued
+	# commands at once instead of spending a response timeout on each, and probes the hub every probeInterval seconds,
+	# doubling up to maxProbeInterval. The first probe that gets an answer closes it again.
+	def __init__(self, failureThreshold=3, probeInterval=1.0, maxProbeInterval=30.0):
+		self.failureThreshold = failureThreshold
+		self.baseProbeInterval = probeInterval
+		self.maxProbeInterval = maxProbeInterval
+		self.lock = threading.Lock()
+		self.state = CLOSED
+		self.failures = 0
+		self.probeInterval = probeInterval
+		self.nextProbeAt = 0.0
+		self.openedAt: Optional[float] = None
+
+	@property
+	def isOpen(self) -> bool:
+		return self.state == OPEN
+
+	def record(self, answered: bool) -> bool:
+		# the outcome of a command: answered is False for a timeout or running out of retries
+		# True if this outcome opened the circuit
+		with self.lock:
+			if answered:
+				self.failures = 0
+				return False
+			self.failures += 1
+			if self.state == CLOSED and self.failures >= self.failureThreshold:
+				self.state = OPEN
+				self.openedAt = time.monotonic()
+				self.probeInterval = self.baseProbeInterval
+				self.nextProbeAt = self.openedAt + self.probeInterval
+				CIRCUIT_OPEN.set(1)
+				CIRCUIT_OPENED.inc()
+				log.error("hub unresponsive after %d commands without an answer, failing commands fast", self.failures)
+				return True
+			return False
+
+	def probeDue(self) -> bool:
+		return self.state == OPEN and time.monotonic() >= self.nextProbeAt
+
+	def timeUntilProbe(self) -> Optional[float]:
+		# how long the command loop may block waiting for work, None while closed
+		if self.state != OPEN:
+			return None
+		return max(self.nextProbeAt - time.monotonic(), 0.0)
+
+	def recordProbe(self, answered: bool):
+		CIRCUIT_PROBES.inc()
+		with self.lock:
+			if answered:
+				log.warning("hub answering again after %.1fs", time.monotonic() - (self.openedAt or time.monotonic()))
+				self.state = CLOSED
+				self.failures = 0
+				self.openedAt = None
+				CIRCUIT_OPEN.set(0)
+			else:
+				self.probeInterval = min(self.probeInterval * 2, self.maxProbeInterval)
+				self.nextProbeAt = time.monotonic() + self.probeInterval
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Optional
+
+from lib.logs import getLogger
+from lib.metrics import REGISTRY
+
+log = getLogger("wire")
+
+INCIDENTS_HELP = "Hub link failures that led to the serial port being reopened, by reason"
+LINK_UP = REGISTRY.gauge("twig_hub_link_up", "1 while the serial port to the hub is open")
+RECONNECTS = REGISTRY.counter("twig_hub_link_reconnects_total", "Times the serial port to the hub was reopened after a failure")
+OPEN_FAILURES = REGISTRY.counter("twig_hub_link_open_failures_total", "Attempts to open the serial port that failed")
+RECOVERY = REGISTRY.histogram("twig_hub_link_recovery_seconds", "Time from a link failure to the serial port being open again")
+
+# reasons a loop gives HubLink.fail
+READ_ERROR = "read_error"
+WRITE_ERROR = "write_error"
+OPEN_ERROR = "open_error"  # the port could not be opened at startup
+CHECKSUM_BURST = "checksum_burst"  # the stream from the hub has desynchronised
+TIMEOUT_STREAK = "timeout_streak"  # the hub stopped answering, the adapter may have wedged
+
+
+class HubLink(object):
+	# Keeps the serial connection to the hub open for both loops
+	# A loop that hits an error calls fail() with the generation of the port it was using; the supervisor thread (loop)
+	# cancels any blocking read, closes that port and reopens it with exponential backoff, then hands the new port to
+	# onConnect. Loops block in waitForPort until it is back and compare generations to notice they need to resync.
+	# Reports about a port that was already replaced are ignored, so an incident seen by both loops costs one reconnect.
+	def __init__(self, openPort: Callable[[], object], onConnect: Optional[Callable[[object], None]] = None,
+			backoff=0.5, maxBackoff=30.0, checksumBurst=8, checksumWindow=2.0):
+		self.openPort = openPort
+		self.onConnect = onConnect
+		self.backoff = backoff
+		self.maxBackoff = maxBackoff
+		self.checksumBurst = checksumBurst
+		self.checksumWindow = checksumWindow
+		self.condition = threading.Condition()
+		self.port = None
+		self.generation = 0  # bumped every time a port is opened
+		self.failure: Optional[str] = None  # reason while the port is being reopened
+		self.failedAt = 0.0
+		self.checksumFailures: Deque[float] = deque()
+		self.stopped = False
+
+	@property
+	def isUp(self) -> bool:
+		return self.port is not None and self.failure is None
+
+	def connect(self) -> bool:
+		# first open, on failure the supervisor keeps trying once its loop runs
+		try:
+			port = self.openPort()
+		except Exception as e:
+			OPEN_FAILURES.inc()
+			log.error("cannot open the hub serial port: %s", e)
+			self.fail(OPEN_ERROR)
+			return False
+		self.connected(port)
+		return True
+
+	def connected(self, port):
+		if self.onConnect is not None:
+			self.onConnect(port)
+		with self.condition:
+			self.port = port
+			self.generation += 1
+			self.failure = None
+			self.checksumFailures.clear()
+			self.condition.notify_all()
+		LINK_UP.set(1)
+
+	def fail(self, reason: str, generation: Optional[int] = None):
+		with self.condition:
+			if self.failure is not None or (generation is not None and generation != self.generation):
+				return
+			self.failure = reason
+			self.failedAt = time.monotonic()
+			port = self.port
+			self.condition.notify_all()
+		LINK_UP.set(0)
+		REGISTRY.counter("twig_hub_link_incidents_total", INCIDENTS_HELP, {"reason": reason}).inc()
+		log.error("hub link failed (%s), reopening the port", reason)
+		if port is not None and hasattr(port, "cancel_read"):
+			try:
+				port.cancel_read()  # wakes the event loop out of its blocking read
+			except Exception:
+				pass
+
+	def noteChecksumFailure(self, generation: Optional[int] = None):
+		# a few corrupt frames happen, a burst of them means the framing is lost
+		now = time.monotonic()
+		with self.condition:
+			self.checksumFailures.append(now)
+			while self.checksumFailures and now - self.checksumFailures[0] > self.checksumWindow:
+				self.checksumFailures.popleft()
+			burst = len(self.checksumFailures) >= self.checksumBurst
+		if burst:
+			self.fail(CHECKSUM_BURST, generation)
+
+	def waitForPort(self, timeout: Optional[float] = None) -> Optional[int]:
+		# the generation of the open port, None if it is still being reopened after timeout or the link was stopped
+		with self.condition:
+			if not self.condition.wait_for(lambda: self.isUp or self.stopped, timeout) or not self.isUp:
+				return None
+			return self.generation
+
+	def reopen(self):
+		old = self.port
+		if old is not None:
+			try:
+				old.close()
+			except Exception as e:
+				log.debug("closing the failed port: %s", e)
+		delay = self.backoff
+		while not self.stopped:
+			try:
+				port = self.openPort()
+			except Exception as e:
+				OPEN_FAILURES.inc()
+				log.warning("cannot reopen the hub serial port, retrying in %.1fs: %s", delay, e)
+				with self.condition:
+					self.condition.wait(delay)
+				delay = min(delay * 2, self.maxBackoff)
+				continue
+			recovery = time.monotonic() - self.failedAt
+			self.connected(port)
+			RECONNECTS.inc()
+			RECOVERY.observe(recovery)
+			log.warning("hub link back after %.1fs", recovery)
+			return
+
+	def loop(self):
+		while not self.stopped:
+			with self.condition:
+				while not self.stopped and self.failure is None:
+					self.condition.wait()
+			if not self.stopped:
+				self.reopen()
+
+	def stop(self):
+		# the port stays open for the next loop(), close() releases it
+		with self.condition:
+			self.stopped = True
+			self.condition.notify_all()
+
+	def close(self):
+		self.stop()
+		with self.condition:
+			port, self.port = self.port, None
+		LINK_UP.set(0)
+		if port is not None:
+			port.close()
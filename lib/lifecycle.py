@@ -0,0 +1,130 @@
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from lib.logs import getLogger
+from lib.metrics import REGISTRY
+
+log = getLogger("lifecycle")
+
+STOPPED = "stopped"
+RUNNING = "running"
+
+STOP_SECONDS = REGISTRY.histogram("twig_service_stop_seconds", "Time taken to stop a service and join its threads")
+
+
+class ServiceError(Exception):
+	pass
+
+
+class Service(object):
+	# A subsystem that can be started and stopped any number of times
+	# start() starts its threads and returns them; stop() only asks them to finish and must not block, the Lifecycle
+	# joins them. Whatever is expensive to create (ports, sockets, loops) is created once and reused by the next
+	# start(); close() releases it for good when the process exits.
+	# The loops behind a service keep a stopped flag: their stop() sets it, and the service's start function clears it
+	# before starting the loop again.
+	def __init__(self, name: str, start: Callable[[], Iterable[threading.Thread]], stop: Callable[[], None],
+			close: Optional[Callable[[], None]] = None):
+		self.name = name
+		self.startThreads = start
+		self.stopThreads = stop
+		self.closeResources = close
+		self.lock = threading.Lock()  # one transition at a time per service, different services may overlap
+		self.state = STOPPED
+		self.threads: List[threading.Thread] = []
+		labels = {"service": name}
+		self.up = REGISTRY.gauge("twig_service_up", "1 while a service is running", labels)
+		self.restarts = REGISTRY.counter("twig_service_restarts_total", "Times a service was restarted", labels)
+		self.leaks = REGISTRY.counter("twig_service_leaked_threads_total", "Threads still alive when a service stop hit its deadline", labels)
+
+	def start(self):
+		with self.lock:
+			if self.state == RUNNING:
+				return
+			leftover = [thread.name for thread in self.threads if thread.is_alive()]
+			if leftover:
+				raise ServiceError(f"{self.name} cannot start, still running from its last stop: {', '.join(leftover)}")
+			self.threads = list(self.startThreads() or ())
+			self.state = RUNNING
+			self.up.set(1)
+		log.info("%s started, %d threads", self.name, len(self.threads))
+
+	def stop(self, deadline: float) -> bool:
+		# deadline is a time.monotonic() value; True if every thread finished by then
+		with self.lock:
+			if self.state == STOPPED:
+				return True
+			started = time.monotonic()
+			self.stopThreads()
+			for thread in self.threads:
+				if thread is not threading.current_thread():
+					thread.join(max(deadline - time.monotonic(), 0))
+			leaked = [thread.name for thread in self.threads if thread.is_alive() and thread is not threading.current_thread()]
+			self.state = STOPPED
+			self.up.set(0)
+			STOP_SECONDS.observe(time.monotonic() - started)
+		if leaked:
+			self.leaks.inc(len(leaked))
+			log.error("%s stopped, but threads did not finish in time: %s", self.name, ", ".join(leaked))
+		else:
+			log.info("%s stopped in %.3fs", self.name, time.monotonic() - started)
+		return not leaked
+
+
+class Lifecycle(object):
+	# Starts and stops the gateway's services by name
+	# Services start in the order they were added and stop in the reverse order; a stop waits at most deadline
+	# seconds in total for their threads, and reports rather than hangs if any are left.
+	def __init__(self, deadline=2.0):
+		self.deadline = deadline
+		self.services: Dict[str, Service] = {}
+
+	def add(self, name: str, start: Callable[[], Iterable[threading.Thread]], stop: Callable[[], None],
+			close: Optional[Callable[[], None]] = None) -> Service:
+		service = self.services[name] = Service(name, start, stop, close)
+		return service
+
+	def select(self, names: Iterable[str]) -> List[Service]:
+		names = list(names) or list(self.services)
+		unknown = [name for name in names if name not in self.services]
+		if unknown:
+			raise ServiceError(f"no service named {', '.join(unknown)}")
+		return [service for name, service in self.services.items() if name in names]
+
+	def state(self, name: str) -> str:
+		return self.services[name].state
+
+	def states(self) -> Dict[str, str]:
+		return {name: service.state for name, service in self.services.items()}
+
+	def start(self, *names: str):
+		# no names means every service
+		for service in self.select(names):
+			service.start()
+
+	def stop(self, *names: str, deadline: Optional[float] = None) -> bool:
+		until = time.monotonic() + (self.deadline if deadline is None else deadline)
+		stopped = True
+		for service in reversed(self.select(names)):
+			stopped = service.stop(until) and stopped
+		return stopped
+
+	def restart(self, *names: str, deadline: Optional[float] = None) -> bool:
+		services = self.select(names)
+		stopped = self.stop(*[service.name for service in services], deadline=deadline)
+		for service in services:
+			service.restarts.inc()
+		self.start(*[service.name for service in services])
+		return stopped
+
+	def close(self, deadline: Optional[float] = None) -> bool:
+		# stop everything, then release what the services kept for their next start
+		stopped = self.stop(deadline=deadline)
+		for service in reversed(list(self.services.values())):
+			if service.closeResources is not None:
+				try:
+					service.closeResources()
+				except Exception as e:
+					log.warning("closing %s: %s", service.name, e)
+		return stopped
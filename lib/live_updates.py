@@ -0,0 +1,254 @@
+import json
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+from lib.logs import getLogger
+
+log = getLogger("events")
+
+# A server-sent events channel for the web dashboards
+# publish(key, value) may be called from any thread; values under the same key are coalesced until the next frame,
+# and frames go out at most maxRate times a second. A frame is serialized once and the same bytes are queued to every
+# client, so dozens of open screens cost about the same as one. All clients are served by a single selector thread,
+# independent of the (bounded) web worker pool, which long-lived streams would otherwise tie up.
+# The dashboards are pages of the web server on the same host but another port, so a different origin: only a
+# page of that server (originPort, on the host the stream was asked of) gets the CORS header that lets it read.
+DEFAULT_PORT = 5001
+KEEPALIVE = 15.0  # seconds between comment lines on an idle stream, keeps proxies from timing it out
+MAX_REQUEST = 8192
+MAX_BACKLOG = 256 * 1024  # a client further behind than this is dropped, EventSource reconnects and gets a fresh snapshot
+RETRY_MS = 3000
+
+RESPONSE_HEADER = (
+	b"HTTP/1.1 200 OK\r\n"
+	b"Content-Type: text/event-stream\r\n"
+	b"Cache-Control: no-cache\r\n"
+	b"Connection: keep-alive\r\n"
+	b"X-Accel-Buffering: no\r\n"
+)
+NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+def _event(data: str, name: Optional[str] = None, sequence: Optional[int] = None) -> bytes:
+	lines = []
+	if sequence is not None:
+		lines.append(f"id: {sequence}")
+	if name is not None:
+		lines.append(f"event: {name}")
+	lines.append(f"data: {data}")
+	return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+class _Client(object):
+	__slots__ = ("sock", "request", "outbox", "streaming")
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.request = bytearray()
+		self.outbox = bytearray()
+		self.streaming = False
+
+
+class LiveUpdates(object):
+	# snapshot() returns the full state as a JSON-able dict, it is sent to each client as it connects
+	def __init__(self, snapshot: Callable[[], Dict], host="0.0.0.0", port=DEFAULT_PORT, maxRate=4.0, originPort: Optional[int] = None):
+		self.snapshot = snapshot
+		self.host = host
+		self.port = port  # both read by serveForever, may be changed while it is not running
+		self.originPort = originPort
+		self.interval = 1.0 / maxRate
+		self.lock = threading.Lock()
+		self.pending: Dict[str, object] = {}  # values may be callables, evaluated once when the frame is built
+		self.sequence = 0
+		self.selector = selectors.DefaultSelector()
+		self.clients: Dict[socket.socket, _Client] = {}
+		self.wakeReader, self.wakeWriter = socket.socketpair()
+		self.wakeReader.setblocking(False)
+		self.wakeWriter.setblocking(False)
+		self.stopped = False
+
+	def publish(self, key: str, value):
+		with self.lock:
+			wasIdle = not self.pending
+			self.pending[key] = value
+		if wasIdle:
+			self.wake()
+
+	def wake(self):
+		try:
+			self.wakeWriter.send(b"\x00")
+		except (BlockingIOError, OSError):
+			pass  # a wakeup is already pending, or we are shutting down
+
+	@property
+	def clientCount(self) -> int:
+		return sum(1 for client in self.clients.values() if client.streaming)
+
+	def serveForever(self):
+		listener = socket.create_server((self.host, self.port))
+		listener.setblocking(False)
+		self.selector.register(listener, selectors.EVENT_READ, self.accept)
+		self.selector.register(self.wakeReader, selectors.EVENT_READ, self.drainWake)
+		nextFrame = lastSent = time.monotonic()
+		try:
+			while not self.stopped:
+				now = time.monotonic()
+				if self.pending:
+					timeout = max(nextFrame - now, 0)
+				else:
+					timeout = max(lastSent + KEEPALIVE - now, 0)
+				for key, mask in self.selector.select(timeout):
+					key.data(key.fileobj, mask)
+				now = time.monotonic()
+				if self.pending and now >= nextFrame:
+					frame = self.buildFrame()
+					if frame is not None:
+						self.broadcast(frame)
+						lastSent = now
+					nextFrame = now + self.interval
+				elif now - lastSent >= KEEPALIVE:
+					self.broadcast(b": keepalive\n\n")
+					lastSent = now
+		finally:
+			for client in list(self.clients.values()):
+				self.close(client)
+			self.selector.unregister(listener)
+			self.selector.unregister(self.wakeReader)
+			listener.close()
+
+	def stop(self):
+		self.stopped = True
+		self.wake()
+
+	def buildFrame(self) -> Optional[bytes]:
+		# a key whose value fails is left out of the frame rather than taking the server down, None if nothing is left
+		with self.lock:
+			pending, self.pending = self.pending, {}
+		delta = {}
+		for key, value in pending.items():
+			try:
+				delta[key] = json.dumps(value() if callable(value) else value, separators=(",", ":"))
+			except Exception as e:
+				log.exception("live update %s failed: %s", key, e)
+		if not delta:
+			return None
+		self.sequence += 1
+		data = "{" + ",".join(f"{json.dumps(key)}:{value}" for key, value in delta.items()) + "}"
+		return _event(data, sequence=self.sequence)
+
+	def broadcast(self, frame: bytes):
+		for client in list(self.clients.values()):
+			if client.streaming:
+				self.send(client, frame)
+
+	def drainWake(self, sock, _):
+		try:
+			while sock.recv(4096):
+				pass
+		except BlockingIOError:
+			pass
+
+	def accept(self, listener, _):
+		try:
+			sock, _ = listener.accept()
+		except BlockingIOError:
+			return
+		sock.setblocking(False)
+		client = _Client(sock)
+		self.clients[sock] = client
+		self.selector.register(sock, selectors.EVENT_READ, self.readable)
+
+	def readable(self, sock, mask):
+		client = self.clients.get(sock)
+		if client is None:
+			return
+		if mask & selectors.EVENT_WRITE:
+			self.flush(client)
+			if sock not in self.clients:
+				return
+		if not mask & selectors.EVENT_READ:
+			return
+		try:
+			data = sock.recv(4096)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b""
+		if not data:
+			self.close(client)
+		elif not client.streaming:
+			client.request += data
+			if b"\r\n\r\n" in client.request:
+				self.startStream(client)
+			elif len(client.request) > MAX_REQUEST:
+				self.close(client)
+		# anything a streaming client sends is ignored, we only read to notice it going away
+
+	def startStream(self, client: _Client):
+		requestLine = bytes(client.request).split(b"\r\n", 1)[0].split()
+		if len(requestLine) < 2 or requestLine[0] != b"GET" or not requestLine[1].startswith(b"/stream"):
+			self.send(client, NOT_FOUND)
+			self.close(client)
+			return
+		header = RESPONSE_HEADER + self.corsHeader(bytes(client.request)) + b"\r\n"
+		client.request = bytearray()
+		try:
+			snapshot = json.dumps(self.snapshot(), separators=(",", ":"))
+		except Exception as e:
+			log.warning("live snapshot failed: %s", e)
+			snapshot = "{}"
+		client.streaming = True
+		self.send(client, header + f"retry: {RETRY_MS}\n".encode("ascii") + _event(snapshot, "snapshot", self.sequence))
+
+	def corsHeader(self, request: bytes) -> bytes:
+		# the Access-Control-Allow-Origin line for a dashboard page of the web server on this host, nothing otherwise
+		headers = {}
+		for line in request.split(b"\r\n")[1:]:
+			name, _, value = line.partition(b":")
+			headers[name.strip().lower()] = value.strip().decode("latin-1")
+		origin = headers.get(b"origin")
+		host = headers.get(b"host", "").rsplit(":", 1)[0]
+		if self.originPort is None or not origin or not host:
+			return b""
+		try:
+			parsed = urlsplit(origin)
+			port = parsed.port or {"http": 80, "https": 443}.get(parsed.scheme)
+		except ValueError:
+			return b""
+		if parsed.hostname != host.strip("[]").lower() or port != self.originPort:
+			return b""
+		return f"Access-Control-Allow-Origin: {origin}\r\nVary: Origin\r\n".encode("latin-1")
+
+	def send(self, client: _Client, data: bytes):
+		client.outbox += data
+		if len(client.outbox) > MAX_BACKLOG:
+			log.info("dropping a live client %d bytes behind", len(client.outbox))
+			self.close(client)
+			return
+		self.flush(client)
+
+	def flush(self, client: _Client):
+		try:
+			sent = client.sock.send(client.outbox)
+		except BlockingIOError:
+			sent = 0
+		except OSError:
+			self.close(client)
+			return
+		del client.outbox[:sent]
+		events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbox else 0)
+		if self.selector.get_key(client.sock).events != events:
+			self.selector.modify(client.sock, events, self.readable)
+
+	def close(self, client: _Client):
+		if self.clients.pop(client.sock, None) is None:
+			return
+		try:
+			self.selector.unregister(client.sock)
+		except (KeyError, ValueError):
+			pass
+		client.sock.close()
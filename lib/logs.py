@@ -0,0 +1,73 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Dict, Optional
+
+from lib.utils import HEX
+
+# loggers live under "twig.<subsystem>", each subsystem can be given its own level
+SUBSYSTEMS = ("wire", "events", "commands", "config", "lifecycle", "bacnet")
+ROOT_NAME = "twig"
+DEFAULT_LEVEL = "INFO"  # quiet enough for production, wire traffic is only logged at DEBUG
+ENVIRONMENT_KEY = "TWIG_LOG"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class LazyHex(object):
+	# defers the HEX() formatting of bits until a handler actually renders the record
+	# bits must not be mutated after logging, pass bytes rather than a reused bytearray
+	__slots__ = ("bits",)
+
+	def __init__(self, bits):
+		self.bits = bits
+
+	def __str__(self):
+		return HEX(self.bits)
+
+
+def getLogger(subsystem: str) -> logging.Logger:
+	return logging.getLogger(f"{ROOT_NAME}.{subsystem}")
+
+
+def parseLevels(spec: str) -> Dict[str, str]:
+	# "DEBUG" sets every subsystem, "INFO,wire=DEBUG,events=WARNING" sets a default plus overrides
+	levels = {}
+	for item in spec.split(","):
+		item = item.strip()
+		if not item:
+			continue
+		name, _, level = item.rpartition("=")
+		levels[name.strip() or ROOT_NAME] = level.strip().upper()
+	return levels
+
+
+def configureLogging(spec: Optional[str] = None, stream=None):
+	# records are formatted on the calling thread (only if their level is enabled) and written by a background listener
+	global _listener
+	if spec is None:
+		spec = os.environ.get(ENVIRONMENT_KEY, DEFAULT_LEVEL)
+	levels = parseLevels(spec)
+	badLevels = {name: level for name, level in levels.items() if not isinstance(logging.getLevelName(level), int)}
+	levels.update(dict.fromkeys(badLevels, DEFAULT_LEVEL))  # a typo must not keep the gateway from starting
+	root = logging.getLogger(ROOT_NAME)
+	root.setLevel(levels.pop(ROOT_NAME, DEFAULT_LEVEL))
+	for subsystem in SUBSYSTEMS:
+		getLogger(subsystem).setLevel(levels.pop(subsystem, logging.NOTSET))
+	if _listener is None:
+		records = queue.SimpleQueue()
+		output = logging.StreamHandler(stream or sys.stdout)
+		output.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+		_listener = logging.handlers.QueueListener(records, output)
+		_listener.start()
+		atexit.register(_listener.stop)
+		root.addHandler(logging.handlers.QueueHandler(records))
+		root.propagate = False  # keep the global basicConfig level/handlers out of the hot path
+	for unknown in levels:
+		root.warning("unknown log subsystem %s in %s, known: %s", unknown, ENVIRONMENT_KEY, ", ".join(SUBSYSTEMS))
+	for name, level in badLevels.items():
+		if name == ROOT_NAME or name in SUBSYSTEMS:
+			root.warning("unknown log level %s for %s in %s, using %s", level, name, ENVIRONMENT_KEY, DEFAULT_LEVEL)
@@ -0,0 +1,120 @@
+import bisect
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+# Minimal Prometheus style instrumentation for the gateway
+# Updates are plain attribute arithmetic under the GIL; an increment racing another on a different thread can be lost,
+# which is an acceptable error for monitoring and keeps the hot path free of locks
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labelText(labels: Dict[str, str], extra: str = "") -> str:
+	items = [f'{key}="{value}"' for key, value in labels.items()]
+	if extra:
+		items.append(extra)
+	return "{" + ",".join(items) + "}" if items else ""
+
+
+class Counter(object):
+	kind = "counter"
+	__slots__ = ("name", "help", "labels", "value")
+
+	def __init__(self, name, help, labels):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.value = 0
+
+	def inc(self, amount=1):
+		self.value += amount
+
+	def samples(self):
+		yield self.name, _labelText(self.labels), self.value
+
+
+class Gauge(Counter):
+	# either set() explicitly or given a function that is sampled at scrape time
+	kind = "gauge"
+	__slots__ = ("function",)
+
+	def __init__(self, name, help, labels):
+		super().__init__(name, help, labels)
+		self.function: Optional[Callable[[], float]] = None
+
+	def set(self, value):
+		self.value = value
+
+	def samples(self):
+		yield self.name, _labelText(self.labels), self.function() if self.function is not None else self.value
+
+
+class Histogram(object):
+	# fixed buckets, observe() only bumps preallocated slots
+	kind = "histogram"
+	__slots__ = ("name", "help", "labels", "buckets", "counts", "sum")
+
+	def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+
+	def samples(self):
+		cumulative = 0
+		for bound, count in zip(self.buckets, self.counts):
+			cumulative += count
+			yield f"{self.name}_bucket", _labelText(self.labels, f'le="{bound}"'), cumulative
+		cumulative += self.counts[-1]
+		yield f"{self.name}_bucket", _labelText(self.labels, 'le="+Inf"'), cumulative
+		yield f"{self.name}_sum", _labelText(self.labels), self.sum
+		yield f"{self.name}_count", _labelText(self.labels), cumulative
+
+
+class Registry(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.metrics: Dict[Tuple[str, Tuple], object] = {}
+
+	def _get(self, cls, name, help, labels, **kwargs):
+		labels = labels or {}
+		key = (name, tuple(sorted(labels.items())))
+		metric = self.metrics.get(key)
+		if metric is None:
+			with self.lock:
+				metric = self.metrics.get(key)
+				if metric is None:
+					metric = self.metrics[key] = cls(name, help, labels, **kwargs)
+		return metric
+
+	def counter(self, name, help, labels=None) -> Counter:
+		return self._get(Counter, name, help, labels)
+
+	def gauge(self, name, help, labels=None) -> Gauge:
+		return self._get(Gauge, name, help, labels)
+
+	def histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS) -> Histogram:
+		return self._get(Histogram, name, help, labels, buckets=buckets)
+
+	def render(self) -> str:
+		lines = []
+		described = set()
+		with self.lock:
+			metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+		for metric in metrics:
+			if metric.name not in described:
+				described.add(metric.name)
+				lines.append(f"# HELP {metric.name} {metric.help}")
+				lines.append(f"# TYPE {metric.name} {metric.kind}")
+			for name, labels, value in metric.samples():
+				lines.append(f"{name}{labels} {value}")
+		return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
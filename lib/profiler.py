@@ -0,0 +1,53 @@
+import collections
+import os
+import sys
+import threading
+import time
+from typing import Dict
+
+# A sampling profiler that needs nothing beyond the standard library
+# It periodically walks the stack of every other thread and counts identical stacks, producing the
+# "collapsed" format (frame;frame;frame count) understood by flamegraph.pl, speedscope and friends
+
+_busy = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+	pass
+
+
+def _frameLabel(code, labels: Dict[object, str]) -> str:
+	label = labels.get(code)
+	if label is None:
+		label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+	return label
+
+
+def sampleStacks(seconds: float, interval: float = 0.005) -> collections.Counter:
+	if not _busy.acquire(blocking=False):
+		raise ProfilerBusy("a profile is already running")
+	try:
+		me = threading.get_ident()
+		labels: Dict[object, str] = {}
+		counts = collections.Counter()
+		deadline = time.perf_counter() + seconds
+		while time.perf_counter() < deadline:
+			names = {thread.ident: thread.name for thread in threading.enumerate()}
+			for ident, frame in sys._current_frames().items():
+				if ident == me:
+					continue
+				stack = []
+				while frame is not None:
+					stack.append(_frameLabel(frame.f_code, labels))
+					frame = frame.f_back
+				stack.append(names.get(ident, str(ident)))
+				stack.reverse()
+				counts[";".join(stack)] += 1
+			time.sleep(interval)
+		return counts
+	finally:
+		_busy.release()
+
+
+def collapsedStacks(counts: collections.Counter) -> str:
+	return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
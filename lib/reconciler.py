@@ -0,0 +1,254 @@
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from lib import valve_positions
+from lib.central_control_types import OUTCOME_CANCELLED, OUTCOME_ERROR, SUCCESSFUL_OUTCOMES, UNSENT_OUTCOMES
+from lib.logs import getLogger
+from lib.metrics import REGISTRY
+from lib.tracing import STAGE_GATHER, Trace
+
+log = getLogger("commands")
+
+CORRECTIONS = REGISTRY.counter("twig_reconciler_corrections_total", "Valve puts re-issued because the reported positions did not match the desired ones")
+GAVE_UP = REGISTRY.counter("twig_reconciler_gave_up_total", "RTUs left out of sync after the maximum number of attempts")
+PENDING = REGISTRY.gauge("twig_reconciler_pending", "RTUs whose desired valve positions have not been confirmed yet")
+
+# desired values are kept as packed PositionCodes (see lib/valve_positions.py), the form the hub reports positions in
+# Valves and Vitals events, and turned into ValvesPut actions only as they are sent
+
+
+class _Target(object):
+	# mask covers the 2 bit fields that have a desired value, bits holds those values
+	# due is the monotonic time of the next attempt, None while queued, once confirmed (or given up)
+	__slots__ = ("mask", "bits", "attempts", "deferrals", "due", "queued", "changed", "confirmed", "gaveUpAt", "traces")
+
+	def __init__(self):
+		self.mask = 0
+		self.bits = 0
+		self.attempts = 0  # transactions that ran on the hub since the last change, limited by maxAttempts
+		self.deferrals = 0  # transactions in a row that never ran (UNSENT_OUTCOMES), these are not limited
+		self.due: Optional[float] = None
+		self.queued = False  # handed to queueBatch, its transaction has not completed yet
+		self.changed = False  # the desired bits changed while queued, they are sent once that transaction completes
+		self.confirmed = False  # a reported position has matched since the last change
+		self.gaveUpAt: Optional[float] = None  # monotonic time maxAttempts ran out
+		self.traces: List[Trace] = []  # the writes not yet sent, they travel with the next transaction
+
+
+class ValveReconciler(object):
+	# Drives the valves towards their desired positions instead of sending a command and forgetting it
+	# A desired change is sent right away (after a short gather window so a burst of writes shares one batch);
+	# the RTU then stays scheduled until a reported position matches, with exponential backoff between attempts.
+	# Only RTUs that differ are re-sent, all due corrections are handed over together as one valve operation.
+	# queueBatch(actions, traces=, onBatchDone=, **options) sends them (ValveScheduler.submit), actions maps oid to
+	# the packed bits for its ValvesPut, traces oid to the traces of the writes behind it, and onBatchDone({oid: outcome})
+	# is called as each transaction completes.
+	# The verification deadline only starts once an RTU's transaction has completed, however long the queue.
+	# A transaction that never ran on the hub (the breaker was open, the queue full, the loop stopped) is retried with
+	# its own backoff and is not charged against maxAttempts. An RTU given up on is started over when the hub recovers
+	# (noteHubRecovered), or when it still reports the wrong position maxBackoff after the give up.
+	# A change to an RTU whose transaction is out is held until that completes, so only one is in flight per RTU.
+	# Cancelling the operation drops the desired positions of the RTUs it had not sent yet, they are left as they are.
+	def __init__(self, queueBatch: Callable[..., object], gather=0.05, backoff=2.0, maxBackoff=300.0, maxAttempts=8):
+		self.queueBatch = queueBatch
+		self.gather = gather
+		self.backoff = backoff
+		self.maxBackoff = maxBackoff
+		self.maxAttempts = maxAttempts
+		self.condition = threading.Condition()
+		self.targets: Dict[int, _Target] = {}
+		self.stopped = False
+		PENDING.function = self.pendingCount
+
+	def pendingCount(self) -> int:
+		return sum(1 for target in self.targets.values() if target.due is not None or target.queued)
+
+	def desired(self, oid: int) -> Optional[Tuple[int, int]]:
+		# (mask, bits) for an RTU, None if nothing was ever asked of it
+		target = self.targets.get(oid)
+		return None if target is None else (target.mask, target.bits)
+
+	def isDriving(self, oid: int, mask: int, bits: int) -> bool:
+		# True while the fields under mask are being sent or retried towards values other than bits, so positions of
+		# bits reported there are about to be overtaken
+		with self.condition:
+			target = self.targets.get(oid)
+			if target is None or target.confirmed or (not target.queued and target.due is None):
+				return False
+			mask &= target.mask
+			return (target.bits & mask) != (bits & mask)
+
+	def setDesired(self, oid: int, valveNumber: int, code: int, trace: Optional[Trace] = None):
+		mask, bits = valve_positions.encode(oid, valveNumber, code)
+		with self.condition:
+			target = self.updateTarget(oid, mask, bits, trace)
+			if not target.queued:
+				target.due = time.monotonic()
+				self.condition.notify()
+
+	def setDesiredMany(self, changes: Iterable[Tuple[int, int, int]], trace: Optional[Trace] = None, **options):
+		# (oid, valveNumber, code) changes sent straight away as their own operation, options go to queueBatch; an RTU
+		# already queued is left out of it and sent as soon as its transaction completes
+		# every change is checked before any is applied, valve_positions.encode raises ValueError for a valve the RTU lacks
+		encoded = [(oid,) + valve_positions.encode(oid, valveNumber, code) for oid, valveNumber, code in changes]
+		with self.condition:
+			actions: Dict[int, int] = {}
+			for oid, mask, bits in encoded:
+				target = self.updateTarget(oid, mask, bits, trace)
+				if not target.queued:
+					actions[oid] = valve_positions.putBits(oid, target.bits)
+			traces = {oid: self.markQueued(oid, self.targets[oid]) for oid in actions}
+		try:
+			return self.queueBatch(actions, traces=traces, onBatchDone=self.noteBatchDone, **options)
+		except Exception:
+			self.noteBatchDone({oid: OUTCOME_ERROR for oid in actions})
+			raise
+
+	def updateTarget(self, oid: int, mask: int, bits: int, trace: Optional[Trace]) -> _Target:
+		# called with the condition held
+		target = self.targets.get(oid)
+		if target is None:
+			target = self.targets[oid] = _Target()
+		target.mask |= mask
+		target.bits = (target.bits & ~mask) | bits
+		target.confirmed = False
+		if target.queued:
+			target.changed = True  # the attempts of the transaction that is out are settled first, see noteBatchDone
+		else:
+			target.attempts = target.deferrals = 0
+			target.gaveUpAt = None
+		if trace is not None and trace not in target.traces:
+			target.traces.append(trace)
+		return target
+
+	def markQueued(self, oid: int, target: _Target) -> List[Trace]:
+		# called with the condition held, returns the traces that go with this attempt
+		if target.attempts:
+			CORRECTIONS.inc()
+		target.attempts += 1
+		target.due = None
+		target.queued = True
+		traces, target.traces = target.traces, []
+		for trace in traces:
+			trace.mark(STAGE_GATHER)
+		return traces
+
+	def noteReported(self, oid: int, positions: int):
+		with self.condition:
+			target = self.targets.get(oid)
+			if target is None:
+				return
+			if positions & target.mask == target.bits:
+				if not target.confirmed:
+					log.debug("reconciled oid=%d after %d attempts", oid, target.attempts)
+				target.confirmed = True
+				target.due = None  # attempts are kept until the next setDesired, so a failing transaction can't retry forever
+			else:
+				wasConfirmed, target.confirmed = target.confirmed, False
+				if target.queued or target.due is not None:
+					return
+				now = time.monotonic()
+				if wasConfirmed and target.attempts < self.maxAttempts:
+					# confirmed earlier but has drifted since, e.g. moved by hand or an RTU that restarted
+					log.info("oid=%d reports %04X, desired %04X, correcting", oid, positions & target.mask, target.bits)
+					target.due = now
+					self.condition.notify()
+				elif target.gaveUpAt is not None and now - target.gaveUpAt >= self.maxBackoff:
+					log.info("oid=%d still reports %04X, desired %04X, starting over", oid, positions & target.mask, target.bits)
+					self.restart(target, now)
+					self.condition.notify()
+
+	def noteHubRecovered(self):
+		# the serial link was reopened or the hub answers again: whatever waited out the outage, or was given up on
+		# during it, is sent again now with a fresh set of attempts
+		with self.condition:
+			now = time.monotonic()
+			for target in self.targets.values():
+				if not target.confirmed and not target.queued and (target.deferrals or target.gaveUpAt is not None):
+					self.restart(target, now)
+			self.condition.notify()
+
+	def restart(self, target: _Target, now: float):
+		# called with the condition held
+		target.attempts = target.deferrals = 0
+		target.gaveUpAt = None
+		target.due = now
+
+	def noteBatchDone(self, outcomes: Dict[int, str]):
+		# a transaction completed; failed RTUs are retried after the backoff, the others are given until the deadline
+		# to report their position. The Valves echo of a put may have confirmed an RTU whose commit then failed.
+		with self.condition:
+			now = time.monotonic()
+			for oid, outcome in outcomes.items():
+				target = self.targets.get(oid)
+				if target is None or not target.queued:
+					continue
+				if outcome == OUTCOME_CANCELLED and not target.changed:
+					del self.targets[oid]
+					continue
+				target.queued = False
+				if target.changed:
+					# whatever became of it, the transaction carried old bits: the new ones go next, with fresh attempts
+					target.changed = False
+					target.attempts = target.deferrals = 0
+					target.gaveUpAt = None
+					if not target.confirmed:
+						target.due = now
+					continue
+				if outcome in UNSENT_OUTCOMES:
+					target.attempts -= 1  # it never got to the RTU
+					target.deferrals += 1
+					if not target.confirmed:
+						target.due = now + self.delay(target.deferrals - 1)
+					continue
+				target.deferrals = 0
+				if outcome not in SUCCESSFUL_OUTCOMES:
+					target.confirmed = False
+				if not target.confirmed:
+					target.due = now + self.delay(target.attempts - 1)
+			self.condition.notify()
+
+	def delay(self, attempts: int) -> float:
+		return min(self.maxBackoff, self.backoff * 2 ** max(attempts, 0))
+
+	def nextBatch(self) -> Tuple[Dict[int, int], Dict[int, List[Trace]]]:
+		# called with the condition held, marks everything it returns as queued
+		now = time.monotonic()
+		due = sorted(oid for oid, target in self.targets.items() if target.due is not None and target.due <= now)
+		actions: Dict[int, int] = {}
+		traces: Dict[int, List[Trace]] = {}
+		for oid in due:
+			target = self.targets[oid]
+			if target.attempts >= self.maxAttempts:
+				GAVE_UP.inc()
+				log.warning("giving up on oid=%d after %d attempts, desired %04X", oid, target.attempts, target.bits)
+				target.due = None
+				target.gaveUpAt = now
+				continue
+			traces[oid] = self.markQueued(oid, target)
+			actions[oid] = valve_positions.putBits(oid, target.bits)
+		return actions, traces
+
+	def loop(self):
+		while not self.stopped:
+			with self.condition:
+				now = time.monotonic()
+				nextDue = min((target.due for target in self.targets.values() if target.due is not None), default=None)
+				if nextDue is None or nextDue > now:
+					self.condition.wait(None if nextDue is None else nextDue - now)
+					continue
+			time.sleep(self.gather)  # let the rest of a burst of writes join this batch
+			with self.condition:
+				actions, traces = self.nextBatch()
+			if actions:
+				try:
+					self.queueBatch(actions, traces=traces, onBatchDone=self.noteBatchDone, label="reconcile")
+				except Exception as e:
+					log.error("cannot queue valve batch: %s", e)
+					self.noteBatchDone({oid: OUTCOME_ERROR for oid in actions})
+
+	def stop(self):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify()
@@ -0,0 +1,122 @@
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+from lib.metrics import REGISTRY
+
+STAGE_SECONDS_HELP = "Time a BACnet valve write spent in each stage between the request and the hub's answer to its commit"
+
+# The stages of a BACnet valve write, in order. A stage marks the trace as it hands the write on, so each span runs
+# from the previous mark (or the request arriving) to its own:
+STAGE_BACNET = "bacnet"  # bacpypes decoding the request, until WriteProperty runs
+STAGE_HANDLER = "handler"  # WriteProperty and on_value_change, until the desired position is set
+STAGE_GATHER = "gather"  # the reconciler's gather window, until it hands the change to the scheduler
+STAGE_SCHEDULE = "schedule"  # pacing in the scheduler, until its transaction is queued
+STAGE_QUEUE = "queue"  # waiting in the command queue, until the transaction's first command is sent
+STAGE_HUB = "hub"  # the transaction on the wire, retries included, until its commit has been answered
+STAGES = (STAGE_BACNET, STAGE_HANDLER, STAGE_GATHER, STAGE_SCHEDULE, STAGE_QUEUE, STAGE_HUB)
+TOTAL = "total"
+
+PERCENTILES = (50, 90, 99)
+
+
+class Trace(object):
+	# One BACnet write on its way to the valves
+	# Travels with the write through the reconciler, the scheduler and the queued commands of its transaction. A write
+	# merged with others is marked once per stage, by whichever of them gets there first.
+	__slots__ = ("id", "label", "startedAt", "marks", "retries", "outcome", "finishedAt")
+
+	def __init__(self, id: int, label: str, startedAt: float):
+		self.id = id
+		self.label = label
+		self.startedAt = startedAt  # perf_counter
+		self.marks: List[Tuple[str, float]] = []
+		self.retries = 0  # resends of the transaction's commands
+		self.outcome: Optional[str] = None
+		self.finishedAt: Optional[float] = None  # time.time(), for display
+
+	def mark(self, stage: str):
+		if not any(name == stage for name, _ in self.marks):
+			self.marks.append((stage, time.perf_counter()))
+
+	def spans(self) -> List[Tuple[str, float]]:
+		spans = []
+		previous = self.startedAt
+		for stage, at in self.marks:
+			spans.append((stage, at - previous))
+			previous = at
+		return spans
+
+	@property
+	def duration(self) -> float:
+		return self.marks[-1][1] - self.startedAt if self.marks else 0.0
+
+	def asDict(self) -> Dict:
+		return {
+			"id": self.id,
+			"label": self.label,
+			"outcome": self.outcome,
+			"retries": self.retries,
+			"finished_at": self.finishedAt,
+			"total": self.duration,
+			"spans": dict(self.spans()),
+		}
+
+
+class Tracer(object):
+	# Hands out traces and keeps the last capacity finished ones in memory for the web UI
+	# Each span is also observed in twig_trace_stage_seconds{stage}, which keeps the long run distribution.
+	def __init__(self, capacity=2048):
+		self.ids = itertools.count(1)
+		self.lock = threading.Lock()
+		self.finished: Deque[Trace] = deque(maxlen=capacity)
+		self.histograms = {stage: REGISTRY.histogram("twig_trace_stage_seconds", STAGE_SECONDS_HELP, {"stage": stage})
+			for stage in STAGES + (TOTAL,)}
+
+	def begin(self, label: str, startedAt: Optional[float] = None) -> Trace:
+		return Trace(next(self.ids), label, time.perf_counter() if startedAt is None else startedAt)
+
+	def finish(self, trace: Trace, outcome: str):
+		# the first finish counts, a write split over several transactions finishes with the first of them
+		with self.lock:
+			if trace.outcome is not None:
+				return
+			trace.mark(STAGE_HUB)
+			trace.outcome = outcome
+			trace.finishedAt = time.time()
+			self.finished.append(trace)
+		for stage, seconds in trace.spans():
+			self.histograms[stage].observe(seconds)
+		self.histograms[TOTAL].observe(trace.duration)
+
+	def recent(self, limit=50) -> List[Dict]:
+		# newest first, none for a limit of 0 or less
+		with self.lock:
+			traces = list(self.finished)
+		traces = traces[-limit:] if limit > 0 else []
+		return [trace.asDict() for trace in reversed(traces)]
+
+	def summary(self) -> Dict[str, Dict]:
+		# {stage: {"count", "p50", "p90", "p99", "max"}} over the buffered traces, stages in pipeline order
+		with self.lock:
+			traces = list(self.finished)
+		samples: Dict[str, List[float]] = {stage: [] for stage in STAGES + (TOTAL,)}
+		for trace in traces:
+			for stage, seconds in trace.spans():
+				samples[stage].append(seconds)
+			samples[TOTAL].append(trace.duration)
+		return {stage: percentiles(values) for stage, values in samples.items()}
+
+
+def percentiles(values: Iterable[float]) -> Dict:
+	# nearest rank, None for an empty sample
+	ordered = sorted(values)
+	summary = {"count": len(ordered), "max": ordered[-1] if ordered else None}
+	for percentile in PERCENTILES:
+		summary[f"p{percentile}"] = ordered[max(-(-len(ordered) * percentile // 100) - 1, 0)] if ordered else None
+	return summary
+
+
+TRACER = Tracer()
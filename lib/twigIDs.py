@@ -1,18 +1,40 @@
+import functools
+from array import array
+from typing import Iterable, Tuple
+
+# upper bound on the number of distinct ids kept alive by TwigID.int, least recently used are evicted first
+INTERN_LIMIT = 65536
+
+
 class TwigID(object):
+	# instances are interned by TwigID.int, so treat them as immutable
+	# derived fields are computed on first access and cached in their slot
+	__slots__ = ("value", "_valveCount", "_rtuString", "_valveString")
+
 	def __init__(self, value: int):
 		self.value: int = value
+		self._valveCount = None
+		self._rtuString = None
+		self._valveString = None
 
 	@classmethod
 	def int(cls, value):
-		if value < 10:
-			return TwigIDLocalValve(value)
-		elif value < 0x0100_0000:
-			return TwigIDLoRa(value)
-		else:
-			return TwigIDSiFlex(value)
+		return _internTwigID(value)
+
+	def __repr__(self):
+		return f"{type(self).__name__}({self.value})"
+
+	@property
+	def typeCode(self) -> int:
+		return 0
 
 	@property
 	def valveCount(self) -> int:
+		if self._valveCount is None:
+			self._valveCount = self._computeValveCount()
+		return self._valveCount
+
+	def _computeValveCount(self) -> int:
 		raise NotImplementedError
 
 	@property
@@ -25,11 +47,21 @@ class TwigID(object):
 
 	@property
 	def rtuString(self) -> str:
+		if self._rtuString is None:
+			self._rtuString = self._computeRtuString()
+		return self._rtuString
+
+	def _computeRtuString(self) -> str:
 		# noinspection PyTypeChecker
 		return NotImplementedError
 
 	@property
 	def valveString(self) -> str:
+		if self._valveString is None:
+			self._valveString = self._computeValveString()
+		return self._valveString
+
+	def _computeValveString(self) -> str:
 		# noinspection PyTypeChecker
 		return NotImplementedError
 
@@ -68,20 +100,22 @@ class TwigID(object):
 
 
 class TwigIDSiFlex(TwigID):
+	__slots__ = ()
+
 	@property
-	def valveCount(self) -> int:
-		typeCode: int = (self.value & 0x0F000000) >> 24
+	def typeCode(self) -> int:
+		return (self.value & 0x0F000000) >> 24
+
+	def _computeValveCount(self) -> int:
 		try:
-			return (1, 2, 4, 4)[typeCode - 0xA]  # A, B, C, D
+			return (1, 2, 4, 4)[self.typeCode - 0xA]  # A, B, C, D
 		except IndexError:
 			return 0
 
-	@property
-	def rtuString(self) -> str:
+	def _computeRtuString(self) -> str:
 		return "{:X}".format(self.value)[:-1]
 
-	@property
-	def valveString(self) -> str:
+	def _computeValveString(self) -> str:
 		return "{:X}".format(self.value)
 
 	@property
@@ -94,12 +128,13 @@ class TwigIDSiFlex(TwigID):
 
 
 class TwigIDLoRa(TwigID):
+	__slots__ = ()
+
 	@property
 	def typeCode(self) -> int:
 		return self.value // 1_000_000
 
-	@property
-	def valveCount(self) -> int:
+	def _computeValveCount(self) -> int:
 		try:
 			return (0, 1, 2, 0, 0, 1, 2, 0, 0, 0)[self.typeCode]
 		except IndexError:
@@ -113,12 +148,10 @@ class TwigIDLoRa(TwigID):
 	def hasVerification(self) -> bool:
 		return self.typeCode in (5, 6)
 
-	@property
-	def rtuString(self) -> str:
+	def _computeRtuString(self) -> str:
 		return "{}-{:05d}".format(self.typeCode, (self.value % 1_000_000) // 10)
 
-	@property
-	def valveString(self) -> str:
+	def _computeValveString(self) -> str:
 		return f"{self.rtuString}-{self.valveIndex}"
 
 	@property
@@ -131,16 +164,15 @@ class TwigIDLoRa(TwigID):
 
 
 class TwigIDLocalValve(TwigID):
-	@property
-	def valveCount(self) -> int:
+	__slots__ = ()
+
+	def _computeValveCount(self) -> int:
 		return 2
 
-	@property
-	def rtuString(self) -> str:
+	def _computeRtuString(self) -> str:
 		return "MC"
 
-	@property
-	def valveString(self) -> str:
+	def _computeValveString(self) -> str:
 		return f"MC.{self.value}"
 
 	@property
@@ -154,3 +186,42 @@ class TwigIDLocalValve(TwigID):
 	@property
 	def nameToken(self) -> str:
 		return "L"
+
+
+def _classForValue(value: int) -> type:
+	if value < 10:
+		return TwigIDLocalValve
+	elif value < 0x0100_0000:
+		return TwigIDLoRa
+	else:
+		return TwigIDSiFlex
+
+
+@functools.lru_cache(maxsize=INTERN_LIMIT)
+def _internTwigID(value: int) -> TwigID:
+	return _classForValue(value)(value)
+
+
+# per type code lookup tables for classify(), derived from the classes so the two can never disagree
+# LoRa ids are below 0x0100_0000, so their type code (value // 1_000_000) never exceeds 16
+_LORA_VALVE_COUNTS = bytes(TwigIDLoRa(typeCode * 1_000_000).valveCount for typeCode in range(17))
+_SIFLEX_VALVE_COUNTS = bytes(TwigIDSiFlex(0x1000_0000 | typeCode << 24).valveCount for typeCode in range(16))
+_LOCAL_VALVE_COUNT = TwigIDLocalValve(0).valveCount
+
+
+def classify(values: Iterable[int]) -> Tuple[array, array]:
+	# map many oids to (typeCodes, valveCounts) in one pass without building a TwigID for each
+	typeCodes = array("B")
+	valveCounts = array("B")
+	for value in values:
+		if value < 10:
+			typeCode, valveCount = 0, _LOCAL_VALVE_COUNT
+		elif value < 0x0100_0000:
+			typeCode = value // 1_000_000
+			valveCount = _LORA_VALVE_COUNTS[typeCode]
+		else:
+			typeCode = (value & 0x0F00_0000) >> 24
+			valveCount = _SIFLEX_VALVE_COUNTS[typeCode]
+		typeCodes.append(typeCode)
+		valveCounts.append(valveCount)
+	return typeCodes, valveCounts
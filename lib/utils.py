@@ -1,2 +1,32 @@
+import os
+import tempfile
+
+
 def HEX(bits: bytes) -> str:
 	return ":".join("{:02X}".format(byte) for byte in bits)
+
+
+def atomicWrite(path, data: bytes):
+	# write beside path, fsync, then rename over it, so a crash leaves either the old or the new file and never a truncated one
+	directory = os.path.dirname(os.path.abspath(path))
+	descriptor, temporaryPath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+	try:
+		with os.fdopen(descriptor, "wb") as file:
+			file.write(data)
+			file.flush()
+			os.fsync(file.fileno())
+		if os.path.exists(path):
+			os.chmod(temporaryPath, os.stat(path).st_mode & 0o777)
+		os.replace(temporaryPath, path)
+	except BaseException:
+		if os.path.exists(temporaryPath):
+			os.unlink(temporaryPath)
+		raise
+	try:  # persist the rename itself
+		directoryDescriptor = os.open(directory, os.O_RDONLY)
+		try:
+			os.fsync(directoryDescriptor)
+		finally:
+			os.close(directoryDescriptor)
+	except OSError:
+		pass
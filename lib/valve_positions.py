@@ -0,0 +1,107 @@
+import enum
+import functools
+from typing import Dict, Iterable, Optional, Tuple
+
+from lib.position_codes import PositionCode
+from lib.twigIDs import INTERN_LIMIT, TwigID
+
+# Packed valve fields: 2 bits per valve, valve 1 in the low bits, in two forms that share the layout
+# Valves and Vitals events report a PositionCode per valve. A ValvesPut byte (so at most 4 valves) carries a
+# ValveAction per valve instead: the ON/OFF flags of control_valve, where 0b01 switches a valve on and 0b10 off,
+# the opposite of what those bits mean as a PositionCode. Desired positions are kept as PositionCodes, so they
+# compare directly with reports, and are turned into actions by putBits as they are sent.
+# A zero field in a put leaves that valve alone, so changes to several valves of one RTU share a put
+FIELD_BITS = 2
+FIELD_MASK = 0b11
+PUT_VALVES = 4
+
+
+@enum.unique
+class ValveAction(enum.IntEnum):
+	# what a ValvesPut field asks of its valve
+	Keep = 0
+	On = 0b01
+	Off = 0b10
+
+
+CODE_ACTIONS = {PositionCode.On: ValveAction.On, PositionCode.Off: ValveAction.Off}  # Unknown and Illegal are kept
+ACTION_CODES = {action: code for code, action in CODE_ACTIONS.items()}
+
+# BACnet presentValue -> position: active is an open valve, switched on, inactive a closed one
+PRESENT_VALUE_CODES = {1: PositionCode.On, 0: PositionCode.Off}
+CODE_PRESENT_VALUES = {code: value for value, code in PRESENT_VALUE_CODES.items()}  # Unknown and Illegal have none
+CODE_STATUSES = {PositionCode.Unknown: "Unknown", PositionCode.Off: "Closed", PositionCode.On: "Open", PositionCode.Illegal: "Illegal"}
+
+
+class RtuLayout(object):
+	# where each valve of one RTU lives in the packed positions, computed once per oid
+	__slots__ = ("valveCount", "shifts", "masks", "mask")
+
+	def __init__(self, valveCount: int):
+		self.valveCount = valveCount
+		self.shifts = tuple(FIELD_BITS * offset for offset in range(valveCount))
+		self.masks = tuple(FIELD_MASK << shift for shift in self.shifts)
+		self.mask = sum(self.masks)  # every field of this RTU
+
+
+@functools.lru_cache(maxsize=INTERN_LIMIT)
+def layout(oid: int) -> RtuLayout:
+	return RtuLayout(min(TwigID.int(oid).valveCount, PUT_VALVES))
+
+
+def field(oid: int, valveNumber: int) -> Tuple[int, int]:
+	# (shift, mask) of one valve, valves are numbered from 1
+	rtu = layout(oid)
+	if not 1 <= valveNumber <= rtu.valveCount:
+		raise ValueError(f"oid {oid} has {rtu.valveCount} valves, no valve {valveNumber}")
+	return rtu.shifts[valveNumber - 1], rtu.masks[valveNumber - 1]
+
+
+def encode(oid: int, valveNumber: int, code: int) -> Tuple[int, int]:
+	# (mask, bits) that set one valve to the PositionCode code
+	shift, mask = field(oid, valveNumber)
+	return mask, (code << shift) & mask
+
+
+def merge(changes: Iterable[Tuple[int, int, int]]) -> Dict[int, int]:
+	# (oid, valveNumber, code) changes -> {oid: packed PositionCodes}, one per RTU; the last change to a valve wins
+	packed: Dict[int, int] = {}
+	for oid, valveNumber, code in changes:
+		mask, bits = encode(oid, valveNumber, code)
+		packed[oid] = (packed.get(oid, 0) & ~mask) | bits
+	return packed
+
+
+def decode(oid: int, positions: int) -> Tuple[PositionCode, ...]:
+	# packed positions from a Valves or Vitals event -> one PositionCode per valve of the RTU
+	rtu = layout(oid)
+	return tuple(PositionCode((positions >> shift) & FIELD_MASK) for shift in rtu.shifts)
+
+
+def putBits(oid: int, positions: int) -> int:
+	# packed PositionCodes -> the packed ValveActions of the ValvesPut that drives the valves there
+	bits = 0
+	for shift in layout(oid).shifts:
+		bits |= CODE_ACTIONS.get((positions >> shift) & FIELD_MASK, ValveAction.Keep) << shift
+	return bits
+
+
+def applyPut(oid: int, positions: int, bits: int) -> int:
+	# the packed PositionCodes an RTU reports once it has carried out a ValvesPut of bits
+	for shift, mask in zip(layout(oid).shifts, layout(oid).masks):
+		code = ACTION_CODES.get((bits >> shift) & FIELD_MASK)
+		if code is not None:
+			positions = (positions & ~mask) | (code << shift)
+	return positions
+
+
+def codeForPresentValue(value: int) -> PositionCode:
+	return PRESENT_VALUE_CODES[1 if value == 1 else 0]
+
+
+def presentValueForCode(code: int) -> Optional[int]:
+	return CODE_PRESENT_VALUES.get(code)
+
+
+def statusForCode(code: int) -> str:
+	return CODE_STATUSES[PositionCode(code)]
@@ -0,0 +1,224 @@
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Sequence
+
+from lib.central_control_types import OUTCOME_CANCELLED, OUTCOME_ERROR, SUCCESSFUL_OUTCOMES
+from lib.logs import getLogger
+from lib.metrics import REGISTRY
+from lib.tracing import STAGE_SCHEDULE, TRACER, Trace
+
+log = getLogger("commands")
+
+BATCHES_QUEUED = REGISTRY.counter("twig_valve_batches_total", "Valve transactions (Begin, Put..., Commit) handed to the command loop")
+BATCHES_IN_FLIGHT = REGISTRY.gauge("twig_valve_batches_in_flight", "Valve transactions queued or on the wire, not yet committed")
+OPERATIONS_PENDING = REGISTRY.gauge("twig_valve_operations_pending", "Valve operations with batches still to send")
+
+DEFAULTS = {
+	"batch_size": 16,  # ValvesPut commands per transaction
+	"batches_per_second": 4.0,  # across all operations
+	"concurrency": 1,  # transactions allowed in the command queue at once
+}
+
+# queueBatch(actions, traces, onDone) queues one transaction for {oid: packed bits} on behalf of the traced writes,
+# onDone({oid: outcome}) is called on the command thread once its commit has been handled
+QueueBatch = Callable[[Dict[int, int], Sequence[Trace], Callable[[Dict[int, str]], None]], None]
+
+
+class ValveOperation(object):
+	# A set of valve changes sent as one or more hub-sized transactions
+	# progress() is safe to call from any thread
+	__slots__ = (
+		"id", "label", "batches", "stagger", "traces", "onBatchDone",
+		"total", "succeeded", "failed", "batchesTotal", "batchesSent", "batchesDone", "nextBatchAt", "createdAt", "finishedAt", "cancelled",
+	)
+
+	def __init__(self, id: int, label: str, batches: List[Dict[int, int]], stagger: float, traces, onBatchDone):
+		self.id = id
+		self.label = label
+		self.batches: Deque[Dict[int, int]] = deque(batches)
+		self.stagger = stagger  # minimum seconds between this operation's transactions, limits inrush
+		self.traces: Dict[int, List[Trace]] = traces  # by oid, each goes with the batch that carries its oid
+		self.onBatchDone = onBatchDone
+		self.total = sum(len(batch) for batch in batches)
+		self.succeeded = 0
+		self.failed = 0
+		self.batchesTotal = len(batches)
+		self.batchesSent = 0
+		self.batchesDone = 0
+		self.nextBatchAt = 0.0
+		self.createdAt = time.time()
+		self.finishedAt: Optional[float] = None
+		self.cancelled = False
+
+	@property
+	def isFinished(self) -> bool:
+		return self.finishedAt is not None
+
+	@property
+	def isSettled(self) -> bool:
+		# nothing left to send and every transaction sent has completed
+		return not self.batches and self.batchesDone == self.batchesSent
+
+	def progress(self) -> Dict:
+		return {
+			"id": self.id,
+			"label": self.label,
+			"state": "cancelled" if self.cancelled else "done" if self.isFinished else "running",
+			"total": self.total,
+			"succeeded": self.succeeded,
+			"failed": self.failed,
+			"batches_total": self.batchesTotal,
+			"batches_done": self.batchesDone,
+			"created_at": self.createdAt,
+			"finished_at": self.finishedAt,
+		}
+
+
+class ValveScheduler(object):
+	# Paces valve transactions so bulk changes have a predictable duration and command queue depth
+	# Operations are split into batchSize puts per transaction; transactions start at most batchesPerSecond
+	# and at most concurrency are outstanding at once. Operations take turns, so a small correction is not
+	# stuck behind a whole floor. onProgress(operation) is called as batches complete, on the command thread.
+	def __init__(self, queueBatch: QueueBatch, batchSize=16, batchesPerSecond=4.0, concurrency=1,
+			onProgress: Optional[Callable[[ValveOperation], None]] = None, history=32):
+		self.queueBatch = queueBatch
+		self.onProgress = onProgress
+		self.configure(batchSize, batchesPerSecond, concurrency)
+		self.condition = threading.Condition()
+		self.pending: Deque[ValveOperation] = deque()  # operations with batches left to send, in turn order
+		self.finished: Deque[ValveOperation] = deque(maxlen=history)
+		self.byID: Dict[int, ValveOperation] = {}
+		self.ids = itertools.count(1)
+		self.inFlight = 0
+		self.nextStartAt = 0.0
+		self.stopped = False
+		BATCHES_IN_FLIGHT.function = lambda: self.inFlight
+		OPERATIONS_PENDING.function = lambda: len(self.pending)
+
+	def configure(self, batchSize, batchesPerSecond, concurrency):
+		self.batchSize = max(int(batchSize), 1)
+		self.interval = 1.0 / batchesPerSecond if batchesPerSecond > 0 else 0.0
+		self.concurrency = max(int(concurrency), 1)
+
+	def submit(self, actions: Dict[int, int], label="", stagger=0.0, traces: Optional[Dict[int, List[Trace]]] = None,
+			onBatchDone: Optional[Callable[[Dict[int, str]], None]] = None, batchSize: Optional[int] = None) -> ValveOperation:
+		# batchSize overrides the configured transaction size for this operation, e.g. a valve group sent as one
+		oids = list(actions)
+		batchSize = max(batchSize or self.batchSize, 1)
+		batches = [{oid: actions[oid] for oid in oids[start:start + batchSize]} for start in range(0, len(oids), batchSize)]
+		with self.condition:
+			operation = ValveOperation(next(self.ids), label, batches, max(stagger, 0.0), dict(traces or {}), onBatchDone)
+			self.byID[operation.id] = operation
+			if batches:
+				self.pending.append(operation)
+				self.condition.notify()
+			else:
+				self.finish(operation)
+		log.debug("valve operation %d %s: %d valves in %d batches", operation.id, label, operation.total, operation.batchesTotal)
+		return operation
+
+	def cancel(self, id: int) -> Optional[ValveOperation]:
+		# batches already queued on the hub still complete, the rest are dropped with OUTCOME_CANCELLED, and so are the
+		# writes traced through them
+		dropped: Dict[int, str] = {}
+		traces: List[Trace] = []
+		with self.condition:
+			operation = self.byID.get(id)
+			if operation is None or operation.isFinished:
+				return operation
+			operation.cancelled = True
+			for batch in operation.batches:
+				dropped.update((oid, OUTCOME_CANCELLED) for oid in batch)
+				traces.extend(trace for oid in batch for trace in operation.traces.pop(oid, ()))
+			operation.batches.clear()
+			if operation in self.pending:
+				self.pending.remove(operation)
+			operation.failed += len(dropped)
+			if operation.isSettled:
+				self.finish(operation)
+		for trace in dict.fromkeys(traces):
+			TRACER.finish(trace, OUTCOME_CANCELLED)
+		if dropped and operation.onBatchDone is not None:
+			operation.onBatchDone(dropped)
+		if self.onProgress is not None:
+			self.onProgress(operation)
+		return operation
+
+	def operation(self, id: int) -> Optional[ValveOperation]:
+		return self.byID.get(id)
+
+	def operations(self) -> List[ValveOperation]:
+		with self.condition:
+			return sorted(self.byID.values(), key=lambda operation: operation.id)
+
+	def finish(self, operation: ValveOperation):
+		# called with the condition held
+		operation.finishedAt = time.time()
+		if len(self.finished) == self.finished.maxlen:
+			self.byID.pop(self.finished[0].id, None)
+		self.finished.append(operation)
+
+	def batchDone(self, operation: ValveOperation, outcomes: Dict[int, str]):
+		succeeded = sum(1 for outcome in outcomes.values() if outcome in SUCCESSFUL_OUTCOMES)
+		with self.condition:
+			self.inFlight -= 1
+			operation.batchesDone += 1
+			operation.succeeded += succeeded
+			operation.failed += len(outcomes) - succeeded
+			if operation.isSettled and not operation.isFinished:
+				self.finish(operation)
+			self.condition.notify()
+		if operation.onBatchDone is not None:
+			operation.onBatchDone(outcomes)
+		if self.onProgress is not None:
+			self.onProgress(operation)
+		if operation.isFinished:
+			log.info("valve operation %d %s done: %d ok, %d failed", operation.id, operation.label, operation.succeeded, operation.failed)
+
+	def nextReady(self, now: float) -> Optional[ValveOperation]:
+		# called with the condition held, the first operation in turn order whose stagger allows a batch now
+		for operation in self.pending:
+			if operation.nextBatchAt <= now:
+				return operation
+		return None
+
+	def loop(self):
+		while not self.stopped:
+			with self.condition:
+				now = time.monotonic()
+				operation = None
+				wait = None
+				if self.inFlight < self.concurrency and self.pending:
+					if now < self.nextStartAt:
+						wait = self.nextStartAt - now
+					else:
+						operation = self.nextReady(now)
+						if operation is None:
+							wait = min(pending.nextBatchAt for pending in self.pending) - now
+				if operation is None:
+					self.condition.wait(wait)
+					continue
+				batch = operation.batches.popleft()
+				self.pending.remove(operation)
+				if operation.batches:
+					self.pending.append(operation)  # take turns with the other operations
+				operation.nextBatchAt = now + operation.stagger
+				self.nextStartAt = now + self.interval
+				self.inFlight += 1
+				operation.batchesSent += 1
+				traces = list(dict.fromkeys(trace for oid in batch for trace in operation.traces.pop(oid, ())))
+			BATCHES_QUEUED.inc()
+			for trace in traces:
+				trace.mark(STAGE_SCHEDULE)
+			try:
+				self.queueBatch(batch, traces, lambda outcomes, operation=operation: self.batchDone(operation, outcomes))
+			except Exception as e:
+				log.error("cannot queue valve batch for operation %d: %s", operation.id, e)
+				self.batchDone(operation, {oid: OUTCOME_ERROR for oid in batch})
+
+	def stop(self):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+"""
+Load test: simulates BMS clients writing, reading (ReadPropertyMultiple) and subscribing to COV on the
+gateway's binary value points over localhost BACnet/IP, and reports throughput, latency percentiles and
+error counts per operation.
+
+By default it starts its own gateway, talking to a hub emulator (hub_emulator.py), in a scratch directory;
+--target sends the load to a gateway that is already running instead. Every client is open loop: requests
+go out at the configured rates whether or not the earlier ones were answered.
+
+usage: load_test.py [--clients 4] [--duration 30] [--write-rate 2] [--read-rate 5] [--subscribe-rate 0.2]
+                    [--max-p99-ms 250] [--max-error-rate 0.01] [--json]
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter
+
+from bacpypes.apdu import (
+    PropertyReference, ReadAccessSpecification, ReadPropertyMultipleACK, ReadPropertyMultipleRequest,
+    SimpleAckPDU, SubscribeCOVRequest, WritePropertyRequest,
+)
+from bacpypes.app import BIPSimpleApplication
+from bacpypes.constructeddata import Any
+from bacpypes.core import run, stop
+from bacpypes.iocb import IOCB
+from bacpypes.local.device import LocalDeviceObject
+from bacpypes.pdu import Address
+from bacpypes.primitivedata import Enumerated
+from bacpypes.task import FunctionTask
+
+from lib.tracing import percentiles
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+OPERATIONS = ("write", "rpm", "subscribe")
+COV = "cov"  # a notification for a written value, its latency runs from the write being sent
+
+GATEWAY_INI = """[BACpypes]
+objectName: LoadTestGateway
+address: 127.0.0.1:{port}
+objectIdentifier: 599
+maxApduLengthAccepted: 1024
+segmentationSupported: segmentedBoth
+vendorIdentifier: 15
+"""
+
+
+class Stats(object):
+    """Latencies and outcomes of every request, shared by all the clients (they run on the bacpypes core thread)."""
+
+    def __init__(self):
+        self.sent = Counter()
+        self.skipped = Counter()
+        self.latencies = {operation: [] for operation in OPERATIONS + (COV,)}
+        self.errors = Counter()  # (operation, reason)
+        self.values = {}  # point -> value last written
+        self.subscribed = set()  # points some client has a COV subscription for
+        self.written = {}  # subscribed point -> (value, perf_counter the write was sent), for COV latency
+
+    def record(self, operation, started, iocb):
+        """Note how a request ended; True if it succeeded."""
+        if iocb.ioError is not None:
+            self.errors[operation, error_name(iocb.ioError)] += 1
+            return False
+        self.latencies[operation].append(time.perf_counter() - started)
+        if isinstance(iocb.ioResponse, ReadPropertyMultipleACK):
+            for result in iocb.ioResponse.listOfReadAccessResults:
+                for element in result.listOfResults:
+                    if element.readResult.propertyAccessError is not None:
+                        self.errors[operation, str(element.readResult.propertyAccessError.errorCode)] += 1
+        return True
+
+    def note_notification(self, apdu):
+        point = apdu.monitoredObjectIdentifier[1]
+        written = self.written.get(point)
+        if written is None:
+            return
+        for element in apdu.listOfValues:
+            if element.propertyIdentifier == "presentValue" and element.value.cast_out(Enumerated) == written[0]:
+                self.latencies[COV].append(time.perf_counter() - written[1])
+                del self.written[point]  # only the first notification of a write counts
+                return
+
+    def summary(self, duration):
+        report = {}
+        for operation in OPERATIONS + (COV,):
+            errors = sum(count for (errored, _), count in self.errors.items() if errored == operation)
+            report[operation] = dict(
+                percentiles(self.latencies[operation]),
+                sent=self.sent[operation], skipped=self.skipped[operation], errors=errors,
+                rate=len(self.latencies[operation]) / duration,
+            )
+        report["errors"] = {f"{operation} {reason}": count for (operation, reason), count in sorted(self.errors.items())}
+        return report
+
+
+def error_name(error):
+    """A short name for what an IOCB failed with: a BACnet error code, reject or abort reason, or timeout."""
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    for attribute in ("errorCode", "rejectReason", "abortReason"):
+        value = getattr(error, attribute, None)
+        if value is not None:
+            return str(value)
+    return type(error).__name__
+
+
+class LoadClient(BIPSimpleApplication):
+    """One simulated BMS with its own device object and UDP port, noting the COV notifications it receives."""
+
+    def __init__(self, index, address, target, points, args, stats):
+        device = LocalDeviceObject(
+            objectName=f"load-client-{index}", objectIdentifier=("device", 600000 + index),
+            maxApduLengthAccepted=1024, segmentationSupported="segmentedBoth", vendorIdentifier=15,
+        )
+        BIPSimpleApplication.__init__(self, device, address)
+        self.index = index
+        self.target = target
+        self.points = points
+        self.args = args
+        self.stats = stats
+        self.outstanding = Counter()
+
+    def do_UnconfirmedCOVNotificationRequest(self, apdu):
+        self.stats.note_notification(apdu)
+
+    def do_ConfirmedCOVNotificationRequest(self, apdu):
+        self.stats.note_notification(apdu)
+        self.response(SimpleAckPDU(context=apdu))
+
+    def issue(self, operation, request, on_success=None):
+        """Send one request, unless this client already has max_outstanding of that kind unanswered."""
+        if self.outstanding[operation] >= self.args.max_outstanding:
+            self.stats.skipped[operation] += 1
+            return
+        request.pduDestination = self.target
+        iocb = IOCB(request)
+        iocb.set_timeout(self.args.timeout, err=TimeoutError())
+        started = time.perf_counter()
+
+        def done(iocb):
+            self.outstanding[operation] -= 1
+            if self.stats.record(operation, started, iocb) and on_success is not None:
+                on_success()
+
+        iocb.add_callback(done)
+        self.outstanding[operation] += 1
+        self.stats.sent[operation] += 1
+        self.request_io(iocb)
+
+    def write(self):
+        """Flip one point, so every write changes the value and goes all the way to the hub."""
+        point = random.choice(self.points)
+        value = self.stats.values[point] = 0 if self.stats.values.get(point) else 1
+        request = WritePropertyRequest(objectIdentifier=("binaryValue", point), propertyIdentifier="presentValue")
+        request.propertyValue = Any()
+        request.propertyValue.cast_in(Enumerated(value))
+        if point in self.stats.subscribed:
+            self.stats.written[point] = (value, time.perf_counter())
+        self.issue("write", request)
+
+    def rpm(self):
+        """presentValue and statusFlags of up to rpm_points points, as a BMS polls them."""
+        points = random.sample(self.points, min(self.args.rpm_points, len(self.points)))
+        request = ReadPropertyMultipleRequest(listOfReadAccessSpecs=[
+            ReadAccessSpecification(
+                objectIdentifier=("binaryValue", point),
+                listOfPropertyReferences=[PropertyReference(propertyIdentifier="presentValue"),
+                                          PropertyReference(propertyIdentifier="statusFlags")],
+            ) for point in points
+        ])
+        self.issue("rpm", request)
+
+    def subscribe(self):
+        point = random.choice(self.points)
+        request = SubscribeCOVRequest(
+            subscriberProcessIdentifier=self.index + 1, monitoredObjectIdentifier=("binaryValue", point),
+            issueConfirmedNotifications=False, lifetime=self.args.lifetime,
+        )
+        self.issue("subscribe", request, lambda: self.stats.subscribed.add(point))
+
+
+def pace(action, rate, until):
+    """Call action rate times a second from the bacpypes core until the time.time() value until."""
+    if rate <= 0:
+        return
+    interval = 1.0 / rate
+
+    def tick(when):
+        if when >= until:
+            return
+        action()
+        FunctionTask(tick, when + interval).install_task(when=when + interval)
+
+    start = time.time() + random.uniform(0, interval)  # spread the clients out
+    FunctionTask(tick, start).install_task(when=start)
+
+
+def start_gateway(args, workdir):
+    """Start a hub emulator and a gateway using it in workdir; returns their processes once the valves are known."""
+    emulator = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "hub_emulator.py"), "--rtus", str(args.rtus), "--delay", str(args.hub_delay)],
+        cwd=HERE, stdout=subprocess.PIPE, stderr=open(os.path.join(workdir, "emulator.log"), "w"), text=True,
+    )
+    port_path = emulator.stdout.readline().strip()
+    points = args.rtus * 2
+    with open(os.path.join(workdir, "config.json"), "w") as config:
+        json.dump({"num_valves": points, "object_to_ids_mapping": {f"{50 + i}": i for i in range(1, points + 1)}}, config)
+    ini = os.path.join(workdir, "bacnet.ini")
+    with open(ini, "w") as file:
+        file.write(GATEWAY_INI.format(port=args.gateway_port))
+    environment = dict(os.environ, TWIG_PORT=port_path, TWIG_SNAPSHOT=os.path.join(workdir, "registry.snapshot"))
+    gateway = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "pi_serverv2.py"), "--ini", ini] + args.gateway_args,
+        cwd=workdir, env=environment, stdout=open(os.path.join(workdir, "gateway.log"), "w"), stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if gateway.poll() is not None:
+            break
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{args.web_port}/api/v1/valves", timeout=1) as response:
+                items = json.load(response)["items"]
+            if len(items) == points and all(item["twig_id"] for item in items):
+                return emulator, gateway
+        except (OSError, ValueError, KeyError):
+            pass
+        time.sleep(0.2)
+    stop_processes(emulator, gateway)
+    raise RuntimeError(f"the gateway did not discover the emulated valves, see {os.path.join(workdir, 'gateway.log')}")
+
+
+def stop_processes(*processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_load(args, target, points):
+    """Run the clients on the bacpypes core for args.duration seconds, then wait out the answers still due."""
+    stats = Stats()
+    clients = [
+        LoadClient(index, f"127.0.0.1:{args.client_port + index}", target, points, args, stats)
+        for index in range(args.clients)
+    ]
+    until = time.time() + args.duration
+    for client in clients:
+        pace(client.subscribe, args.subscribe_rate, until)
+        pace(client.write, args.write_rate, until)
+        pace(client.rpm, args.read_rate, until)
+    FunctionTask(stop).install_task(when=until + args.timeout)
+    run(sigterm=None, sigusr1=None)
+    for client in clients:
+        client.close_socket()
+    return stats
+
+
+def report(args, summary):
+    print(f"{args.clients} clients for {args.duration:.0f}s, latencies in ms")
+    print(f"{'operation':<10} {'sent':>7} {'ok/s':>8} {'errors':>7} {'skipped':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for operation in OPERATIONS + (COV,):
+        row = summary[operation]
+        times = " ".join(f"{'-' if row[key] is None else format(row[key] * 1000, '.1f'):>8}" for key in ("p50", "p90", "p99", "max"))
+        print(f"{operation:<10} {row['sent']:>7} {row['rate']:>8.1f} {row['errors']:>7} {row['skipped']:>8} {times}")
+    for name, count in summary["errors"].items():
+        print(f"  {name}: {count}")
+
+
+def check(args, summary):
+    """The thresholds that were exceeded, empty if the run passes."""
+    failures = []
+    if args.max_p99_ms is not None:
+        for operation in ("write", "rpm"):
+            p99 = summary[operation]["p99"]
+            if p99 is not None and p99 * 1000 > args.max_p99_ms:
+                failures.append(f"{operation} p99 {p99 * 1000:.1f} ms > {args.max_p99_ms} ms")
+    if args.max_error_rate is not None:
+        sent = sum(summary[operation]["sent"] for operation in OPERATIONS)
+        errors = sum(summary[operation]["errors"] for operation in OPERATIONS)
+        if sent and errors / sent > args.max_error_rate:
+            failures.append(f"error rate {errors / sent:.3f} > {args.max_error_rate}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load test the gateway's BACnet side")
+    parser.add_argument("--clients", type=int, default=4, help="simulated BMS clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load")
+    parser.add_argument("--write-rate", type=float, default=2.0, help="WriteProperty requests per client per second")
+    parser.add_argument("--read-rate", type=float, default=5.0, help="ReadPropertyMultiple requests per client per second")
+    parser.add_argument("--subscribe-rate", type=float, default=0.2, help="SubscribeCOV requests per client per second")
+    parser.add_argument("--rpm-points", type=int, default=8, help="points read by each ReadPropertyMultiple")
+    parser.add_argument("--lifetime", type=int, default=60, help="COV subscription lifetime in seconds")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds before an unanswered request counts as an error")
+    parser.add_argument("--max-outstanding", type=int, default=32, help="unanswered requests of a kind a client allows")
+    parser.add_argument("--client-port", type=int, default=47900, help="UDP port of the first client, the others follow")
+    parser.add_argument("--target", default=None, help="address of a running gateway, e.g. 127.0.0.1:47808")
+    parser.add_argument("--points", type=int, default=None, help="binary value points to use on --target, from 1")
+    parser.add_argument("--rtus", type=int, default=8, help="2 valve RTUs behind the emulated hub")
+    parser.add_argument("--hub-delay", type=float, default=0.005, help="seconds the emulated hub takes per command")
+    parser.add_argument("--gateway-port", type=int, default=47808, help="UDP port of the gateway started here")
+    parser.add_argument("--web-port", type=int, default=5000, help="web port of the gateway started here")
+    parser.add_argument("--startup-timeout", type=float, default=30.0, help="seconds to wait for the gateway to be ready")
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="fail if write or rpm p99 latency exceeds this")
+    parser.add_argument("--max-error-rate", type=float, default=None, help="fail if this fraction of requests errors")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("gateway_args", nargs=argparse.REMAINDER, help="arguments passed on to the gateway after --")
+    args = parser.parse_args()
+    args.gateway_args = [arg for arg in args.gateway_args if arg != "--"]
+
+    if args.target:
+        summary = run_load(args, Address(args.target), list(range(1, (args.points or 2) + 1))).summary(args.duration)
+    else:
+        with tempfile.TemporaryDirectory(prefix="twig-load-") as workdir:
+            emulator, gateway = start_gateway(args, workdir)
+            try:
+                points = list(range(1, args.rtus * 2 + 1))
+                summary = run_load(args, Address(f"127.0.0.1:{args.gateway_port}"), points).summary(args.duration)
+            finally:
+                stop_processes(gateway, emulator)
+
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        report(args, summary)
+    failures = check(args, summary)
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,10 @@ triggers the notifications.
 """
 
 import time
+startup_started = time.perf_counter()  # the module imports below are the first startup phase
+# bacpypes and Flask stay module level imports: the BACnet object classes subclass bacpypes and the routes are
+# registered on the Flask app as this module loads. Modules only a request or an option needs (waitress, the
+# profiler) are imported where they are used.
 from threading import Thread,Event,Lock
 from bacpypes.service.device import WhoIsIAmServices
 from bacpypes.apdu import WhoIsRequest, IAmRequest
@@ -15,7 +19,7 @@ from bacpypes.consolelogging import ConfigArgumentParser
 from bacpypes.consolecmd import ConsoleCmd
 from bacpypes.pdu import Address
 
-from bacpypes.core import run, deferred, enable_sleeping
+from bacpypes.core import run, deferred, enable_sleeping, stop as stop_bacnet_core
 from bacpypes.task import RecurringTask
 import logging
 
@@ -29,53 +33,77 @@ from bacpypes.object import (
 )    
 from bacpypes.local.device import LocalDeviceObject
 from bacpypes.service.cov import ChangeOfValueServices
-logging.basicConfig(level=logging.DEBUG)
+from bacpypes.service.object import ReadWritePropertyMultipleServices
 from bacpypes.primitivedata import Enumerated
+from bacpypes.errors import ExecutionError
 
 from hubLoop import *
-from flask import Flask, render_template, request, redirect, url_for, flash,jsonify
-
+from lib.twigIDs import TwigID, classify
+from lib import valve_positions
+from flask import Flask, render_template, request, redirect, url_for, flash,jsonify, g, Response
+from lib.metrics import REGISTRY
+from lib.config_store import ConfigStore
+from lib.live_updates import LiveUpdates, DEFAULT_PORT as LIVE_PORT
+from lib.reconciler import ValveReconciler
+from lib.valve_scheduler import ValveScheduler, DEFAULTS as SCHEDULER_DEFAULTS
+from lib.event_bus import COALESCE
+from lib.lifecycle import Lifecycle, RUNNING, STOPPED
+from lib.tracing import TRACER, STAGE_BACNET, STAGE_HANDLER
+from lib.core_handoff import CoreHandoff
+
+import csv
+import io
+from functools import partial
 import json
 import os
 
+import atexit
 import signal
 import sys
 
 def signal_handler(sig, frame):
-    """Handle termination signals and perform cleanup."""
-    global test_application
-
+    """Handle termination signals, main() wakes up and shuts everything down."""
     print("\nTermination signal received. Cleaning up...")
-    
-    # Stop the BACnet application
-    if test_application:
-        test_application.close_socket()
-        test_application = None
-
-    # Set the stop_event to terminate threads
     stop_event.set()
 
-    # Exit the application
-    sys.exit(0)
+def shutdown():
+    """Stop every service, release the serial port and the BACnet socket, and save what is pending."""
+    lifecycle.close()
+
+    # Write out any configuration change still waiting for the store's timer
+    config_store.flush()
+
+    # Checkpoint the device registry for the next warm start
+    try:
+        get_event_loop().writeCheckpoint()
+    except RuntimeError:
+        pass
 
 # Global BACnet variables
 test_application = None
 num_valves = 0  # Global variable to store the number of valves
 
 CONFIG_FILE = "config.json"  # File to store the configuration
-
-communication_log = []  # Stores logs of communication
-log_lock = Lock()  # Lock to handle thread-safe updates
+config_store = ConfigStore(CONFIG_FILE)  # In-memory configuration, written behind atomically
+atexit.register(config_store.flush)
 
 # test globals
 test_av = None
 test_bv = None
 
 object_to_ids_mapping = {}  # Maps objectName to ids_list index
+bacnet_objects = {}  # objectName -> the BACnet binary value object, filled in by main()
 
-stop_event = Event()
+stop_event = Event()  # set once the process is shutting down
+lifecycle = Lifecycle()  # the hub, web and bacnet services, added by main()
+
+# Instrumentation
+BACNET_WRITE_TO_WIRE = REGISTRY.histogram("twig_bacnet_write_to_wire_seconds", "Time from a BACnet valve write to its ValvesCommit going on the wire")
 
 # TWIG data
+valves_version = 0  # bumped whenever a valve status changes outside refresh_valves
+valves_lock = Lock()  # one refresh_valves rebuild at a time
+valves_built_from = None  # (RTUs, table) of the last rebuild
 twig_gateway = None
 valves = {
     1: {"status": "Closed","twig_id":0,"valve_number":0},
@@ -88,56 +116,204 @@ valves = {
 
 def load_config():
     """Load configuration from a file."""
-    global num_valves, object_to_ids_mapping
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, "r") as f:
-            config = json.load(f)
-            num_valves = config.get("num_valves", 0)
-            object_to_ids_mapping = config.get("object_to_ids_mapping", {})
-    else:
-        num_valves = 0  # Default value if the file doesn't exist
-        object_to_ids_mapping = {}
+    global num_valves, object_to_ids_mapping, web_port
+    config_store.load()
+    num_valves = config_store.get("num_valves", 0)
+    object_to_ids_mapping = config_store.get("object_to_ids_mapping", {})
+    web_port = config_store.get("web_port", WEB_PORT)
+    live_updates.port = config_store.get("live_port", LIVE_PORT)
+    live_updates.originPort = web_port  # the dashboards' origin, the only one allowed to read the stream
+    scheduler_settings = dict(SCHEDULER_DEFAULTS, **config_store.get("valve_scheduler", {}))
+    valve_scheduler.configure(scheduler_settings["batch_size"], scheduler_settings["batches_per_second"], scheduler_settings["concurrency"])
 
 def save_config():
-    """Save the current configuration to a file."""
+    """Hand the current configuration to the store, which writes it to disk shortly after."""
     global num_valves, object_to_ids_mapping
-    with open(CONFIG_FILE, "w") as f:
-        json.dump({
-            "num_valves": num_valves,
-            "object_to_ids_mapping": object_to_ids_mapping
-        }, f)
+    config_store.update(num_valves=num_valves, object_to_ids_mapping=object_to_ids_mapping)
+
+############################################## Valve table #########################################################
+
+def refresh_valves():
+    """Rebuild the valve table from the discovered RTUs, one entry per valve, keeping known statuses.
+
+    RTUs are numbered in oid order and contribute TwigID.valveCount entries each, so a valve keeps
+    its index (and therefore its BACnet mapping) across restarts as long as the set of RTUs is unchanged.
+    The table is only replaced when that set has changed, so a status written into it is not lost to a
+    rebuild running on another thread.
+    """
+    global valves, valves_built_from
+    ids_list = tuple(sorted(get_event_loop().unique_ids))
+    if not ids_list:
+        return valves
+    with valves_lock:
+        if valves_built_from is not None and valves_built_from[0] == ids_list and valves_built_from[1] is valves:
+            return valves
+        known = {(details.get("twig_id"), details.get("valve_number")): details["status"] for details in valves.values()}
+        _, valve_counts = classify(list(ids_list))
+        table = {}
+        for oid, valve_count in zip(ids_list, valve_counts):
+            for valve_number in range(1, valve_count + 1):
+                table[len(table) + 1] = {
+                    "status": known.get((oid, valve_number), "Closed"),
+                    "twig_id": oid,
+                    "valve_number": valve_number,
+                }
+        valves = table
+        valves_built_from = (ids_list, table)
+    return table
+
+def bacnet_object_names():
+    """Names of the BACnet binary value objects created by main()."""
+    return [f"{50 + i}" for i in range(1, num_valves + 1)]
+
+def parse_mapping_table(text, fmt):
+    """Parse an uploaded mapping table into a list of (object_name, valve_index) pairs.
+
+    CSV rows are object_name,valve_index with an optional header row, further columns are ignored.
+    JSON is either {"object_name": valve_index, ...} or a list of {"object_name": ..., "valve_index": ...}.
+    """
+    if fmt == "json":
+        document = json.loads(text)
+        if isinstance(document, dict):
+            return list(document.items())
+        return [(row["object_name"], row["valve_index"]) for row in document]
+    rows = [row for row in csv.reader(io.StringIO(text)) if row and any(cell.strip() for cell in row)]
+    if rows and rows[0][0].strip().lower() == "object_name":
+        rows = rows[1:]
+    return [(row[0], row[1] if len(row) > 1 else "") for row in rows]
+
+def validate_mapping_table(pairs):
+    """Check every pair against the BACnet objects and the valves of the discovered RTUs.
+
+    Returns (mapping, errors); index 0 means unmapped.
+    """
+    objects = set(bacnet_object_names())
+    table = refresh_valves() if get_event_loop().unique_ids else {}
+    mapping, errors = {}, []
+    for line, (object_name, valve_index) in enumerate(pairs, 1):
+        object_name = str(object_name).strip()
+        try:
+            valve_index = int(str(valve_index).strip())
+        except ValueError:
+            errors.append(f"row {line}: valve index {valve_index!r} is not a number")
+            continue
+        if object_name not in objects:
+            errors.append(f"row {line}: no BACnet object named {object_name!r}")
+        elif valve_index != 0 and valve_index not in table:
+            errors.append(f"row {line}: valve index {valve_index} is not one of the {len(table)} discovered valves")
+        elif object_name in mapping:
+            errors.append(f"row {line}: object {object_name} is listed twice")
+        else:
+            mapping[object_name] = valve_index
+    return mapping, errors
+
+############################################## Valve groups #########################################################
+
+GROUP_INSTANCE_BASE = 1000  # binaryValue instance numbers of the group objects start above this, clear of the valve points
+
+def valve_groups():
+    """{group name: [valve index, ...]} from the configuration."""
+    return config_store.get("valve_groups", {})
+
+def apply_valve_group(name, value, trace=None):
+    """Drive every member of a valve group to value (1 open, 0 closed) as a single valve transaction.
+
+    Members on the same RTU are merged into one ValvesPut. The BACnet points mapped to the members are
+    updated to match without going through their own on_value_change. Returns the valve operation, or
+    None when no member is among the discovered valves. trace is the BACnet write's, if it came from one.
+    """
+    table = refresh_valves()
+    members = {index for index in valve_groups().get(name, []) if index in table}
+    changes = []
+    for index in sorted(members):
+        details = table[index]
+        details["status"] = "Open" if value == 1 else "Closed"
+        changes.append((details["twig_id"], details["valve_number"], valve_positions.codeForPresentValue(value)))
+    if not changes:
+        return None
+    mark_valves_changed()
+    for object_name, valve_index in object_to_ids_mapping.items():
+        if valve_index in members and object_name in bacnet_objects:
+            bacnet_objects[object_name].presentValue = BinaryPV(value)  # a direct property write, not WriteProperty
+    if trace is not None:
+        trace.mark(STAGE_HANDLER)
+    return valve_reconciler.setDesiredMany(changes, trace=trace, label=f"group {name}", batchSize=len(changes))
+
+def mark_valves_changed(index=None):
+    """Invalidate anything cached from the valve table (JSON API responses, ETags) and push the change to live dashboards.
+
+    With an index only that valve is sent, otherwise the whole table (built when the next frame goes out).
+    """
+    global valves_version
+    valves_version += 1
+    if index is not None and index in valves:
+        live_updates.publish(f"valves/{index}", dict(valves[index]))
+    else:
+        live_updates.publish("valves", lambda: valves)
 
 ############################################## Web interface #########################################################
 # Flask app setup
 app = Flask(__name__)
 app.secret_key = "super_secret_key"
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_time(response):
+    """Record the handling time of every request, per endpoint."""
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        REGISTRY.histogram("twig_http_request_seconds", "Flask request handling time",
+                           {"endpoint": request.endpoint or "unknown"}).observe(time.perf_counter() - started)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Expose gateway counters and histograms in the Prometheus text format."""
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/')
 def index():
     """Dashboard displaying valve status and controls."""
     global valves
     global object_to_ids_mapping
-    event_object = get_event_loop()
-    ids_list = list(event_object.unique_ids)
-    i = 1
-    for index , items in enumerate(ids_list):
-        valves[index+i]['twig_id'] = items
-        valves[index+i]["valve_number"] = 1
-        valves[index+i+1]['twig_id'] = items
-        valves[index+i+1]["valve_number"] = 2
+    refresh_valves()
     return render_template('index.html', 
                            object_to_ids_mapping=object_to_ids_mapping, 
-                           valves=valves)
+                           valves=valves,
+                           services=lifecycle.states())
 @app.route('/debug')
 def debug():
     """Display communication logs."""
     event_object = get_event_loop()
-    log_list = (event_object.communication_log)
-    return render_template('debug.html', logs=log_list)
+    log_list = event_object.getCommunicationLog()
+    return render_template('debug.html', logs=log_list, live_port=live_updates.port)
+@app.route('/debug/traces')
+def debug_traces():
+    """Latency of recent BACnet valve writes, per pipeline stage."""
+    return render_template('traces.html', summary=TRACER.summary(), traces=TRACER.recent())
+@app.route('/debug/profile')
+def debug_profile():
+    """Sample every thread's stack for a few seconds and return a flamegraph-ready collapsed stack file."""
+    from lib import profiler
+    try:
+        seconds = min(max(float(request.args.get('seconds', 10)), 1), 120)
+        interval = min(max(float(request.args.get('interval_ms', 5)), 1), 1000) / 1000
+    except ValueError as e:
+        return Response(f"Error: {e}\n", status=400, mimetype="text/plain")
+    try:
+        counts = profiler.sampleStacks(seconds, interval)
+    except profiler.ProfilerBusy as e:
+        return Response(f"{e}\n", status=409, mimetype="text/plain")
+    return Response(profiler.collapsedStacks(counts), mimetype="text/plain",
+                    headers={"Content-Disposition": "attachment; filename=gateway.collapsed"})
 @app.route('/get_logs')
 def get_logs():
     """Return the communication logs as JSON."""
     event_object = get_event_loop()
-    log_list = (event_object.communication_log)
+    log_list = event_object.getCommunicationLog()
     return jsonify(log_list)
 @app.route('/configure', methods=['POST'])
 def configure():
@@ -148,23 +324,32 @@ def configure():
         save_config()
         # twig_gateway = request.form['gateway']
         valves = {i: {"status": "Unknown"} for i in range(1, num_valves + 1)}
+        mark_valves_changed()
         flash(f"Configured {num_valves} valves with gateway {twig_gateway}.", "success")
     except Exception as e:
         flash(f"Error: {e}", "danger")
     return redirect(url_for('index'))
 
+CONTROLLED_SERVICES = ("hub", "bacnet")  # the web service is not stopped from one of its own requests
+
+def requested_services():
+    """The services named by the form's "service" field: hub, bacnet, or both when it is absent or "all"."""
+    name = request.form.get("service", "all")
+    if name == "all":
+        return CONTROLLED_SERVICES
+    if name not in CONTROLLED_SERVICES:
+        raise ValueError(f"unknown service {name!r}")
+    return (name,)
+
 @app.route('/start-service', methods=['POST'])
 def start_service():
     """Start BACnet/TWIG services."""
-    global stop_event
-    if not stop_event.is_set():
-        flash("Service is already running!", "info")
-        return redirect(url_for('index'))
     try:
-        stop_event.clear()  # Reset stop signal
-        thread = Thread(target=main)  # Start the main BACnet service in a new thread
-        thread.daemon = True
-        thread.start()
+        names = requested_services()
+        if all(lifecycle.state(name) == RUNNING for name in names):
+            flash("Service is already running!", "info")
+            return redirect(url_for('index'))
+        lifecycle.start(*names)
         flash("Service started successfully!", "success")
     except Exception as e:
         flash(f"Error starting service: {e}", "danger")
@@ -172,24 +357,32 @@ def start_service():
 
 @app.route('/stop-service', methods=['POST'])
 def stop_service():
-    """Stop BACnet/TWIG services."""
-    global stop_event, test_application
-    if stop_event.is_set():
-        flash("Service is already stopped!", "info")
-        return redirect(url_for('index'))
+    """Stop BACnet/TWIG services, their threads are joined and the port and socket kept for a restart."""
     try:
-        stop_event.set()  # Signal threads to stop
-        # Wait a moment for threads to terminate
-        time.sleep(1)
-        # Cleanup BACnet application if needed
-        if test_application:
-            test_application.close_socket()
-            test_application = None 
-        flash("Service stopped successfully!", "success")
+        names = requested_services()
+        if all(lifecycle.state(name) == STOPPED for name in names):
+            flash("Service is already stopped!", "info")
+            return redirect(url_for('index'))
+        if lifecycle.stop(*names):
+            flash("Service stopped successfully!", "success")
+        else:
+            flash("Service stopped, but some threads did not finish in time, see the log", "warning")
     except Exception as e:
         flash(f"Error stopping service: {e}", "danger")
     return redirect(url_for('index'))
 
+@app.route('/restart-service', methods=['POST'])
+def restart_service():
+    """Restart BACnet/TWIG services."""
+    try:
+        if lifecycle.restart(*requested_services()):
+            flash("Service restarted successfully!", "success")
+        else:
+            flash("Service restarted, but some threads did not finish in time, see the log", "warning")
+    except Exception as e:
+        flash(f"Error restarting service: {e}", "danger")
+    return redirect(url_for('index'))
+
 @app.route('/map_object', methods=['POST'])
 def map_object():
     """Map a BACnet object to an ids_list index."""
@@ -211,6 +404,70 @@ def map_object():
 
 
 
+@app.route('/mappings/import', methods=['POST'])
+def import_mappings():
+    """Replace (or with merge=1, update) the whole object to valve mapping from one CSV or JSON upload."""
+    global object_to_ids_mapping
+    from_form = 'file' in request.files
+    fmt = request.args.get('format') or request.form.get('format')
+    try:
+        if from_form:
+            upload = request.files['file']
+            text = upload.read().decode('utf-8-sig')
+            name = upload.filename or ''
+        else:
+            text = request.get_data(as_text=True)
+            name = ''
+        if not fmt:
+            fmt = 'json' if name.lower().endswith('.json') or request.is_json else 'csv'
+        mapping, errors = validate_mapping_table(parse_mapping_table(text, fmt))
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+        mapping, errors = {}, [f"cannot parse upload: {e}"]
+    except RuntimeError as e:
+        mapping, errors = {}, [str(e)]
+
+    if not errors:
+        merge = (request.args.get('merge') or request.form.get('merge')) in ('1', 'true', 'on')
+        updated = dict(object_to_ids_mapping) if merge else {name: 0 for name in bacnet_object_names()}
+        updated.update(mapping)
+        object_to_ids_mapping = updated  # swapped in whole, BACnet writes never see a half applied table
+        save_config()
+
+    if from_form:
+        if errors:
+            flash("Mapping import rejected: " + "; ".join(errors[:10]), "danger")
+        else:
+            flash(f"Imported {len(mapping)} mappings.", "success")
+        return redirect(url_for('index'))
+    if errors:
+        return jsonify({"errors": errors}), 400
+    return jsonify({"applied": len(mapping)})
+
+@app.route('/mappings/export')
+def export_mappings():
+    """Stream the current object to valve mapping as CSV (default) or JSON."""
+    fmt = request.args.get('format', 'csv')
+    mapping = dict(object_to_ids_mapping)
+    table = refresh_valves() if get_event_loop().unique_ids else {}
+    if fmt == 'json':
+        return Response(json.dumps(mapping, indent=1, sort_keys=True), mimetype='application/json',
+                        headers={"Content-Disposition": "attachment; filename=mappings.json"})
+
+    def rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["object_name", "valve_index", "twig_id", "valve_number"])
+        for object_name, valve_index in sorted(mapping.items(), key=lambda item: item[0]):
+            details = table.get(valve_index, {})
+            writer.writerow([object_name, valve_index, details.get("twig_id", ""), details.get("valve_number", "")])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(rows(), mimetype='text/csv',
+                    headers={"Content-Disposition": "attachment; filename=mappings.csv"})
+
 @app.route('/set-ip', methods=['POST'])
 def set_ip():
     """Set a fixed IP address for the Raspberry Pi."""
@@ -236,20 +493,330 @@ def set_ip():
 def status():
     """Show valve status."""
     global valves
+    refresh_valves()
+    return render_template('status.html', valves=valves, live_port=live_updates.port)
+
+############################################## JSON API #########################################################
+
+API_PAGE_LIMIT = 1000  # largest page a client may ask for
+api_cache = {"etag": None, "bodies": {}}  # serialized responses for the current state version, by request path
+api_cache_lock = Lock()
+
+def state_etag():
+    """An ETag that changes whenever anything the JSON API reports may have changed."""
+    return f"{get_event_loop().stateVersion}.{valves_version}.{config_store.version}"
+
+def api_response(build):
+    """Answer a JSON API GET, with 304 for a matching If-None-Match and a per-version body cache.
+
+    build() returns the full list of items; fields, offset and limit are applied here.
+    """
+    try:
+        etag = state_etag()
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        key = request.full_path
+        with api_cache_lock:
+            if api_cache["etag"] != etag:
+                api_cache["etag"], api_cache["bodies"] = etag, {}
+            body = api_cache["bodies"].get(key)
+        if body is None:
+            try:
+                offset = max(int(request.args.get('offset', 0)), 0)
+                limit = min(max(int(request.args.get('limit', API_PAGE_LIMIT)), 1), API_PAGE_LIMIT)
+            except ValueError as e:
+                return jsonify({"error": f"bad paging argument: {e}"}), 400
+            fields = [field for field in request.args.get('fields', '').split(',') if field]
+            items = build()
+            page = items[offset:offset + limit]
+            if fields:
+                page = [{field: item[field] for field in fields if field in item} for item in page]
+            body = json.dumps({"version": etag, "total": len(items), "offset": offset, "limit": limit, "items": page})
+            with api_cache_lock:
+                if api_cache["etag"] == etag and len(api_cache["bodies"]) < 64:
+                    api_cache["bodies"][key] = body
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"  # clients may keep it but must revalidate
+    return response
+
+@app.route('/api/v1/valves')
+def api_valves():
+    """Valve table as JSON: ?fields=status,twig_id&offset=0&limit=100."""
+    def build():
+        table = refresh_valves()
+        stale = get_event_loop().staleIDs
+        objects = {}
+        for object_name, valve_index in object_to_ids_mapping.items():
+            if valve_index:
+                objects.setdefault(valve_index, []).append(object_name)
+        return [{
+            "index": index,
+            "status": details.get("status"),
+            "twig_id": details.get("twig_id"),
+            "valve_number": details.get("valve_number"),
+            "objects": sorted(objects.get(index, [])),
+            "stale": details.get("twig_id") in stale,
+        } for index, details in sorted(table.items())]
+    return api_response(build)
+
+@app.route('/api/v1/devices')
+def api_devices():
+    """Discovered RTUs with their last vitals as JSON: ?fields=oid,rssi&offset=0&limit=100."""
+    def build():
+        event_object = get_event_loop()
+        devices, positions, last_seen, stale = event_object.devices, event_object.positions, event_object.lastSeen, event_object.staleIDs
+        items = []
+        for oid in sorted(event_object.unique_ids):
+            twig_id = TwigID.int(oid)
+            vitals = devices.get(oid)
+            items.append({
+                "oid": oid,
+                "rtu": twig_id.rtuString,
+                "valve_count": twig_id.valveCount,
+                "power": vitals.power if vitals else None,
+                "rssi": vitals.rssi if vitals else None,
+                "extra": vitals.extra if vitals else None,
+                "positions": positions.get(oid),
+                "last_seen": last_seen.get(oid),
+                "stale": oid in stale,
+            })
+        return items
+    return api_response(build)
+
+VALVE_STATES = {"on": 1, "open": 1, "1": 1, "off": 0, "closed": 0, "0": 0}
+
+@app.route('/api/v1/valves/bulk', methods=['POST'])
+def api_valves_bulk():
+    """Move many valves at once: {"valves": [index, ...] or "all", "state": "on"|"off", "stagger": seconds, "label": text}.
+
+    The change becomes the desired state of every valve and is sent as one scheduled operation, split into
+    hub-sized batches; answers 202 with the operation, whose progress is at /api/v1/operations/<id>.
+    """
+    document = request.get_json(silent=True) or {}
+    state = VALVE_STATES.get(str(document.get("state", "")).strip().lower())
+    if state is None:
+        return jsonify({"error": "state must be on or off"}), 400
+    try:
+        table = refresh_valves()
+        stagger = float(document.get("stagger", 0))
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"bad stagger: {e}"}), 400
+    indexes = document.get("valves", [])
+    if indexes == "all":
+        indexes = sorted(table)
+    if not isinstance(indexes, list) or not indexes:
+        return jsonify({"error": "valves must be a list of valve indexes or \"all\""}), 400
+    unknown = [index for index in indexes if index not in table]
+    if unknown:
+        return jsonify({"error": "unknown valve indexes", "unknown": unknown}), 400
+    changes = []
+    for index in indexes:
+        details = table[index]
+        details["status"] = "Open" if state == 1 else "Closed"
+        changes.append((details["twig_id"], details["valve_number"], valve_positions.codeForPresentValue(state)))
+    mark_valves_changed()
+    operation = valve_reconciler.setDesiredMany(changes, label=str(document.get("label", f"bulk {len(changes)} valves")), stagger=stagger)
+    response = jsonify(operation.progress())
+    response.status_code = 202
+    response.headers["Location"] = url_for('api_operation', operation_id=operation.id)
+    return response
+
+@app.route('/api/v1/traces')
+def api_traces():
+    """Per-stage latency percentiles of the buffered BACnet write traces, and the most recent ones: ?limit=50."""
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), API_PAGE_LIMIT)
+    except ValueError as e:
+        return jsonify({"error": f"bad limit: {e}"}), 400
+    return jsonify({"stages": TRACER.summary(), "recent": TRACER.recent(limit)})
+
+@app.route('/api/v1/operations')
+def api_operations():
+    """Recent and running valve operations with their progress."""
+    return jsonify([operation.progress() for operation in valve_scheduler.operations()])
+
+@app.route('/api/v1/operations/<int:operation_id>', methods=['GET', 'DELETE'])
+def api_operation(operation_id):
+    """Progress of one valve operation; DELETE cancels the batches not yet sent."""
+    if request.method == 'DELETE':
+        operation = valve_scheduler.cancel(operation_id)
+    else:
+        operation = valve_scheduler.operation(operation_id)
+    if operation is None:
+        return jsonify({"error": f"no operation {operation_id}"}), 404
+    return jsonify(operation.progress())
+
+############################################## Live updates #########################################################
+
+def device_state(oid):
+    """What the dashboards show for one RTU, evaluated when the frame carrying it is built."""
+    event_object = get_event_loop()
+    vitals = event_object.devices.get(oid)
+    positions = event_object.positions.get(oid)
+    return {
+        "positions": positions,
+        "reported": [valve_positions.statusForCode(code) for code in valve_positions.decode(oid, positions)] if positions is not None else [],
+        "rssi": vitals.rssi if vitals else None,
+        "power": vitals.power if vitals else None,
+        "last_seen": event_object.lastSeen.get(oid),
+        "stale": oid in event_object.staleIDs,
+    }
+
+def live_snapshot():
+    """Full state sent to a dashboard when it connects to the live stream."""
+    try:
+        event_object = get_event_loop()
+    except RuntimeError:
+        return {"valves": valves, "devices": {}, "log": []}
+    return {
+        "valves": refresh_valves(),
+        "devices": {oid: device_state(oid) for oid in sorted(event_object.unique_ids)},
+        "log": event_object.getCommunicationLog(),
+    }
+
+def publish_hub_update(topic, payload):
+    """Event bus subscriber feeding the live stream.
+
+    It only records which keys changed; the values are built once per frame on the live updates thread,
+    however many events hit the same key in between.
+    """
+    if topic in ("vitals", "valves"):
+        live_updates.publish(f"devices/{payload.oid}", partial(device_state, payload.oid))
+    elif topic == "sweep":
+        for vitals in payload:
+            live_updates.publish(f"devices/{vitals.oid}", partial(device_state, vitals.oid))
+        live_updates.publish("valves", refresh_valves)  # the set of RTUs may have changed
+    elif topic == "command":
+        live_updates.publish("command", {
+            "command": f"{payload.command:02X}",
+            "outcome": payload.outcome,
+            "retries": payload.retries,
+        })
+    elif topic == "log":
+        live_updates.publish("log", get_event_loop().getCommunicationLog)
+
+live_updates = LiveUpdates(live_snapshot, port=LIVE_PORT)  # ports are set from the config by load_config
+
+############################################## BACnet core handoff #########################################################
+
+# BACnet objects belong to the bacpypes core thread; other threads hand their changes to it, see lib/core_handoff.py
+core_handoff = CoreHandoff()
+
+def set_from_thread(obj, property_name, value):
+    """Set a property of a BACnet object from any thread; applied on the core thread, the latest value per property wins."""
+    core_handoff.post((obj.objectName, property_name), setattr, obj, property_name, value)
+
+def show_reported_value(object_name, valve_index, oid, valve_number, code):
+    """On the core thread: show a valve's reported position on its point and in the valve table, unless a write
+    moving it elsewhere is pending."""
+    obj = bacnet_objects.get(object_name)
+    value = valve_positions.presentValueForCode(code)
+    if obj is None or value is None:
+        return
+    if valve_reconciler.isDriving(oid, *valve_positions.encode(oid, valve_number, code)):
+        return  # a report from before the write, or the valve is being corrected
+    details = valves.get(valve_index)
+    status = valve_positions.statusForCode(code)
+    if details is not None and details.get("twig_id") == oid and details["status"] != status:
+        details["status"] = status
+        mark_valves_changed(valve_index)
+    if obj.presentValue != value:
+        obj.presentValue = BinaryPV(value)  # a direct property write: COV subscribers are notified, the valve is not moved
+
+def reflect_reported_positions(oids):
+    """Hand the reported positions of the given RTUs to the BACnet points mapped to their valves.
+
+    Uses the valve table as it is, RTUs it does not list yet are shown once it has been rebuilt and they report again.
+    """
     event_object = get_event_loop()
-    ids_list = list(event_object.unique_ids)
-    i = 1
-    for index , items in enumerate(ids_list):
-        valves[index+i]['twig_id'] = items
-        valves[index+i]["valve_number"] = 1
-        valves[index+i+1]['twig_id'] = items
-        valves[index+i+1]["valve_number"] = 2
-        i+=1
-    return render_template('status.html', valves=valves)
-
-def start_flask():
-    """Run Flask app in a separate thread."""
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    table = valves
+    for object_name, valve_index in object_to_ids_mapping.items():
+        details = table.get(valve_index)
+        if not details or details.get("twig_id") not in oids or object_name not in bacnet_objects:
+            continue
+        oid, valve_number = details["twig_id"], details["valve_number"]
+        positions = event_object.positions.get(oid)
+        codes = valve_positions.decode(oid, positions) if positions is not None else ()
+        if not 1 <= valve_number <= len(codes):
+            continue
+        code = codes[valve_number - 1]
+        value = valve_positions.presentValueForCode(code)
+        if value is None:
+            continue
+        if bacnet_objects[object_name].presentValue != value or details["status"] != valve_positions.statusForCode(code):
+            core_handoff.post((object_name, "presentValue"), show_reported_value, object_name, valve_index, oid, valve_number, code)
+
+def reflect_hub_update(topic, payload):
+    """Event bus subscriber showing reported valve positions on the BACnet points."""
+    if topic == "sweep":
+        reflect_reported_positions({vitals.oid for vitals in payload})
+    else:
+        reflect_reported_positions({payload.oid})
+
+############################################## Web server #########################################################
+
+WEB_PORT = 5000  # defaults, config keys web_port and live_port override them
+web_port = WEB_PORT
+
+def make_web_server(server="auto", threads=None):
+    """Create the web UI server, bound but not yet serving; returns (serve, shutdown).
+
+    With waitress installed (or server="waitress") requests are handled by a fixed pool of worker
+    threads with HTTP keep-alive, so concurrent dashboards don't queue behind each other and a burst
+    of requests can't spawn threads that compete with the hub loops. server="dev" (or no waitress)
+    falls back to Flask's threaded development server.
+    serve() blocks, shutdown() returns at once and serve() returns shortly after; it must not be
+    called from a request.
+    """
+    threads = threads or min(4, os.cpu_count() or 1)
+    create_server = None
+    if server in ("auto", "waitress"):
+        try:
+            from waitress import create_server
+            from waitress import wasyncore
+        except ImportError:
+            if server == "waitress":
+                raise
+            print("waitress is not installed, using the Flask development server")
+    if create_server is not None:
+        web = create_server(app, host='0.0.0.0', port=web_port, threads=threads,
+                            connection_limit=64,  # further clients wait in the listen backlog
+                            channel_timeout=30,  # idle keep-alive connections are closed after this many seconds
+                            ident="twig-gateway")
+
+        def serve():
+            web.run()
+            web.task_dispatcher.shutdown()
+
+        # closing every channel from inside its own loop leaves it nothing to wait on, so run() returns
+        return serve, lambda: web.trigger.pull_trigger(lambda: wasyncore.close_all(web._map))
+    from werkzeug.serving import make_server
+    web = make_server('0.0.0.0', web_port, app, threaded=True)
+    # BaseServer.shutdown() waits for serve_forever() to return, so it gets a thread of its own
+    return web.serve_forever, lambda: Thread(target=web.shutdown, name="web-shutdown", daemon=True).start()
+
+web_shutdown = None  # shutdown() of the running web server, see start_web
+
+def start_web(server="auto", threads=None):
+    """Start the web UI and the live updates stream, returns their threads."""
+    global web_shutdown
+    serve, web_shutdown = make_web_server(server, threads)
+    live_updates.stopped = False
+    started = [Thread(target=serve, name="web", daemon=True),
+               Thread(target=live_updates.serveForever, name="live-updates", daemon=True)]
+    for thread in started:
+        thread.start()
+    return started
+
+def stop_web():
+    web_shutdown()
+    live_updates.stop()
 
 # some debugging
 _debug =  True
@@ -279,8 +846,20 @@ class WritableAnalogValueObject(AnalogValueObject):
 
 
 @bacpypes_debugging
-class SubscribeCOVApplication(BIPSimpleApplication, ChangeOfValueServices):
-    pass       
+class SubscribeCOVApplication(BIPSimpleApplication, ReadWritePropertyMultipleServices, ChangeOfValueServices):
+    """The gateway's BACnet application, with ReadPropertyMultiple as BMS polls use it.
+
+    It notes when the WriteProperty request being served arrived, to trace it.
+    """
+
+    write_received_at = None
+
+    def do_WritePropertyRequest(self, apdu):
+        self.write_received_at = time.perf_counter()
+        try:
+            super().do_WritePropertyRequest(apdu)
+        finally:
+            self.write_received_at = None
 
 #
 #   COVConsoleCmd
@@ -523,7 +1102,7 @@ class TestAnalogValueThread(Thread):
                 TestAnalogValueThread._debug("    - next_value: %r", next_value)
 
             # change the point
-            test_av.presentValue = next_value
+            set_from_thread(test_av, "presentValue", next_value)
 
             # sleep
             time.sleep(self.interval)
@@ -540,13 +1119,22 @@ class WritableBinaryValueObject(BinaryValueObject):
         if property_name == 'presentValue':
             current_value = getattr(self, property_name)
             if current_value != value:
+                # Refuse the write rather than queue it behind a hub that is not answering
+                if not hub_accepting_writes():
+                    raise ExecutionError(errorClass='device', errorCode='deviceBusy')
+
+                # Follow the write to the valves, from when its request arrived if it came over BACnet
+                received_at = test_application.write_received_at if test_application is not None else None
+                trace = TRACER.begin(self.objectName, received_at)
+                trace.mark(STAGE_BACNET)
+
                 # Change the value
                 super().WriteProperty(property_name, value, index, key)
 
                 # Trigger your custom process
-                self.on_value_change(value)
+                self.on_value_change(value, trace)
 
-    def on_value_change(self, value):
+    def on_value_change(self, value, trace=None):
         global valves,object_to_ids_mapping
         """Custom process when value changes."""
         try:
@@ -555,38 +1143,35 @@ class WritableBinaryValueObject(BinaryValueObject):
             print(f"Object Name: {self.objectName}")
             event_object = get_event_loop()
             ids_list = list(event_object.unique_ids)
-            i = 1
-            for index , items in enumerate(ids_list):
-                valves[index+i]['twig_id'] = items
-                valves[index+i]["valve_number"] = 1
-                valves[index+i+1]['twig_id'] = items
-                valves[index+i+1]["valve_number"] = 2
-                i+=1
-            print(f"DEBUG : {valves}")
-            print(f"DEBUG : {object_to_ids_mapping}")
+            refresh_valves()
+            valve_index = object_to_ids_mapping.get(self.objectName)
             if len(ids_list) == 0 :
                 print("Set is empty")
-            elif (int(self.objectName) - 50) > len(ids_list):
-                print(f'The number of valves is {len(ids_list)} max object number is {len(ids_list) + 50} given object is {self.objectName}')  
-            else:        
-                if (valves[object_to_ids_mapping[self.objectName]]["valve_number"]) ==1:
-                    valves[int(self.objectName) - 50]['status'] =  "Open" if value==1 else "Closed"
-                    control_valve(valves[object_to_ids_mapping[self.objectName]]["twig_id"].to_bytes(4,byteorder='little') , 0x01 if value==1 else 0x02)
-                elif(valves[object_to_ids_mapping[self.objectName]]["valve_number"]) ==2:
-                    control_valve(valves[object_to_ids_mapping[self.objectName]]["twig_id"].to_bytes(4,byteorder='little') , 0x04 if value==1 else 0x08)
-                    valves[object_to_ids_mapping[self.objectName]]['status'] =  "Open" if value==1 else "Closed"
-
-
-                # if (valves[int(self.objectName) - 50]["valve_number"] ) ==1:
-                #     valves[int(self.objectName) - 50]['status'] =  "Open" if value==1 else "Closed"
-                #     control_valve(valves[int(self.objectName)-50]["twig_id"].to_bytes(4,byteorder='little') , 0x01 if value==1 else 0x02)
-                # elif(valves[int(self.objectName) - 50]["valve_number"] ) ==2:
-                #     control_valve(valves[int(self.objectName)-50]["twig_id"].to_bytes(4,byteorder='little') , 0x04 if value==1 else 0x08)
-                #     valves[int(self.objectName) - 50]['status'] =  "Open" if value==1 else "Closed"
+            elif valve_index not in valves:
+                print(f'The number of valves is {len(valves)}, object {self.objectName} is mapped to valve {valve_index}')
+            else:
+                details = valves[valve_index]
+                details['status'] = "Open" if value == 1 else "Closed"
+                mark_valves_changed(valve_index)
+                if trace is not None:
+                    trace.mark(STAGE_HANDLER)
+                valve_reconciler.setDesired(details["twig_id"], details["valve_number"], valve_positions.codeForPresentValue(value), trace)
+        except Exception as e:
+            print(e)
 
+class ValveGroupObject(WritableBinaryValueObject):
+    """A binary value standing for a configured valve group, a write moves all its valves at once."""
 
+    def on_value_change(self, value, trace=None):
+        try:
+            operation = apply_valve_group(self.objectName, value, trace)
+            if operation is None:
+                print(f"Valve group {self.objectName} has no discovered valves")
+            else:
+                commandsLog.debug("valve group %s -> %s: %d RTUs", self.objectName, value, operation.total)
         except Exception as e:
             print(e)
+
 @bacpypes_debugging
 class TestBinaryValueTask(RecurringTask):
 
@@ -650,85 +1235,71 @@ class TestBinaryValueThread(RecurringTask, Thread):
         while not stop_event.is_set():
             next_value = self.test_values.pop(0)
             self.test_values.append(next_value)
-            test_bv.presentValue = next_value
+            set_from_thread(test_bv, "presentValue", next_value)
             time.sleep(self.interval)
 
 
-def main():
-    # Register signal handlers
+############################################## Startup #########################################################
+
+startup_phases = {}  # phase name -> seconds, filled in by main()
+
+def record_phase(phase, started):
+    """Record how long a startup phase took, for the log line, /metrics and bench_startup.py."""
+    seconds = time.perf_counter() - started
+    startup_phases[phase] = seconds
+    REGISTRY.gauge("twig_startup_phase_seconds", "Time spent in each startup phase", {"phase": phase}).set(seconds)
+    return seconds
+
+def start_hub():
+    """Start the hub loops (opening the port the first time), the valve scheduler and the reconciler; returns their threads."""
+    started = time.perf_counter()
+    hub_status = setup()  # setup twig protocol
+    if hub_status != OK:
+        print("Hub serial port not available, retrying in the background")
+    if not hub_subscriptions:
+        bus = get_event_loop().bus
+        # both only care about the latest state per RTU, so a backlog collapses rather than drops
+        hub_subscriptions.append(bus.subscribe("live", publish_hub_update, topics=("vitals", "sweep", "valves", "command", "log"), policy=COALESCE))
+        hub_subscriptions.append(bus.subscribe("reconciler", reconcile_hub_update, topics=("vitals", "sweep", "valves", "recovered"), policy=COALESCE, maxsize=4096))
+        hub_subscriptions.append(bus.subscribe("bacnet", reflect_hub_update, topics=("vitals", "sweep", "valves"), policy=COALESCE, maxsize=4096))
+    valve_scheduler.stopped = valve_reconciler.stopped = False
+    threads = get_hub_threads() + [
+        Thread(target=valve_scheduler.loop, name="valve-scheduler", daemon=True),
+        Thread(target=valve_reconciler.loop, name="valve-reconciler", daemon=True),
+    ]
+    threads[-2].start()
+    threads[-1].start()
+    record_phase("hub", started)
+    return threads
+
+hub_subscriptions = []  # event bus subscriptions, made by the first start_hub and kept across restarts
+
+def stop_hub():
+    valve_reconciler.stop()
+    valve_scheduler.stop()
+    teardown()
+
+def close_hub():
+    """Close the serial port for good."""
     try:
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
-    except:
+        get_command_loop().link.close()
+    except RuntimeError:
         pass
-    return_status = setup()  # setup twig protocol
-
-    global test_av, test_bv, test_application, num_valves, object_to_ids_mapping
-    # load the configuration
-    load_config()
-    print(f'Number of valves is {num_valves}')
-
-    # make a parser
-    parser = ConfigArgumentParser(description=__doc__)
-    parser.add_argument(
-        "--console", action="store_true", default=False, help="create a console",
-    )
-
-    # analog value task and thread
-    parser.add_argument(
-        "--avtask", type=float, help="analog value recurring task",
-    )
-    parser.add_argument(
-        "--avthread", type=float, help="analog value thread",
-    )
-
-    # analog value task and thread
-    parser.add_argument(
-        "--bvtask", type=float, help="binary value recurring task",
-    )
-    parser.add_argument(
-        "--bvthread", type=float, help="binary value thread",
-    )
-
-    # provide a different spin value
-    parser.add_argument(
-        "--spin", type=float, help="spin time", default=1.0,
-    )
-    if not hasattr(parser, 'ini') or not parser.parse_args().ini:
-        parser.set_defaults(ini='./bacnet.ini')
-    # parse the command line arguments
-    args = parser.parse_args()
-
-    if _debug:
-        _log.debug("initialization")
-    if _debug:
-        _log.debug("    - args: %r", args)
-
-    # Check for stop signal
-    if stop_event.is_set():
-        print("Stop signal received. Exiting main function.")
-        return
 
+def build_bacnet(args):
+    """Create the BACnet device, application and objects; done once, the core loop is started and stopped by the lifecycle."""
+    global test_av, test_bv, test_application
     # make a device object
+    phase_started = time.perf_counter()
     this_device = LocalDeviceObject(ini=args.ini)
     if _debug:
         _log.debug("    - this_device: %r", this_device)
 
-    # Check for stop signal
-    if stop_event.is_set():
-        print("Stop signal received. Exiting main function.")
-        return
-
     # make a sample application
     print(args.ini.address)
 
     test_application = SubscribeCOVApplication(this_device, args.ini.address)
 
-    # Check for stop signal
-    if stop_event.is_set():
-        print("Stop signal received. Exiting main function.")
-        return
-
     # make a binary value object
     for i in range(1, num_valves + 1):
         test_bv = WritableBinaryValueObject(
@@ -737,18 +1308,30 @@ def main():
             presentValue=BinaryPV(0),
             statusFlags=[0, 0, 0, 0],
         )
-        object_to_ids_mapping[f"{50 + i}"] = 0
+        object_to_ids_mapping.setdefault(f"{50 + i}", 0)  # keep mappings loaded from the config
 
         # add it to the device
         test_application.add_object(test_bv)
-
-        # Check for stop signal in the loop
-        if stop_event.is_set():
-            print("Stop signal received. Exiting main function.")
-            return
+        bacnet_objects[test_bv.objectName] = test_bv
 
     _log.debug("    - test_bv: %r", test_bv)
 
+    # one binary value per configured valve group
+    for n, (name, members) in enumerate(sorted(valve_groups().items()), 1):
+        if name in bacnet_objects:
+            print(f"Valve group {name} has the name of a valve point, skipped")
+            continue
+        group_bv = ValveGroupObject(
+            objectIdentifier=("binaryValue", GROUP_INSTANCE_BASE + n),
+            objectName=name,
+            presentValue=BinaryPV(0),
+            statusFlags=[0, 0, 0, 0],
+        )
+        test_application.add_object(group_bv)
+        bacnet_objects[name] = group_bv
+        _log.debug("    - valve group %s: %d valves", name, len(members))
+    record_phase("bacnet", phase_started)
+
     # make a console
     if args.console:
         test_console = COVConsoleCmd()
@@ -790,54 +1373,238 @@ def main():
     i_am.vendorID = this_device.vendorIdentifier
     test_application.request(i_am)
 
-    # Start Flask in a separate thread
-    flask_thread = Thread(target=start_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
+    # positions the hub reported before the points existed
+    try:
+        refresh_valves()
+        reflect_reported_positions(set(get_event_loop().positions))
+    except RuntimeError:
+        pass  # the hub is not set up yet, its first sweep takes care of it
+    return this_device
+
+def start_bacnet(spin):
+    """Run the bacpypes core loop on its own thread, the signal handlers stay with main()."""
+    thread = Thread(target=run, kwargs={"spin": spin, "sigterm": None, "sigusr1": None}, name="bacnet-core", daemon=True)
+    thread.start()
+    return [thread]
+
+def stop_bacnet():
+    # runs inside the core loop as soon as it is woken, or once it starts spinning if it has not yet
+    core_handoff.call(stop_bacnet_core)
+
+def close_bacnet():
+    """Close the BACnet socket for good."""
+    global test_application
+    if test_application:
+        test_application.close_socket()
+        test_application = None
+
+def main():
+    if "imports" not in startup_phases:
+        record_phase("imports", startup_started)
+    main_started = time.perf_counter()
+
+    # Register signal handlers
+    try:
+        signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
+    except:
+        pass
+
+    # The hub (serial port, snapshot, loops) and web subsystems start in the background while BACnet is built here
+    lifecycle.add("hub", start_hub, stop_hub, close_hub)
+    hub_thread = Thread(target=lifecycle.start, args=("hub",), name="hub-setup", daemon=True)
+    hub_thread.start()
+
+    global num_valves, object_to_ids_mapping
+    # load the configuration
+    phase_started = time.perf_counter()
+    load_config()
+    record_phase("config", phase_started)
+    print(f'Number of valves is {num_valves}')
+
+    # make a parser
+    parser = ConfigArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--console", action="store_true", default=False, help="create a console",
+    )
+
+    # analog value task and thread
+    parser.add_argument(
+        "--avtask", type=float, help="analog value recurring task",
+    )
+    parser.add_argument(
+        "--avthread", type=float, help="analog value thread",
+    )
+
+    # analog value task and thread
+    parser.add_argument(
+        "--bvtask", type=float, help="binary value recurring task",
+    )
+    parser.add_argument(
+        "--bvthread", type=float, help="binary value thread",
+    )
 
-    # Check for stop signal in the main loop
-    while not stop_event.is_set():
-        run(args.spin)
+    # provide a different spin value
+    parser.add_argument(
+        "--spin", type=float, help="spin time", default=1.0,
+    )
 
-    # Cleanup when the stop signal is received
-    print("Cleaning up resources...")
-    test_application = None
+    # logging and startup measurement
+    parser.add_argument(
+        "--verbose", action="store_true", default=bool(os.environ.get("TWIG_DEBUG")),
+        help="log everything at DEBUG (also enabled by TWIG_DEBUG=1)",
+    )
+    parser.add_argument(
+        "--web-server", choices=("auto", "waitress", "dev"), default="auto",
+        help="web server: waitress worker pool when available (auto), or the Flask development server",
+    )
+    parser.add_argument(
+        "--web-threads", type=int, default=None,
+        help="web worker threads, defaults to the number of cores (at most 4)",
+    )
+    parser.add_argument(
+        "--startup-benchmark", action="store_true", default=False,
+        help="print the startup phase timings as JSON and exit instead of serving",
+    )
+    if not hasattr(parser, 'ini') or not parser.parse_args().ini:
+        parser.set_defaults(ini='./bacnet.ini')
+    # parse the command line arguments
+    args = parser.parse_args()
+
+    # DEBUG everywhere is expensive on a Pi, so it is opt-in
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    if not args.startup_benchmark:
+        lifecycle.add("web", partial(start_web, args.web_server, args.web_threads), stop_web)
+        lifecycle.start("web")
+
+    if _debug:
+        _log.debug("initialization")
+    if _debug:
+        _log.debug("    - args: %r", args)
+
+    build_bacnet(args)
+    lifecycle.add("bacnet", partial(start_bacnet, args.spin), stop_bacnet, close_bacnet)
+
+    # the BACnet side is ready, wait for the hub before serving writes
+    hub_thread.join()
+    record_phase("ready", main_started)
+    print("startup: " + ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in startup_phases.items()))
+    if args.startup_benchmark:
+        print(json.dumps(startup_phases))
+        shutdown()
+        return
+
+    # every service runs on threads of its own, this one waits for a termination signal
+    if not stop_event.is_set():
+        lifecycle.start("bacnet")
+        stop_event.wait()
+    shutdown()
     _log.debug("fini")
 
 
 
-def control_valve(oid, action):
+############################################## Valve control #########################################################
+
+def control_valve(oid, action, trace=None):
     """
     Sends commands to control two valves on a twig using a single integer.
 
     :param oid: Object Identifier (as bytes) of the twig, e.g., b'\xE0\xE1\x10\x00'
-    :param action: Integer bitmask (0-15) representing the state of two valves:
+    :param action: Integer bitmask (0-15) of ValveAction flags (lib/valve_positions.py) for two valves:
                    - Bit 0: Valve 1 ON
                    - Bit 1: Valve 1 OFF
                    - Bit 2: Valve 2 ON
                    - Bit 3: Valve 2 OFF
                    Example: 13 (0b1101) => Valve 1 ON, Valve 2 ON, Valve 2 OFF
+    :param trace: the write's trace (lib/tracing.py), one is started here if not given
     """
-    commandLoop = get_command_loop()
-    
     # Validate action
     if not (0 <= action <= 0x0F):  # Ensure action is within 4 bits (0–15)
         raise ValueError("Invalid action. Must be an integer between 0 and 15.")
+    if trace is None:
+        trace = TRACER.begin(f"control {oid.hex()}")
+    queue_valve_batch({int.from_bytes(oid, byteorder='little'): action}, [trace])
 
-    # Step 1: Send valvesBegin command (0x02)
-    commandLoop.queueNamedCommand(CommandCode.ValvesBegin)
-    print("Sent: valvesBegin (0x02)")
-    print(f'Type pf oid is {type(oid)}')
+VALVE_TRANSACTION_ROOM = 3  # ValvesBegin, ValvesPut, ValvesCommit
 
+def hub_accepting_writes():
+    """False while the hub is unresponsive or the command queue has no room for another valve transaction.
 
-    # Step 3: Send valvesPut command (0x51)
-    body = oid + bytes([action])
-    commandLoop.queueNamedCommand(CommandCode.ValvesPut, body)
-    print(f"Sent: valvesPut (0x51) for OID {HEX(oid)}, action: {action}")
+    Before the hub has been set up writes are accepted, they are kept as desired positions until it is.
+    """
+    try:
+        return get_command_loop().isAcceptingWrites(room=VALVE_TRANSACTION_ROOM)
+    except RuntimeError:
+        return True
+
+def queue_valve_batch(actions, traces=(), on_done=None):
+    """Queue one valve transaction: ValvesBegin, a ValvesPut per oid with its packed action bits, ValvesCommit.
+
+    :param actions: {oid: packed action bits}
+    :param traces: traces of the BACnet writes that asked for it; every command carries them, they are finished with
+                   the transaction's outcome once the commit has been handled
+    :param on_done: called on the command thread with {oid: outcome} once the commit has been handled; an oid's
+                    outcome is that of its put, unless the begin or the commit failed
+    :raises CommandQueueFull: the command queue has no room for the whole transaction, nothing was queued
+    """
+    commandLoop = get_command_loop()
+    results = {}
+    traces = tuple(traces)
+    tracked = on_done is not None or traces
+    record = (lambda key: lambda outcome: results.__setitem__(key, outcome)) if tracked else (lambda key: None)
+
+    def finish(commit_outcome):
+        failed = next((outcome for outcome in (results.get("begin"), commit_outcome) if outcome not in SUCCESSFUL_OUTCOMES), None)
+        outcomes = {oid: failed or results.get(oid, OUTCOME_TIMEOUT) for oid in actions}
+        # a write is as good as the worst put in its transaction
+        trace_outcome = next((outcome for outcome in outcomes.values() if outcome not in SUCCESSFUL_OUTCOMES), commit_outcome)
+        for trace in traces:
+            TRACER.finish(trace, trace_outcome)
+        if on_done is not None:
+            on_done(outcomes)
 
-    # Step 4: Send valvesCommit command (0x04)
-    commandLoop.queueNamedCommand(CommandCode.ValvesCommit)
-    print("Sent: valvesCommit (0x04)")
+    # Step 1: Send valvesBegin command (0x02)
+    commands = [commandLoop.namedCommand(CommandCode.ValvesBegin, onDone=record("begin"), traces=traces)]
+
+    # Step 2: Send a valvesPut command (0x51) per twig
+    for oid, action in actions.items():
+        body = oid.to_bytes(4, byteorder='little') + bytes([action])
+        commands.append(commandLoop.namedCommand(CommandCode.ValvesPut, body, onDone=record(oid), traces=traces))
+        commandsLog.debug("valvesPut (0x51) for OID %d, action: %d", oid, action)
+
+    # Step 3: Send valvesCommit command (0x04)
+    def on_wire():
+        now = time.perf_counter()
+        for trace in traces:
+            BACNET_WRITE_TO_WIRE.observe(now - trace.startedAt)
+    commands.append(commandLoop.namedCommand(CommandCode.ValvesCommit, onWire=on_wire if traces else None,
+                                             onDone=finish if tracked else None, traces=traces))
+
+    # the whole transaction or none of it, a begin without its commit would leave the hub mid-transaction
+    commandLoop.queueCommands(commands, transaction=True)
+    commandsLog.debug("queued: valve transaction of %d puts", len(actions))
+
+def publish_operation_progress(operation):
+    """Push a valve operation's progress to the live dashboards as its batches complete."""
+    live_updates.publish(f"operations/{operation.id}", operation.progress)
+
+# All valve transactions are paced by the scheduler; BACnet writes set the desired position and the reconciler
+# submits it, then keeps at it until the RTU reports it
+valve_scheduler = ValveScheduler(queue_valve_batch, onProgress=publish_operation_progress)
+valve_reconciler = ValveReconciler(valve_scheduler.submit)
+
+def reconcile_hub_update(topic, payload):
+    """Event bus subscriber feeding reported positions, and the hub coming back, to the reconciler."""
+    if topic == "vitals":
+        valve_reconciler.noteReported(payload.oid, payload.valves)
+    elif topic == "valves":
+        valve_reconciler.noteReported(payload.oid, payload.positions)
+    elif topic == "sweep":
+        for vitals in payload:
+            valve_reconciler.noteReported(vitals.oid, vitals.valves)
+    elif topic == "recovered":
+        valve_reconciler.noteHubRecovered()
 
 if __name__ == "__main__":
     main()
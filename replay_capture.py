@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Replays serial captures written with TWIG_CAPTURE=<path> into HubEventLoop.dispatch, without a hub attached
+# usage: replay_capture.py capture.bin [capture.bin.1 ...] [--realtime] [--speed 2] [--profile]
+
+import argparse
+import cProfile
+import pstats
+import time
+
+import hubLoop
+from hubLoop import HubCommandLoop, HubEventLoop, VITALS_SWEEP_COMMAND
+from lib import capture, packet_codes
+from lib.logs import configureLogging
+
+
+def replay(paths, realtime=False, speed=1.0):
+	commandLoop = HubCommandLoop(None)
+	eventLoop = HubEventLoop(None, commandLoop)
+	hubLoop.commandLoop = commandLoop
+	hubLoop.eventLoop = eventLoop
+	records = rxBytes = 0
+	firstTimestamp = None
+	started = time.perf_counter()
+	for path in paths:
+		for timestamp, direction, bits in capture.readCapture(path):
+			if realtime:
+				if firstTimestamp is None:
+					firstTimestamp = timestamp
+				delay = (timestamp - firstTimestamp) / speed - (time.perf_counter() - started)
+				if delay > 0:
+					time.sleep(delay)
+			records += 1
+			if direction == capture.DIRECTION_RX:
+				rxBytes += len(bits)
+				eventLoop.feed(bits)
+				commandLoop.drainEvents()  # nothing is waiting on solicited events during a replay
+			elif bytes(packet_codes.unescapePacketCodes(bits))[1:6] == VITALS_SWEEP_COMMAND:
+				eventLoop.beginVitalsSweep()
+	elapsed = time.perf_counter() - started
+	print(f"replayed {records} records, {rxBytes} rx bytes in {elapsed:.3f}s ({rxBytes / elapsed if elapsed else 0:.0f} B/s)")
+	print(f"{len(eventLoop.unique_ids)} rtus seen")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="replay a serial capture through the hub event decoder")
+	parser.add_argument("paths", nargs="+", help="capture files, oldest first")
+	parser.add_argument("--realtime", action="store_true", help="keep the original spacing between chunks")
+	parser.add_argument("--speed", type=float, default=1.0, help="realtime speed multiplier")
+	parser.add_argument("--profile", action="store_true", help="run under cProfile and print the hottest functions")
+	parser.add_argument("--log", default="WARNING", help="log levels, same syntax as TWIG_LOG")
+	args = parser.parse_args()
+	configureLogging(args.log)
+	if args.profile:
+		profiler = cProfile.Profile()
+		profiler.runcall(replay, args.paths, args.realtime, args.speed)
+		pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+	else:
+		replay(args.paths, args.realtime, args.speed)
+
+
+if __name__ == "__main__":
+	main()
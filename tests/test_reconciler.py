@@ -0,0 +1,142 @@
+import unittest
+
+from lib import valve_positions
+from lib.central_control_types import OUTCOME_CANCELLED, OUTCOME_DROPPED, OUTCOME_OK, OUTCOME_TIMEOUT, OUTCOME_UNAVAILABLE
+from lib.reconciler import ValveReconciler
+from lib.tracing import TRACER
+from lib.valve_scheduler import ValveScheduler
+
+OID = 0x1B00_0001  # 2 valves
+MASK, BITS = valve_positions.encode(OID, 1, 2)
+WRONG = BITS ^ MASK
+
+
+class ValveReconcilerTest(unittest.TestCase):
+	# drives the state machine by hand: nextBatch stands in for the loop, noteBatchDone for the hub's answers
+	def setUp(self):
+		self.reconciler = ValveReconciler(lambda *args, **kwargs: None, backoff=0.0, maxBackoff=0.0, maxAttempts=3)
+		self.reconciler.setDesired(OID, 1, 2)
+
+	def attempt(self, outcome=None):
+		# the due batch, completed with outcome; False if the RTU was not due or was given up on
+		with self.reconciler.condition:
+			actions, _ = self.reconciler.nextBatch()
+		if OID not in actions:
+			return False
+		if outcome is not None:
+			self.reconciler.noteBatchDone({OID: outcome})
+		return True
+
+	def target(self):
+		return self.reconciler.targets[OID]
+
+	def giveUp(self):
+		for _ in range(3):
+			self.assertTrue(self.attempt(OUTCOME_TIMEOUT))
+		self.assertFalse(self.attempt())
+		self.assertIsNotNone(self.target().gaveUpAt)
+
+	def testSendsUntilConfirmed(self):
+		self.assertTrue(self.attempt(OUTCOME_OK))
+		self.assertTrue(self.attempt(OUTCOME_OK))  # not reported yet, so sent again
+		self.reconciler.noteReported(OID, BITS)
+		self.assertFalse(self.attempt())
+		self.assertEqual(self.reconciler.pendingCount(), 0)
+
+	def testGivesUpAfterMaxAttempts(self):
+		self.giveUp()
+		self.assertEqual(self.target().attempts, 3)
+
+	def testUnsentOutcomesAreNotCharged(self):
+		for outcome in [OUTCOME_UNAVAILABLE] * 10 + [OUTCOME_DROPPED]:
+			self.assertTrue(self.attempt(outcome))
+		self.assertEqual(self.target().attempts, 0)
+		self.assertEqual(self.target().deferrals, 11)
+		self.assertTrue(self.attempt(OUTCOME_OK))
+		self.assertEqual(self.target().attempts, 1)
+		self.assertEqual(self.target().deferrals, 0)
+
+	def testUnsentOutcomesBackOff(self):
+		self.reconciler.backoff, self.reconciler.maxBackoff = 10.0, 300.0
+		self.assertTrue(self.attempt(OUTCOME_UNAVAILABLE))
+		self.assertFalse(self.attempt())  # waits out its backoff
+		self.reconciler.noteHubRecovered()
+		self.assertTrue(self.attempt())
+
+	def testWrongReportRearmsGivenUp(self):
+		self.giveUp()
+		self.reconciler.noteReported(OID, WRONG)
+		self.assertTrue(self.attempt(OUTCOME_OK))
+		self.assertEqual(self.target().attempts, 1)
+
+	def testWrongReportWaitsMaxBackoffAfterGivingUp(self):
+		self.reconciler.maxBackoff = 300.0
+		self.giveUp()
+		self.reconciler.noteReported(OID, WRONG)
+		self.assertFalse(self.attempt())
+		self.target().gaveUpAt -= 300.0
+		self.reconciler.noteReported(OID, WRONG)
+		self.assertTrue(self.attempt())
+
+	def testRecoveryRearmsGivenUp(self):
+		self.reconciler.maxBackoff = 300.0
+		self.giveUp()
+		self.reconciler.noteHubRecovered()
+		self.assertTrue(self.attempt(OUTCOME_OK))
+		self.assertIsNone(self.target().gaveUpAt)
+
+	def testRecoveryLeavesConfirmedAlone(self):
+		self.assertTrue(self.attempt(OUTCOME_OK))
+		self.reconciler.noteReported(OID, BITS)
+		self.reconciler.noteHubRecovered()
+		self.assertFalse(self.attempt())
+
+	def testDriftIsCorrected(self):
+		self.assertTrue(self.attempt(OUTCOME_OK))
+		self.reconciler.noteReported(OID, BITS)
+		self.reconciler.noteReported(OID, WRONG)
+		self.assertTrue(self.attempt())
+
+	def testReportOfOtherValveIsIgnored(self):
+		self.assertTrue(self.attempt(OUTCOME_OK))
+		_, otherBits = valve_positions.encode(OID, 2, 1)
+		self.reconciler.noteReported(OID, BITS | otherBits)
+		self.assertFalse(self.attempt())
+
+	def testChangeWhileQueuedIsHeld(self):
+		self.assertTrue(self.attempt())
+		self.reconciler.setDesired(OID, 1, 1)
+		self.assertFalse(self.attempt())  # one transaction in flight per RTU
+		self.reconciler.noteBatchDone({OID: OUTCOME_TIMEOUT})
+		with self.reconciler.condition:
+			actions, _ = self.reconciler.nextBatch()
+		self.assertEqual(actions, {OID: valve_positions.putBits(OID, valve_positions.encode(OID, 1, 1)[1])})
+		self.assertEqual(self.target().attempts, 1)
+
+	def testChangeWhileQueuedSurvivesCancel(self):
+		scheduler = ValveScheduler(lambda *args: None)
+		self.reconciler.queueBatch = scheduler.submit
+		operation = self.reconciler.setDesiredMany([(OID, 1, 1)])
+		self.reconciler.setDesiredMany([(OID, 1, 2)])
+		scheduler.cancel(operation.id)
+		self.assertEqual(self.reconciler.desired(OID), (MASK, BITS))
+		self.assertTrue(self.attempt())
+
+	def testCancelledOperationIsNotResent(self):
+		# the scheduler's loop is not running, so the whole operation is still waiting when it is cancelled
+		scheduler = ValveScheduler(lambda *args: None)
+		self.reconciler.queueBatch = scheduler.submit
+		trace = TRACER.begin("test")
+		operation = self.reconciler.setDesiredMany([(OID, 1, 1)], trace=trace)
+		scheduler.cancel(operation.id)
+		self.assertEqual(trace.outcome, OUTCOME_CANCELLED)
+		self.assertIsNone(self.reconciler.desired(OID))
+		self.assertFalse(self.attempt())
+		self.reconciler.noteReported(OID, WRONG)
+		self.reconciler.noteHubRecovered()
+		self.assertFalse(self.attempt())
+		self.assertEqual(self.reconciler.pendingCount(), 0)
+
+
+if __name__ == "__main__":
+	unittest.main()